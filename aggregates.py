@@ -0,0 +1,176 @@
+'''
+Rolling-window aggregates of reported values, e.g. the mean wind speed over
+the last 10 minutes, kept up to date as reports come in so that dashboards
+can read them directly instead of asking Prometheus to work them out.
+
+Each window holds the samples reported within the last so many seconds in
+a deque, along with a running total or, for maxima and minima, only the
+samples that can still become the extreme. Adding a sample and dropping
+the ones that have aged out is O(1) amortised. The windows of a series are
+dropped along with it when it stops being reported.
+'''
+import math
+from collections import deque
+from snapshot import Snapshot
+
+
+class Mean:
+    '''Mean of the samples in the window'''
+    __slots__ = ('seconds', 'samples', 'total')
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.samples = deque()
+        self.total = 0.0
+
+    def add(self, now: float, value: float) -> float:
+        samples = self.samples
+        samples.append((now, value))
+        self.total += value
+        cutoff = now - self.seconds
+        while samples[0][0] <= cutoff:
+            self.total -= samples.popleft()[1]
+        return round(self.total / len(samples), 2)
+
+
+class Extreme:
+    '''
+    Maximum, or with `largest` false minimum, of the samples in the window.
+    A sample that is beaten by a later one can never be the extreme again,
+    so the deque only holds samples in decreasing (or increasing) order.
+    '''
+    __slots__ = ('seconds', 'samples', 'largest')
+
+    def __init__(self, seconds: float, largest: bool = True):
+        self.seconds = seconds
+        self.samples = deque()
+        self.largest = largest
+
+    def add(self, now: float, value: float) -> float:
+        samples = self.samples
+        if self.largest:
+            while samples and samples[-1][1] <= value:
+                samples.pop()
+        else:
+            while samples and samples[-1][1] >= value:
+                samples.pop()
+        samples.append((now, value))
+        cutoff = now - self.seconds
+        while samples[0][0] <= cutoff:
+            samples.popleft()
+        return samples[0][1]
+
+
+class VectorMean:
+    '''
+    Mean of directions in degrees, taken as unit vectors so that the mean
+    of 350 and 10 is 0 rather than 180
+    '''
+    __slots__ = ('seconds', 'samples', 'x', 'y')
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.samples = deque()
+        self.x = 0.0
+        self.y = 0.0
+
+    def add(self, now: float, value: float) -> float:
+        radians = math.radians(value)
+        x, y = math.sin(radians), math.cos(radians)
+        samples = self.samples
+        samples.append((now, x, y))
+        self.x += x
+        self.y += y
+        cutoff = now - self.seconds
+        while samples[0][0] <= cutoff:
+            _, x, y = samples.popleft()
+            self.x -= x
+            self.y -= y
+        # Rounded first, so that a hair under 360 comes out as 0
+        return round(math.degrees(math.atan2(self.x, self.y)), 1) % 360
+
+
+FUNCTIONS = {
+    'mean': Mean,
+    'max': Extreme,
+    'min': lambda seconds: Extreme(seconds, largest=False),
+    'vector_mean': VectorMean,
+}
+
+
+class Rule:
+    '''
+    Aggregate the series of the `source` metric with `function` into the
+    `target` metric, which is declared with the given name and documentation.
+    If `sensors` is given, only series with one of those sensor labels count.
+    '''
+    __slots__ = ('source', 'function', 'target', 'name', 'documentation', 'sensors')
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, source: str, function: str, target: str, name: str,
+                 documentation: str, sensors: tuple = None):
+        self.source = source
+        self.function = FUNCTIONS[function]
+        self.target = target
+        self.name = name
+        self.documentation = documentation
+        self.sensors = sensors
+
+
+class Aggregator:
+    '''
+    Maintains every rule's aggregates over every window, a dict of label to
+    seconds, for the series in `snapshot`.
+    '''
+
+    def __init__(self, snapshot: Snapshot, windows: dict, rules: list):
+        self.snapshot = snapshot
+        self.windows = windows
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.source, []).append(rule)
+        self.targets = {rule.target for rule in rules}
+        self.state = {}
+
+    def setup(self):
+        '''Declare the target metrics, with the labels of their source and a window'''
+        common = len(self.snapshot.common_labels)
+        for rules in self.rules.values():
+            for rule in rules:
+                labelnames = self.snapshot.families[rule.source].labelnames[common:]
+                self.snapshot.add_gauge(rule.target, rule.name, rule.documentation, list(labelnames) + ['window'])
+
+    def update(self, writes: list, now: float) -> list:
+        '''
+        Feed a report's (metric, labels, value) writes into the windows and
+        return the aggregates' writes. Callers serialise reports from one
+        station, and series from different stations never share a window.
+        '''
+        aggregates = []
+        sensor = len(self.snapshot.common_labels)
+        for metric, labels, value in writes:
+            rules = self.rules.get(metric)
+            if rules is None or math.isnan(value):
+                continue
+            for rule in rules:
+                if rule.sensors and labels[sensor] not in rule.sensors:
+                    continue
+                for window, seconds in self.windows.items():
+                    key = (rule.target, labels, window)
+                    state = self.state.get(key)
+                    if state is None:
+                        state = self.state[key] = rule.function(seconds)
+                    aggregates.append((rule.target, labels + (window,), state.add(now, value)))
+        return aggregates
+
+    def forget(self, metric: str, labels: tuple):
+        '''
+        Drop the windows of a removed series, so that they are not kept
+        forever: those fed by it if it is a source, or its own if it is an
+        aggregate. A series that is reported again starts with new windows.
+        '''
+        for rule in self.rules.get(metric, ()):
+            for window in self.windows:
+                self.state.pop((rule.target, labels, window), None)
+        if metric in self.targets:
+            self.state.pop((metric, labels[:-1], labels[-1]), None)
@@ -0,0 +1,237 @@
+'''
+Backfill Prometheus from archived gateway reports.
+
+    python backfill.py [-o FILE] [-p PROCESSES] ARCHIVE...
+    promtool tsdb create-blocks-from openmetrics FILE DATA_DIR
+
+Each archive holds raw report bodies in the format of data.txt, one
+urlencoded payload per line. Every payload goes through the same ingest
+plan as /report, with the same unit, location, STATION_PASSKEYS and other
+SETTINGS taken from the environment, and every metric it sets comes out as an
+OpenMetrics sample timestamped with the payload's dateutc. Payloads with
+no usable dateutc are skipped, as are payloads with a reading that cannot
+be converted, which are reported with their file and line number.
+
+Archives are split into chunks of lines, converted by several processes
+at once. Each chunk's samples are written to a temporary file grouped by
+series, as OpenMetrics wants each series' samples together, and the files
+are joined up at the end, each opened only while a section is read from
+it. Memory use and open files depend on the chunk size, not on the size of
+the archives. Archives should be given in time order.
+'''
+import argparse
+import calendar
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from config import Config
+from ecowitt_exporter import Exporter
+from ingest import INFO, parse_body
+from snapshot import escape
+
+# Bytes of archive converted by one process at a time. Each chunk's samples
+# are held in memory until it is done, which takes several times as much.
+CHUNK_SIZE = 2 * 1024 * 1024
+
+# Settings that change the metrics a report sets, which archives are
+# converted with, along with every *_LOCATION. The rest are about serving,
+# e.g. STATE_FILE, POLL_GATEWAYS or MQTT_URL, and are left out.
+SETTINGS = (
+    'TEMPERATURE_UNIT', 'PRESSURE_UNIT', 'WIND_UNIT', 'RAIN_UNIT', 'DISTANCE_UNIT', 'IRRADIANCE_UNIT',
+    'AQI_STANDARD', 'STATION_ID', 'STATION_PASSKEYS', 'DERIVED_METRICS', 'DISCOVER_KEYS',
+)
+
+# The exporter whose stations, derived metrics and metric families archives
+# are converted with, set up by load()
+exporter = None # pylint: disable=invalid-name
+
+
+def load(environ: dict = None) -> Exporter:
+    '''Set up the exporter from the SETTINGS in the environment, as they would be set to serve'''
+    global exporter # pylint: disable=global-statement
+    environ = os.environ if environ is None else environ
+    exporter = Exporter(Config({
+        name: value for name, value in environ.items() if name in SETTINGS or name.endswith('_LOCATION')
+    }))
+    exporter.setup_metrics()
+    return exporter
+
+
+def parse_dateutc(value: str) -> int:
+    '''Seconds since the epoch of a dateutc such as "2025-05-30 19:31:57"'''
+    return calendar.timegm((
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]),
+    ))
+
+
+def format_value(value: float) -> str:
+    if math.isfinite(value):
+        return repr(value)
+    return 'NaN' if math.isnan(value) else ('+Inf' if value > 0 else '-Inf')
+
+
+def line_number(path: str, offset: int) -> int:
+    '''The number of the line of an archive starting at byte `offset`'''
+    with open(path, 'rb') as archive:
+        return archive.read(offset).count(b'\n') + 1
+
+
+def payloads(path: str, start: int = 0, end: int = None):
+    '''
+    Yield (offset, timestamp, payload) for each line of an archive that
+    starts between byte offsets `start` and `end`, skipping lines without a
+    dateutc
+    '''
+    with open(path, 'rb') as archive:
+        if start:
+            archive.seek(start - 1)
+            archive.readline()
+        while end is None or archive.tell() < end:
+            offset = archive.tell()
+            line = archive.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            data = parse_body(line)
+            try:
+                timestamp = parse_dateutc(data.get('dateutc', ''))
+            except ValueError:
+                continue
+            yield offset, timestamp, data
+
+
+def writes(data: dict, timestamp: int) -> list:
+    '''Every metric write for one payload, as ingest() would make them'''
+    station = exporter.stations.identify(data)
+    result = station.plan.evaluate(data, timestamp)
+    result.append(('last_report_timestamp', (station.name,), timestamp))
+    if exporter.derived:
+        result.extend(exporter.derived.evaluate(station.plan, data))
+    return result
+
+
+def series_name(metric: str, labels: tuple, value) -> str:
+    '''A series' name and labels, as they start its sample lines'''
+    family = exporter.metrics.families[metric]
+    pairs = ','.join(f'{name}="{escape(str(label))}"' for name, label in zip(family.labelnames, labels))
+    return f'{family.name}_info{{{pairs}}} ' if value is INFO else f'{family.name}{{{pairs}}} '
+
+
+def convert(job: tuple) -> tuple:
+    '''
+    Convert the lines of an archive between two offsets into the file
+    `stem`, one section of sample lines per series. Returns an index of
+    (offset, length) of each series' section and the numbers of payloads
+    converted, samples and payloads skipped as they could not be converted.
+    '''
+    path, start, end, stem = job
+    # Each series' last value, its sample line up to the timestamp, its
+    # sample lines so far and its name and labels
+    series = {}
+    reports = samples = skipped = 0
+    for offset, timestamp, data in payloads(path, start, end):
+        stamp = f' {timestamp}\n'
+        try:
+            batch = writes(data, timestamp)
+        except (KeyError, ValueError) as error:
+            # A corrupt line, e.g. a cut-off reading, should not stop the rest
+            print(f'Skipping {path} line {line_number(path, offset)}: {error!r}', file=sys.stderr)
+            skipped += 1
+            continue
+        for metric, labels, value in batch:
+            entry = series.get((metric, labels))
+            if entry is None:
+                entry = series[(metric, labels)] = [None, None, [], series_name(metric, labels, value)]
+            # Most readings are the same as last time, so is their text
+            if entry[0] != value:
+                entry[0] = value
+                entry[1] = entry[3] + ('1' if value is INFO else format_value(value))
+            entry[2].append(entry[1] + stamp)
+        reports += 1
+        samples += len(batch)
+
+    index = {}
+    with open(stem, 'wb') as output:
+        for key, entry in series.items():
+            section = ''.join(entry[2]).encode()
+            index[key] = (output.tell(), len(section))
+            output.write(section)
+    return index, reports, samples, skipped
+
+
+def chunks(paths: list, directory: str) -> list:
+    '''Split archives into (path, start, end, stem) jobs of about CHUNK_SIZE bytes'''
+    jobs = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), CHUNK_SIZE):
+            jobs.append((path, start, min(start + CHUNK_SIZE, size), os.path.join(directory, str(len(jobs)))))
+    return jobs
+
+
+def backfill(paths: list, output, processes: int = None) -> tuple:
+    '''
+    Write the metrics of every payload in the archives at `paths`, in that
+    order, to the binary stream `output` as OpenMetrics. Returns the numbers
+    of payloads converted, samples and payloads skipped.
+    '''
+    with tempfile.TemporaryDirectory(prefix='ecowitt-backfill-') as directory:
+        jobs = chunks(paths, directory)
+        if processes == 1 or len(jobs) == 1:
+            results = [convert(job) for job in jobs]
+        else:
+            # Forked, so the workers have the metric families already declared
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                results = pool.map(convert, jobs, chunksize=1)
+
+        # Every series of each family, in the order they were first seen
+        families = {}
+        for index, *_counts in results:
+            for key in index:
+                families.setdefault(key[0], {})[key] = None
+        for metric, family in exporter.metrics.families.items():
+            if metric not in families:
+                continue
+            output.write(f'# HELP {family.name} {escape(family.documentation)}\n'.encode())
+            output.write(f'# TYPE {family.name} {family.kind}\n'.encode())
+            # OpenMetrics wants each series' samples together, so each
+            # chunk's section of a series follows the one before. A year of
+            # chunks is more files than can be open at once, so each one is
+            # only opened to read a section.
+            for key in families[metric]:
+                for job, (index, *_counts) in zip(jobs, results):
+                    if key in index:
+                        offset, length = index[key]
+                        with open(job[3], 'rb') as part:
+                            part.seek(offset)
+                            output.write(part.read(length))
+        output.write(b'# EOF\n')
+    return tuple(sum(result[field] for result in results) for field in (1, 2, 3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert archived Ecowitt reports to OpenMetrics for promtool backfilling')
+    parser.add_argument('archives', nargs='+', help='files of urlencoded report bodies, one per line')
+    parser.add_argument('-o', '--output', help='file to write, instead of standard output')
+    parser.add_argument('-p', '--processes', type=int, help='processes to convert with (default: one per CPU)')
+    args = parser.parse_args()
+
+    load()
+    started = time.perf_counter()
+    if args.output:
+        with open(args.output, 'wb') as output:
+            reports, samples_written, skipped = backfill(args.archives, output, args.processes)
+    else:
+        reports, samples_written, skipped = backfill(args.archives, sys.stdout.buffer, args.processes)
+    print(f'{reports} reports, {samples_written} samples in {time.perf_counter() - started:.1f}s'
+          + (f', {skipped} reports skipped' if skipped else ''), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Validate the built-in AQI and Beaufort tables and time them.
+
+    python benchmarks/bench_aqi.py
+
+If python-aqi is installed (pip install python-aqi), the EPA and MEP tables
+are checked against it for every 0.01 µg/m3 step from 0 to 500 and the
+two are timed against each other. The UK DAQI and Beaufort bisect lookups
+are checked against the if-chains they replaced.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order,too-many-return-statements
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conversions import PiecewiseIndex, EPA_PM25, MEP_PM25, aqi_uk, mph2beaufort
+
+try:
+    import aqi
+except ImportError:
+    aqi = None
+
+
+def chain_uk(concentration):
+    '''The UK DAQI if-chain as it was'''
+    if concentration < 12:
+        return 1
+    elif concentration < 24:
+        return 2
+    elif concentration < 36:
+        return 3
+    elif concentration < 42:
+        return 4
+    elif concentration < 48:
+        return 5
+    elif concentration < 54:
+        return 6
+    elif concentration < 59:
+        return 7
+    elif concentration < 65:
+        return 8
+    elif concentration < 71:
+        return 9
+    return 10
+
+
+def chain_beaufort(speed):
+    '''The Beaufort if-chain as it was'''
+    for number, limit in enumerate((1, 3, 7, 12, 18, 24, 31, 38, 46, 54, 63, 73)):
+        if speed <= limit:
+            return number
+    return 12
+
+
+def concentrations():
+    '''Every 0.01 step from 0 to 500, as the strings a gateway would send'''
+    return ['{:.2f}'.format(step / 100) for step in range(50001)]
+
+
+def validate():
+    values = concentrations()
+    failures = 0
+    for value in values:
+        number = float(value)
+        failures += aqi_uk(number) != chain_uk(number)
+        failures += mph2beaufort(number / 4) != chain_beaufort(number / 4)
+    print(f'UK DAQI and Beaufort: {len(values)} values, {failures} mismatches')
+
+    if aqi is None:
+        print('python-aqi is not installed, skipping EPA and MEP validation')
+        return failures
+
+    for name, table, precision, algo in [('EPA', EPA_PM25, 1, aqi.ALGO_EPA), ('MEP', MEP_PM25, 0, aqi.ALGO_MEP)]:
+        engine = PiecewiseIndex(table, precision=precision, memo=0)
+        mismatches = 0
+        for value in values:
+            if engine(float(value)) != int(aqi.to_iaqi(aqi.POLLUTANT_PM25, value, algo=algo)):
+                mismatches += 1
+                if mismatches < 5:
+                    print(f'  {name} mismatch at {value}')
+        print(f'{name}: {len(values)} values, {mismatches} mismatches')
+        failures += mismatches
+    return failures
+
+
+def bench():
+    # A day of 24h averages from a handful of sensors repeats a lot
+    values = [float(value) for value in concentrations()[::50]]
+    repeated = values[:40] * 25
+
+    def run(name, func, sample, number=20):
+        seconds = min(timeit.repeat(lambda: [func(v) for v in sample], number=number, repeat=3))
+        print(f'  {name:<24} {seconds / (number * len(sample)) * 1e6:8.3f} µs/call')
+
+    print('Timings:')
+    run('UK if-chain', chain_uk, values)
+    run('UK bisect', aqi_uk, values)
+    run('Beaufort if-chain', chain_beaufort, values)
+    run('Beaufort bisect', mph2beaufort, values)
+    for name, table, precision, algo in [('EPA', EPA_PM25, 1, 'aqi.algos.epa'), ('MEP', MEP_PM25, 0, 'aqi.algos.mep')]:
+        if aqi is not None:
+            run(f'{name} python-aqi', lambda v, algo=algo: aqi.to_iaqi(aqi.POLLUTANT_PM25, str(v), algo=algo), values, number=2)
+        run(f'{name} table', PiecewiseIndex(table, precision=precision, memo=0), values)
+        run(f'{name} table, memo, repeats', PiecewiseIndex(table, precision=precision), repeated)
+
+
+def main():
+    failures = validate()
+    bench()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Throughput of backfill.py on a generated archive of 16-second reports.
+
+    python benchmarks/bench_backfill.py [days] [processes]
+
+Writes `days` (default 7) of minute-by-minute-like pushes every 16 seconds
+to a temporary archive, converts it with one process and then with
+`processes` (default one per CPU), and reports reports/sec for each.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import calendar
+import io
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backfill
+from payloads import realistic_payloads
+
+
+def write_archive(path: str, days: float) -> int:
+    '''An archive of `days` of reports 16 seconds apart. Returns how many.'''
+    start = calendar.timegm((2025, 3, 1, 0, 0, 0))
+    payloads = realistic_payloads(2000)
+    count = int(days * 86400 / 16)
+    with open(path, 'w', encoding='utf-8') as archive:
+        for index in range(count):
+            payload = dict(payloads[index % len(payloads)])
+            payload['dateutc'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start + 16 * index))
+            archive.write(urlencode(payload) + '\n')
+    return count
+
+
+class Counter(io.RawIOBase):
+    '''A binary stream that only counts what is written to it'''
+
+    def __init__(self):
+        super().__init__()
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def main():
+    days = float(sys.argv[1]) if len(sys.argv) > 1 else 7
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    backfill.load()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'archive.txt')
+        count = write_archive(path, days)
+        print(f'{count} reports, {days:g} days at 16s, {os.path.getsize(path) / 1e6:.0f} MB')
+        for label, workers in [('1 process', 1), (f'{processes} processes', processes)]:
+            output = Counter()
+            start = time.perf_counter()
+            backfill.backfill([path], output, workers)
+            elapsed = time.perf_counter() - start
+            print(f'  {label:12s} {elapsed:8.1f}s  {count / elapsed:10.0f} reports/s  {output.size / 1e6:8.0f} MB out')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+'''
+Saving from skipping unchanged readings, per report, for sequences of
+pushes built from data.txt.
+
+    python benchmarks/bench_changes.py [reports]
+
+Each sequence is evaluated into a Snapshot by an IngestPlan as the exporter
+does, once as it is and once with the change cache emptied before every
+report, which is roughly what every key cost before. "realistic" is a
+minute-by-minute sequence where wind, outdoor temperature and the like
+change on every push and other readings now and then; "drifting" changes
+every reading on every push, the worst case; "identical" repeats one
+push, the best case.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import IngestPlan
+from snapshot import Snapshot
+from bench_ingest import gauge_metrics
+from bench_metrics import snapshot_metrics
+from payloads import drifted_payloads, realistic_payloads, sample_payload
+from prometheus_client import CollectorRegistry
+
+
+def per_report(payloads: list, snapshot: Snapshot, reports: int, forget: bool = False) -> tuple:
+    '''
+    Microseconds per report and the fraction of keys that were unchanged.
+    If `forget`, the change cache is emptied before every report.
+    '''
+    plan = IngestPlan()
+    counts = [0, 0]
+    start = time.perf_counter()
+    for index in range(reports):
+        if forget:
+            plan.last.clear()
+        now = time.time()
+        snapshot.apply(plan.evaluate(payloads[index % len(payloads)], now, counts=counts), now)
+    elapsed = time.perf_counter() - start
+    return elapsed / reports * 1e6, counts[0] / counts[1]
+
+
+def main():
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    families = gauge_metrics(CollectorRegistry())
+    sequences = [
+        ('realistic', realistic_payloads(1000)),
+        ('drifting', drifted_payloads(1000)),
+        ('identical', [sample_payload()]),
+    ]
+    print(f'{reports} reports of {len(sample_payload())} keys each')
+    print(f'  {"":10s} {"misses":>10s} {"cached":>10s} {"saving":>8s} {"unchanged":>10s}')
+    for name, payloads in sequences:
+        before, _ = per_report(payloads, snapshot_metrics(families), reports, forget=True)
+        after, unchanged = per_report(payloads, snapshot_metrics(families), reports)
+        print(f'  {name:10s} {before:8.1f}µs {after:8.1f}µs {1 - after / before:7.0%} {unchanged:10.0%}')
+
+
+if __name__ == '__main__':
+    main()
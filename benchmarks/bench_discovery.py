@@ -0,0 +1,67 @@
+'''
+Cost and bounds of exposing unrecognised report keys with DISCOVER_KEYS.
+
+    python benchmarks/bench_discovery.py [reports] [new keys]
+
+Replays `reports` (default 2000) realistic pushes from data.txt through
+ingest(), as sent by a gateway with five keys the exporter does not know,
+and by a misbehaving one that also sends `new keys` (default 20) keys it
+has never sent before on every push. Each goes to an exporter without
+discovery and one with DISCOVER_KEYS=* and the default DISCOVER_MAX_SERIES.
+Shows the time per report, then the discovered series, the keys held in
+the station's ingest plan and the size of /metrics at the end.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from ecowitt_exporter import Exporter
+from payloads import realistic_payloads
+
+UNKNOWN_KEYS = {'wh90batt': '3.2', 'ws90cap_volt': '5.4', 'heap': '121892', 'interval': '60', 'ws90_ver': '152'}
+
+
+def gateway_payloads(count: int, new_keys: int) -> list:
+    '''Realistic pushes with the unknown keys, plus `new_keys` never seen before in each'''
+    payloads = []
+    for index, payload in enumerate(realistic_payloads(count)):
+        payload.update(UNKNOWN_KEYS)
+        for number in range(new_keys):
+            payload[f'new{index}_{number}'] = str(number)
+        payloads.append(payload)
+    return payloads
+
+
+def replay(environ: dict, payloads: list) -> tuple:
+    '''Ingest every payload, returning seconds per report and the exporter'''
+    exporter = Exporter(Config(environ))
+    exporter.setup_metrics()
+    station = exporter.stations.get('bench')
+    start = time.perf_counter()
+    for index, payload in enumerate(payloads):
+        exporter.ingest(station, payload, 1748633517.0 + index * 60)
+    return (time.perf_counter() - start) / len(payloads), exporter
+
+
+def main():
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    new_keys = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(f'{reports} reports, {len(UNKNOWN_KEYS)} unknown keys in each')
+    print(f'  {"gateway":12s} {"discovery":10s} {"per report":>12s} {"raw series":>11s} {"plan keys":>10s} {"/metrics":>10s}')
+    for label, extra in (('usual', 0), (f'+{new_keys} new', new_keys)):
+        payloads = gateway_payloads(reports, extra)
+        for environ in ({}, {'DISCOVER_KEYS': '*'}):
+            # Best of three runs
+            seconds, exporter = min((replay(environ, payloads) for _ in range(3)), key=lambda run: run[0])
+            raw = exporter.metrics.families.get('raw')
+            plan = exporter.stations.get('bench').plan
+            print(f'  {label:12s} {"on" if environ else "off":10s} {seconds * 1e6:10.1f}µs '
+                  f'{len(raw.samples) if raw else 0:11d} {len(plan.last):10d} {len(exporter.metrics.exposition()):10d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+'''
+Cost of writing a report's readings into the snapshot, with and without
+the handles IngestPlan keeps to the Samples each key's writes go to.
+
+    python benchmarks/bench_handles.py [reports] [sensors]
+
+Replays a minute-by-minute sequence of pushes from data.txt with `sensors`
+(default 120) extra soil probes, each sending a moisture reading and a
+battery voltage. The same pushes go through two exporters, one looking up
+every write's family and labels and one writing through handles, with
+some series removed part way as SERIES_TTL would. Checks both end up with
+the same samples, then times evaluate and apply per report, and apply on
+its own per write, for `reports` (default 5000) reports.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from ecowitt_exporter import Exporter
+from payloads import realistic_payloads, with_channels
+
+
+def station_payloads(count: int, sensors: int, seed: int = 0) -> list:
+    '''Realistic pushes with `sensors` soil probes added, a few changing each time'''
+    return with_channels(realistic_payloads(count, seed), sensors, seed)
+
+
+def exporter() -> Exporter:
+    instance = Exporter(Config({}))
+    instance.setup_metrics()
+    return instance
+
+
+def replay(instance: Exporter, payloads: list, handles: bool, remove_at: int = None) -> tuple:
+    '''
+    Apply every payload as ingest() does, optionally removing every fourth
+    series at `remove_at`. Returns seconds in evaluate and apply, seconds in
+    apply and the number of writes.
+    '''
+    station = instance.stations.get('bench')
+    metrics = instance.metrics
+    total = applying = 0.0
+    writes_count = 0
+    for index, payload in enumerate(payloads):
+        if index == remove_at:
+            for metric, family in metrics.families.items():
+                for key in list(family.samples)[::4]:
+                    metrics.remove(metric, key)
+        now = 1748633517.0 + index * 60
+        start = time.perf_counter()
+        batch = [] if handles else None
+        writes = station.plan.evaluate(payload, now, handles=batch)
+        applied = time.perf_counter()
+        with station.lock:
+            metrics.apply(writes, now, batch)
+        end = time.perf_counter()
+        total += end - start
+        applying += end - applied
+        writes_count += len(writes)
+    return total, applying, writes_count
+
+
+def samples(instance: Exporter) -> dict:
+    return {
+        (metric, key): (sample.labels, sample.value, sample.updated)
+        for metric, family in instance.metrics.families.items() for key, sample in family.samples.items()
+    }
+
+
+def main():
+    reports = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    sensors = int(sys.argv[2]) if len(sys.argv) > 2 else 120
+    payloads = station_payloads(500, sensors)
+
+    looked_up, handled = exporter(), exporter()
+    replay(looked_up, payloads, False, remove_at=250)
+    replay(handled, payloads, True, remove_at=250)
+    same = samples(looked_up) == samples(handled)
+    print(f'{len(payloads[0])} keys per report, {sensors} extra sensors, '
+          f'series removed part way: {"same samples" if same else "DIFFERENT samples"} with and without handles')
+
+    # Alternate between the two and keep the best of each
+    sequence = [payloads[index % len(payloads)] for index in range(reports // 3)]
+    results = {False: (float('inf'),) * 2, True: (float('inf'),) * 2}
+    for _ in range(3):
+        for handles in (False, True):
+            total, applying, writes = replay(exporter(), sequence, handles)
+            results[handles] = min(results[handles], (total / len(sequence) * 1e6, applying / writes * 1e9))
+    print(f'{reports} reports, {writes // len(sequence)} writes each')
+    print(f'  {"":10s} {"per report":>12s} {"apply/write":>12s}')
+    for handles, label in ((False, 'lookup'), (True, 'handles')):
+        report, write = results[handles]
+        print(f'  {label:10s} {report:10.1f}µs {write:10.0f}ns')
+    print(f'  saving     {1 - results[True][0] / results[False][0]:11.0%} {1 - results[True][1] / results[False][1]:11.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+'''
+Micro-benchmark of per-payload key dispatch: the compiled IngestPlan against
+the if/elif chain that logecowitt() used to run for every key.
+
+    python benchmarks/bench_ingest.py [iterations]
+
+Both variants write into the same throwaway sink, so the numbers show the
+dispatch and conversion cost without Prometheus client overhead; a second
+pass repeats the comparison against real Gauges in a private registry.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order,invalid-name,too-many-return-statements
+import logging
+import os
+import re
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import CollectorRegistry, Gauge, Info
+from conversions import (mph2kmh_float, mph2ms_float, mph2kts_float, mph2fps_float, in2mm_float, km2mi_float,
+                         inhg2hpa_float, inhg2mmhg_float, wm22lux_float, wm22fc_float, f2c_float, f2k_float,
+                         mph2beaufort)
+from ingest import IngestPlan, rainmaps, calculate_aqi, INFO
+from payloads import drifted_payloads
+
+logger = logging.getLogger('bench')
+
+# The string-in/string-out conversions logecowitt() used, for the legacy chain
+def mph2kmh(mph: str) -> str:
+    '''Convert mph to km/h'''
+    return "{:.2f}".format(mph2kmh_float(float(mph), None))
+
+
+def mph2ms(mph: str) -> str:
+    '''Convert mph to m/s'''
+    return "{:.2f}".format(mph2ms_float(float(mph), None))
+
+
+def mph2kts(mph: str) -> str:
+    '''Convert mph to knots'''
+    return "{:.2f}".format(mph2kts_float(float(mph), None))
+
+
+def mph2fps(mph: str) -> str:
+    '''Convert mph to fps'''
+    return "{:.2f}".format(mph2fps_float(float(mph), None))
+
+
+def in2mm(inches: str) -> str:
+    '''Convert inches to mm'''
+    return "{:.1f}".format(in2mm_float(float(inches), None))
+
+
+def km2mi(km: str) -> str:
+    '''Convert km to miles'''
+    return "{:.2f}".format(km2mi_float(float(km), None))
+
+
+def inhg2hpa(inhg: str) -> str:
+    '''Convert inches Hg to hPa'''
+    return "{:.2f}".format(inhg2hpa_float(float(inhg), None))
+
+
+def inhg2mmhg(inhg: str) -> str:
+    '''Convert inches Hg to mmHg'''
+    return "{:.2f}".format(inhg2mmhg_float(float(inhg), None))
+
+
+def wm22lux(wm2: str) -> str:
+    '''Convert degrees W/m2 to lux'''
+    return "{:.2f}".format(wm22lux_float(float(wm2), None))
+
+
+def wm22fc(wm2: str) -> str:
+    '''Convert degrees W/m2 to foot candle'''
+    return "{:.2f}".format(wm22fc_float(float(wm2), None))
+
+
+def f2c(f: str) -> str:
+    '''Convert degrees Fahrenheit to Celsius'''
+    return "{:.2f}".format(f2c_float(float(f), None))
+
+
+def f2k(f: str) -> str:
+    '''Convert degrees Fahrenheit to Kelvin'''
+    return "{:.2f}".format(f2k_float(float(f), None))
+
+
+# Same defaults as the exporter with no environment set
+temperature_unit = 'c'
+pressure_unit = 'hpa'
+wind_unit = 'kmh'
+rain_unit = 'mm'
+distance_unit = 'km'
+irradiance_unit = 'wm2'
+aqi_standard = 'uk'
+co2_location = None
+outdoor_location = None
+indoor_location = None
+temp1_location = None
+temp2_location = None
+temp3_location = None
+temp4_location = None
+temp5_location = None
+temp6_location = None
+temp7_location = None
+temp8_location = None
+
+
+def legacy(data, addmetric, metrics):
+    '''The logecowitt() key loop as it was before the IngestPlan'''
+    for key in data:
+        # Process each key from the raw data, do unit conversions if necessary,
+        # then add the results to the Prometheus exporter
+        value = data[key]
+        logger.debug("Received raw value %s: %s", key, value)
+
+        # Ignore these fields
+        if key in ['PASSKEY', 'dateutc', 'runtime']:
+            continue
+        
+        # Add these fields as INFO
+        elif key in ['stationtype', 'freq', 'model']:
+            metrics[key].info({key: value})
+
+        # No conversions needed
+        elif key in ['winddir', 'uv', 'lightning_num', 'lightning_time']:
+            addmetric(metric=key, value=value)
+        
+        # Support for WS90 capacitor
+        elif key in ['ws90cap_volt']:
+            addmetric(metric='ws90', label=[key, 'volt'], value=value)
+
+        # Battery status & levels
+        elif 'batt' in key:
+            # Battery level - returns battery level from 0-5
+            if key in ['wh57batt', 'pm25batt1', 'pm25batt2']:
+                addmetric(metric='batterylevel', label=[key], value=value)
+                # Per-sensor last-seen timestamp for PM2.5 sensors (see note
+                # on sensor freshness tracking at bottom of /report handler).
+                # The WH41 PM2.5 sensor can drop off the radio and we want to
+                # alert on that independently of the gateway.
+                if key.startswith('pm25batt'):
+                    addmetric(metric='sensor_last_report_timestamp',
+                              label=[key], value=time.time())
+            # Battery voltage - returns a decimal voltage e.g. 1.7
+            elif key.startswith('soil') or key.startswith('ws90'):
+                addmetric(metric='batteryvoltage', label=[key, 'volt'], value=value)
+                # Per-sensor last-seen timestamp (see note on sensor freshness
+                # tracking at bottom of /report handler).
+                if key.startswith('soilbatt'):
+                    addmetric(metric='sensor_last_report_timestamp',
+                              label=[key], value=time.time())
+            # Battery status - returns 0 for OK and 1 for low
+            else:
+                addmetric(metric='batterystatus', label=[key], value=value)
+
+        # Soil moisture
+        elif key.startswith('soilmoisture'):
+            addmetric(metric='soilmoisture', label=[key, 'percent'], value=value)
+            # Per-sensor last-seen timestamp (see note on sensor freshness
+            # tracking at bottom of /report handler).
+            addmetric(metric='sensor_last_report_timestamp',
+                      label=[key], value=time.time())
+
+        # WH45 CO2/AQI multi-sensor (tf_co2, humi_co2, pm25_co2,
+        # pm25_24h_co2, pm10_co2, pm10_24h_co2, co2, co2_24h)
+        # Must be checked BEFORE the generic pm25 handler.
+        elif key == 'tf_co2':
+            if temperature_unit == 'c':
+                value = f2c(value)
+            elif temperature_unit == 'k':
+                value = f2k(value)
+            location = co2_location if co2_location else 'co2'
+            addmetric(metric='temp', label=['co2', temperature_unit, location], value=value)
+            addmetric(metric='sensor_last_report_timestamp',
+                      label=['co2'], value=time.time())
+
+        elif key == 'humi_co2':
+            location = co2_location if co2_location else 'co2'
+            addmetric(metric='humidity', label=['co2', 'percent', location], value=value)
+
+        elif key == 'pm25_co2':
+            addmetric(metric='pm25', label=['realtime', 'co2', 'μgm3'], value=value)
+
+        elif key == 'pm25_24h_co2':
+            addmetric(metric='pm25', label=['avg_24h', 'co2', 'μgm3'], value=value)
+            aqi = calculate_aqi(standard=aqi_standard, value=value)
+            addmetric(metric='aqi', label=[aqi_standard, 'co2'], value=aqi)
+
+        elif key == 'pm10_co2':
+            addmetric(metric='pm10', label=['realtime', 'co2', 'μgm3'], value=value)
+
+        elif key == 'pm10_24h_co2':
+            addmetric(metric='pm10', label=['avg_24h', 'co2', 'μgm3'], value=value)
+
+        elif key == 'co2':
+            addmetric(metric='co2', label=['realtime', 'ppm'], value=value)
+
+        elif key == 'co2_24h':
+            addmetric(metric='co2', label=['avg_24h', 'ppm'], value=value)
+
+        # PM25 (WH41 channel sensors)
+        # 'pm25_ch1', 'pm25_avg_24h_ch1'
+        elif key.startswith('pm25'):
+            # Check for invalid readings from the WH41 PM2.5 sensor when the battery is low
+            # https://github.com/djjudas21/ecowitt-exporter/issues/17
+            # If we find bad data, just skip the entire PM2.5 section
+            if (data.get('pm25batt1') == '1' and data.get('pm25_ch1') == '1000') or (data.get('pm25batt2') == '1' and data.get('pm25_ch2') == '1000'):
+                logger.debug("Drop erroneous PM25 reading %s: %s", key, value)
+                continue
+
+            # Preserve the original key (e.g. 'pm25_ch1') so we can use it as
+            # a per-sensor last-seen label below.
+            original_key = key
+
+            # Drop PM25 prefix
+            key = key.replace('pm25_', '')
+
+            # Get & drop sensor ch suffix
+            sensorsearch = re.search(r"(ch\d)$", key)
+            sensor = sensorsearch.group(1)
+            key = re.sub(r"ch\d$", '', key)
+
+            # Generate series label
+            if key.startswith('avg_24h'):
+                series = 'avg_24h'
+            else:
+                series = 'realtime'
+
+            # Log the PM25 metric
+            addmetric(metric='pm25', label=[series, sensor, 'μgm3'], value=value)
+
+            # Per-sensor last-seen timestamp for PM2.5 sensors (see note on
+            # sensor freshness tracking at bottom of /report handler). Only
+            # update on the realtime series; avg_24h is a derived rollup and
+            # doesn't represent a fresh sensor push.
+            if series == 'realtime':
+                addmetric(metric='sensor_last_report_timestamp',
+                          label=[original_key], value=time.time())
+
+            # Calculate AQI from PM25
+            if key.startswith('avg_24h'):
+                aqi = calculate_aqi(standard=aqi_standard, value=value)
+                addmetric(metric='aqi', label=[aqi_standard, sensor], value=aqi)
+
+        # Humidity - no conversion needed
+        elif key.startswith('humidity'):
+            match key:
+                case 'humidity':
+                    label = 'outdoor'
+                    location = outdoor_location if outdoor_location else label
+                case 'humidityin':
+                    label = 'indoor'
+                    location = indoor_location if indoor_location else label
+                case _:
+                    label = f'ch{key[-1]}'
+                    location = globals()[f'temp{key[-1]}_location']
+            # pylint: disable=used-before-assignment
+            addmetric(metric='humidity', label=[label, 'percent', location], value=value)
+
+        # Solar irradiance, default W/m^2
+        elif key in ['solarradiation']:
+            if irradiance_unit == 'lx':
+                value = wm22lux(value)
+            elif irradiance_unit == 'fc':
+                value = wm22fc(value)
+            addmetric(metric='solarradiation', label=[irradiance_unit], value=value)
+
+        # Temperature, default Fahrenheit
+        # 'tempinf', 'tempf', 'temp1f', 'temp2f', 'temp3f', 'temp4f', 'temp5f', 'temp6f', 'temp7f', 'temp8f'
+        elif key.startswith('temp'):
+            # Strip trailing f
+            key = key[:-1]
+
+            if temperature_unit == 'c':
+                value = f2c(value)
+            elif temperature_unit == 'k':
+                value = f2k(value)
+
+            if key == 'tempin':
+                label = 'indoor'
+                location = indoor_location if indoor_location else label
+            elif key == 'temp':
+                label = 'outdoor'
+                location = outdoor_location if outdoor_location else label
+            else:
+                label = f'ch{key[-1]}'
+                location = globals()[f'temp{key[-1]}_location']
+
+            addmetric(metric='temp', label=[label, temperature_unit, location], value=value)
+
+        # Pressure, default inches Hg
+        elif key.startswith('barom'):
+            if pressure_unit == 'hpa':
+                value = inhg2hpa(value)
+            elif pressure_unit == 'mmhg':
+                value = inhg2mmhg(value)
+            # Remove 'in' suffix
+            key = key[:-2]
+
+            if key == 'baromrel':
+                label = 'relative'
+            elif key == 'baromabs':
+                label = 'absolute'
+            addmetric(metric='barom', label=[label, pressure_unit], value=value)
+
+        # VPD, default inches Hg
+        elif key in ['vpd']:
+            if pressure_unit == 'hpa':
+                value = inhg2hpa(value)
+            elif pressure_unit == 'mmhg':
+                value = inhg2mmhg(value)
+
+            addmetric(metric='vpd', label=[pressure_unit], value=value)
+
+        # Wind speed, default mph
+        elif key in ['windspeedmph', 'windgustmph', 'maxdailygust']:
+            if wind_unit == 'kmh':
+                value = mph2kmh(value)
+            elif wind_unit == 'ms':
+                value = mph2ms(value)
+            elif wind_unit == 'knots':
+                value = mph2kts(value)
+            elif wind_unit == 'fps':
+                value = mph2fps(value)
+
+            if key == 'windspeedmph':
+                beaufort = mph2beaufort(value)
+                addmetric(metric='wind_beaufort', value=beaufort)
+
+            if key != 'maxdailygust':
+                key = key[:-3]
+            addmetric(metric='wind', label=[key, wind_unit], value=value)
+        
+        # Support for WS90 with a haptic rain sensor (rain state)
+        elif key == 'srain_piezo':
+            # Rain state: 0 = no rain, 1 = rain
+            addmetric(metric='rain_state', label=[key], value=value)
+
+        # Support for WS90 with a haptic rain sensor (cumulative rain amounts)
+        elif key.endswith('piezo'):
+            if rain_unit == 'mm':
+                value = in2mm(value)
+            mkey = rainmaps[key]
+            addmetric(metric='rain', label=[key, rain_unit], value=value)
+
+        # Rainfall, default inches
+        elif 'rain' in key:
+        # 'rainratein', 'eventrainin', 'hourlyrainin', 'dailyrainin', 'weeklyrainin', 'monthlyrainin', 'yearlyrainin', 'totalrainin'
+            if rain_unit == 'mm':
+                value = in2mm(value)
+            key = key[:-2]
+            key = key.replace('rain', '')
+            addmetric(metric='rain', label=[key, rain_unit], value=value)
+
+        # Lightning distance, default kilometers
+        elif key in ['lightning']:
+            if distance_unit == 'km':
+                addmetric(metric='lightning', label=[distance_unit], value=value)
+            elif distance_unit == 'mi':
+                value = km2mi(value)
+                addmetric(metric='lightning', label=[distance_unit], value=value)
+
+
+def compiled(data, addmetric, metrics, plan):
+    '''The logecowitt() key loop using a compiled IngestPlan'''
+    for metric, label, value in plan.evaluate(data, time.time()):
+        if value is INFO:
+            metrics[metric].info({metric: label[-1]})
+        else:
+            addmetric(metric, value, label)
+
+
+class NullInfo:
+    def info(self, value):
+        return value
+
+
+def null_addmetric(metric, value, label=()):
+    return metric, value, label
+
+
+def gauge_metrics(registry):
+    '''Same metric families as the exporter, in a private registry'''
+    labelled = {
+        'temp': ['sensor', 'unit', 'location'],
+        'humidity': ['sensor', 'unit', 'location'],
+        'pm25': ['series', 'sensor', 'unit'],
+        'aqi': ['standard', 'sensor'],
+        'pm10': ['series', 'sensor', 'unit'],
+        'co2': ['series', 'unit'],
+        'batterystatus': ['sensor'],
+        'batterylevel': ['sensor'],
+        'batteryvoltage': ['sensor', 'unit'],
+        'solarradiation': ['unit'],
+        'barom': ['sensor', 'unit'],
+        'vpd': ['unit'],
+        'wind': ['sensor', 'unit'],
+        'rain': ['sensor', 'unit'],
+        'rain_state': ['sensor'],
+        'lightning': ['unit'],
+        'ws90': ['sensor', 'unit'],
+        'soilmoisture': ['sensor', 'unit'],
+        'sensor_last_report_timestamp': ['sensor'],
+    }
+    metrics = {}
+    for name in ['stationtype', 'freq', 'model']:
+        metrics[name] = Info(name=f'bench_{name}', documentation=name, registry=registry)
+    for name in ['winddir', 'uv', 'wind_beaufort', 'lightning_num', 'lightning_time']:
+        metrics[name] = Gauge(name=f'bench_{name}', documentation=name, registry=registry)
+    for name, labelnames in labelled.items():
+        metrics[name] = Gauge(name=f'bench_{name}', documentation=name, labelnames=labelnames, registry=registry)
+    return metrics
+
+
+def gauge_addmetric(metrics):
+    def addmetric(metric, value, label=()):
+        if label:
+            return metrics[metric].labels(*label).set(value)
+        return metrics[metric].set(value)
+    return addmetric
+
+
+def run(name, func, payloads, iterations):
+    def loop():
+        for payload in payloads:
+            func(payload)
+    seconds = min(timeit.repeat(loop, number=iterations, repeat=5))
+    per_payload = seconds / (iterations * len(payloads)) * 1e6
+    print(f'  {name:<10} {per_payload:8.2f} µs/payload')
+    return per_payload
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    payloads = drifted_payloads(50)
+    plan = IngestPlan()
+    null_metrics = {'stationtype': NullInfo(), 'freq': NullInfo(), 'model': NullInfo()}
+
+    print(f'{len(payloads)} payloads of {len(payloads[0])} keys, {iterations} iterations')
+    print('Dispatch and conversion only:')
+    old = run('legacy', lambda p: legacy(p, null_addmetric, null_metrics), payloads, iterations)
+    new = run('compiled', lambda p: compiled(p, null_addmetric, null_metrics, plan), payloads, iterations)
+    print(f'  speedup    {old / new:8.2f}x')
+
+    print('Writing to prometheus_client Gauges:')
+    metrics = gauge_metrics(CollectorRegistry())
+    addmetric = gauge_addmetric(metrics)
+    old = run('legacy', lambda p: legacy(p, addmetric, metrics), payloads, iterations)
+    new = run('compiled', lambda p: compiled(p, addmetric, metrics, plan), payloads, iterations)
+    print(f'  speedup    {old / new:8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Overhead of INSTRUMENT=yes on /report, calling the WSGI app in-process.
+
+    python benchmarks/bench_instrument.py [seconds]
+
+"off" is the exporter as shipped by default. "on" records the report
+histograms, per-category handler timings and unknown keys on every request.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from ecowitt_exporter import Exporter, create_app
+from payloads import raw_payload
+from bench_report import requests_per_second
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    body = raw_payload()
+    apps = {}
+    for instrument in ('no', 'yes'):
+        exporter = Exporter(Config({'INSTRUMENT': instrument}))
+        exporter.setup_metrics()
+        apps[instrument] = create_app(exporter).wsgi_app
+
+    # Alternate between the two and keep the best of each, so a noisy
+    # neighbour does not land on one side only
+    off = on = 0
+    for _ in range(3):
+        off = max(off, requests_per_second(apps['no'], body, seconds / 3))
+        on = max(on, requests_per_second(apps['yes'], body, seconds / 3))
+    print(f'/report with a {len(body)} byte payload, {seconds:g}s each')
+    print(f'  off      {off:10.0f} req/s  {1e6 / off:8.1f} us/req')
+    print(f'  on       {on:10.0f} req/s  {1e6 / on:8.1f} us/req')
+    print(f'  overhead {1e6 / on - 1e6 / off:10.1f} us/req ({off / on - 1:.1%})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+'''
+Cost of a /metrics scrape: prometheus_client Gauges served by make_wsgi_app
+against the cached Snapshot exposition.
+
+    python benchmarks/bench_metrics.py [scrapes]
+
+"idle" scrapes follow each other with no report in between, which is the
+common case with several Prometheus replicas or a short scrape interval.
+"changed" scrapes each follow a report, so the cache is always stale.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order,dangerous-default-value
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import CollectorRegistry, make_wsgi_app
+from bench_ingest import gauge_metrics, gauge_addmetric
+from ingest import IngestPlan, INFO
+from snapshot import Snapshot, make_snapshot_app
+from payloads import drifted_payloads
+
+
+def snapshot_metrics(metrics):
+    '''A Snapshot with the same families as the Gauges from gauge_metrics()'''
+    snapshot = Snapshot()
+    for key, metric in metrics.items():
+        name = metric._name
+        if key in ('stationtype', 'freq', 'model'):
+            snapshot.add_info(key, name=name, documentation=metric._documentation)
+        else:
+            snapshot.add_gauge(key, name=name, documentation=metric._documentation, labelnames=metric._labelnames)
+    return snapshot
+
+
+def scrape(wsgi_app, headers):
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/metrics', 'QUERY_STRING': ''}
+    environ.update(headers)
+    return b''.join(wsgi_app(environ, lambda status, headers: None))
+
+
+def main():
+    scrapes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    payloads = drifted_payloads(20)
+    plan = IngestPlan()
+    empty = CollectorRegistry()
+
+    registry = CollectorRegistry()
+    gauges = gauge_metrics(registry)
+    addmetric = gauge_addmetric(gauges)
+    gauge_app = make_wsgi_app(registry)
+
+    snapshot = snapshot_metrics(gauges)
+    snapshot_app = make_snapshot_app(snapshot, registry=empty)
+
+    def report_gauges(payload):
+        for metric, label, value in plan.evaluate(payload, time.time()):
+            if value is INFO:
+                gauges[metric].info({metric: label[-1]})
+            else:
+                addmetric(metric, value, label)
+
+    def report_snapshot(payload):
+        now = time.time()
+        snapshot.apply(plan.evaluate(payload, now), now)
+
+    report_gauges(payloads[0])
+    report_snapshot(payloads[0])
+    size = len(scrape(snapshot_app, {}))
+    print(f'{scrapes} scrapes of {size} bytes')
+
+    variants = [
+        ('text', {}),
+        ('text+gzip', {'HTTP_ACCEPT_ENCODING': 'gzip'}),
+        ('openmetrics', {'HTTP_ACCEPT': 'application/openmetrics-text'}),
+    ]
+    for name, headers in variants:
+        for label, app, report in [('gauges', gauge_app, report_gauges), ('snapshot', snapshot_app, report_snapshot)]:
+            idle = min(timeit.repeat(lambda app=app, headers=headers: scrape(app, headers), number=scrapes, repeat=3))
+
+            def changed(app=app, report=report, headers=headers):
+                for payload in payloads:
+                    report(payload)
+                    scrape(app, headers)
+            changed_seconds = min(timeit.repeat(changed, number=max(1, scrapes // len(payloads)), repeat=3))
+            changed_count = max(1, scrapes // len(payloads)) * len(payloads)
+            print(f'  {name:<12} {label:<9} idle {idle / scrapes * 1e6:9.1f} µs/scrape   '
+                  f'changed {changed_seconds / changed_count * 1e6:9.1f} µs/report+scrape')
+
+
+if __name__ == '__main__':
+    main()
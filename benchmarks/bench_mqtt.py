@@ -0,0 +1,157 @@
+'''
+Reports taken from MQTT against reports posted to /report, with a
+stand-in broker (fake_broker.py).
+
+    python benchmarks/bench_mqtt.py [stations] [rounds]
+
+First checks that a report published on ecowitt/<station> sets the same
+metrics as the same report posted to /report, and that retained messages
+are skipped. Then publishes `rounds` (default 20) reports from each of
+`stations` (default 200) stations of loadgen.py's fleet, a round at a
+time, as fast as they are consumed, and times how long the exporter takes
+to consume them all and in how many batches. The same reports are also
+posted to /report in-process, one request each, for comparison. Finally
+it cuts the connection half way through a round and checks that no
+QoS 1 report is lost.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_broker
+from config import Config
+from ecowitt_exporter import Exporter, create_app
+from loadgen import Fleet, InProcess
+from payloads import raw_payload
+
+
+def exporter(broker: fake_broker.Broker, client_id: str) -> Exporter:
+    '''An exporter taking QoS 1 reports on ecowitt/+ from `broker`, counting its ingests'''
+    instance = Exporter(Config({'MQTT_URL': broker.url, 'MQTT_QOS': '1', 'MQTT_CLIENT_ID': client_id, 'MAX_STATIONS': '0'}))
+    instance.setup_metrics()
+    subscriber = instance.subscriber
+    subscriber.ingests = 0
+    ingest = subscriber.ingest
+
+    def counted(station, data, now):
+        subscriber.ingests += 1
+        ingest(station, data, now)
+
+    subscriber.ingest = counted
+    subscriber.start()
+    wait(lambda: subscriber.connects)
+    return instance
+
+
+def wait(condition, timeout: float = 60) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def compare(broker: fake_broker.Broker):
+    '''Send the sample report over MQTT and /report, as two stations, and compare their metrics'''
+    broker.publish('ecowitt/old', raw_payload(), qos=1, retain=True)
+    instance = exporter(broker, 'compare')
+    InProcess(create_app(instance)).post('/report/http', raw_payload())
+    broker.publish('ecowitt/mqtt', raw_payload(), qos=1)
+    wait(lambda: instance.subscriber.messages)
+    same = differ = 0
+    for family in instance.metrics.families.values():
+        if 'timestamp' in family.name or family.kind == 'counter':
+            continue
+        for key, sample in family.samples.items():
+            if key[:1] != ('http',):
+                continue
+            other = family.samples.get(('mqtt',) + key[1:])
+            if other is not None and other.value == sample.value:
+                same += 1
+            else:
+                differ += 1
+                print(f'  {family.name}{key[1:]}: /report {sample.value}, MQTT {other and other.value}')
+    retained = 'old' in instance.stations.names()
+    print(f'{same} series the same over /report and MQTT, {differ} different, '
+          f'retained report {"INGESTED" if retained else "skipped"}')
+    instance.subscriber.stop()
+
+
+def consume(broker: fake_broker.Broker, fleet: Fleet, rounds: int) -> tuple:
+    '''
+    Publish the reports a round at a time, one from each station as they
+    would come in over a minute, and time how long until they are all consumed
+    '''
+    instance = exporter(broker, 'consume')
+    subscriber = instance.subscriber
+    stations = len(fleet.names)
+    start = time.perf_counter()
+    for index in range(stations * rounds):
+        path, body = fleet.request(index)
+        broker.publish('ecowitt/' + path.rsplit('/', 1)[1], body, qos=1)
+        if index % stations == stations - 1:
+            wait(lambda index=index: subscriber.messages > index)
+    seconds = time.perf_counter() - start
+    subscriber.stop()
+    return seconds, subscriber.batches, subscriber.ingests
+
+
+def posted(fleet: Fleet, rounds: int) -> float:
+    '''Seconds to post every round of reports to /report in-process'''
+    instance = Exporter(Config({'MAX_STATIONS': '0'}))
+    instance.setup_metrics()
+    target = InProcess(create_app(instance))
+    start = time.perf_counter()
+    for index in range(len(fleet.names) * rounds):
+        target.post(*fleet.request(index))
+    return time.perf_counter() - start
+
+
+def outage(broker: fake_broker.Broker, fleet: Fleet) -> tuple:
+    '''
+    Publish a round with the connection cut half way, returning how many
+    reports were published and consumed, counting those sent again, and how
+    many stations reported
+    '''
+    instance = exporter(broker, 'outage')
+    subscriber = instance.subscriber
+    count = len(fleet.names)
+    for index in range(count):
+        if index == count // 2:
+            broker.drop()
+        path, body = fleet.request(index)
+        broker.publish('ecowitt/' + path.rsplit('/', 1)[1], body, qos=1)
+
+    def reported() -> int:
+        return sum(1 for name in fleet.names if instance.metrics.has('last_report_timestamp', (name,)))
+
+    wait(lambda: reported() == count, timeout=10)
+    subscriber.stop()
+    return count, subscriber.messages, reported(), subscriber.connects
+
+
+def main():
+    stations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    broker = fake_broker.start()
+    compare(broker)
+
+    fleet = Fleet(stations, 8)
+    count = stations * rounds
+    seconds, batches, ingests = consume(broker, fleet, rounds)
+    http = posted(fleet, rounds)
+    print(f'{count} reports from {stations} stations, {rounds} rounds of one from each')
+    print(f'  MQTT     {count / seconds:10.0f} reports/s, {batches} batches of {count / batches:.1f}, {ingests} ingested')
+    print(f'  /report  {count / http:10.0f} reports/s, one request each, in-process')
+
+    published, consumed, reported, connects = outage(broker, fleet)
+    print(f'Connection cut half way through {published} QoS 1 reports: {reported} of {stations} stations reported '
+          f'after {connects - 1} reconnect(s), {consumed - published} reports sent again')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Polling a fleet of fake gateways, see fake_gateway.py.
+
+    python benchmarks/bench_poll.py [gateways] [interval] [seconds] [threads]
+
+First checks that polling the sample readings sets the same metrics as
+pushing them, then polls `gateways` fake gateways (default 50) every
+`interval` seconds (default 0.5) for `seconds` (default 5) with `threads`
+polling threads (default 8), and reports the poll rate it kept up.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from ecowitt_exporter import Exporter
+from ingest import parse_body
+from poller import Poller, livedata_payload
+from fake_gateway import livedata, start_fleet
+from payloads import raw_payload, sample_payload
+
+
+def compare(exporter: Exporter):
+    '''Push the sample payload and its livedata equivalent as two stations and compare'''
+    now = time.time()
+    exporter.ingest(exporter.stations.get('push'), parse_body(raw_payload()), now)
+    exporter.ingest(exporter.stations.get('poll'), livedata_payload(livedata(sample_payload())), now)
+    same = differ = 0
+    for family in exporter.metrics.families.values():
+        if family.kind != 'gauge' or 'timestamp' in family.name:
+            continue
+        for key, sample in family.samples.items():
+            if key[:1] != ('push',):
+                continue
+            polled = family.samples.get(('poll',) + key[1:])
+            if polled is None:
+                continue
+            if abs(polled.value - sample.value) <= max(0.15, abs(sample.value) * 0.005):
+                same += 1
+            else:
+                differ += 1
+                print(f'  {family.name}{key[1:]}: pushed {sample.value}, polled {polled.value}')
+    print(f'{same} series the same pushed and polled (within display rounding), {differ} different')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    exporter = Exporter(Config())
+    exporter.setup_metrics()
+    compare(exporter)
+
+    servers = start_fleet(count)
+    gateways = [(f'gw{n}', '127.0.0.1', server.server_address[1]) for n, server in enumerate(servers)]
+    poller = Poller(gateways, exporter.ingest, exporter.stations,
+                    interval=interval, timeout=2, concurrency=threads)
+    poller.start()
+    time.sleep(seconds)
+    polling = sum(1 for thread in threading.enumerate() if thread.name.startswith('poll'))
+    poller.stop()
+    print(f'{count} gateways every {interval:g}s with {threads} threads for {seconds:g}s')
+    print(f'  polls    {poller.polls:10d}  ({poller.polls / seconds:.0f}/s, {count / interval:.0f}/s scheduled)')
+    print(f'  errors   {poller.errors:10d}')
+    print(f'  threads  {polling:10d}  (scheduler and pool)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Replays the same readings as Ecowitt POSTs to /report and as Weather
+Underground GETs to /weatherstation/updateweatherstation.php, calling the
+WSGI app in-process, and compares requests/sec.
+
+    python benchmarks/bench_protocols.py [seconds] [payloads]
+
+First checks that both protocols set the same metrics for the same readings.
+The `payloads` (default 100) drifted variations of the sample payload are
+replayed round-robin for `seconds` (default 3) per protocol.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import io
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ecowitt_exporter
+from wunderground import KEYS, UPLOAD_PATH
+from bench_report import environ
+from payloads import drifted_payloads
+
+# Ecowitt keys and the WU fields a gateway would send them as
+WU_FIELDS = {ecowitt: wu for wu, ecowitt in KEYS.items() if ecowitt}
+
+
+def wunderground_query(payload: dict) -> bytes:
+    '''The readings of an Ecowitt payload as a WU upload's query string'''
+    fields = {'ID': 'KXYZ1', 'PASSWORD': 'secret', 'action': 'updateraw'}
+    fields.update((WU_FIELDS.get(key, key), value) for key, value in payload.items() if key != 'PASSKEY')
+    return urlencode(fields).encode()
+
+
+def requests(payloads: list, wunderground: bool) -> list:
+    '''WSGI environs replaying `payloads` in either protocol'''
+    environs = []
+    for payload in payloads:
+        if wunderground:
+            env = environ(b'')
+            env.update(REQUEST_METHOD='GET', PATH_INFO=UPLOAD_PATH, CONTENT_LENGTH='0',
+                       QUERY_STRING=wunderground_query(payload).decode())
+            env.pop('CONTENT_TYPE')
+            environs.append((env, b''))
+        else:
+            body = urlencode(payload).encode()
+            environs.append((environ(body), body))
+    return environs
+
+
+def start_response(status, headers):
+    assert status.startswith('200'), status
+    return headers
+
+
+def replay(app, environs: list):
+    for base, body in environs:
+        env = dict(base)
+        env['wsgi.input'] = io.BytesIO(body)
+        for _chunk in app.wsgi_app(env, start_response):
+            pass
+
+
+def requests_per_second(app, environs: list, seconds: float) -> float:
+    count = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        replay(app, environs)
+        count += len(environs)
+    return count / (time.perf_counter() - start)
+
+
+def compare(app, payload: dict):
+    '''Send one payload in both protocols, as two stations, and compare their metrics'''
+    exporter = app.extensions['ecowitt']
+    exporter.stations.passkeys.update({payload['PASSKEY']: 'ecowitt', 'KXYZ1': 'wu'})
+    replay(app, requests([payload], False) + requests([payload], True))
+    same = differ = 0
+    for family in exporter.metrics.families.values():
+        if 'timestamp' in family.name:
+            continue
+        for key, sample in family.samples.items():
+            if key[:1] != ('ecowitt',):
+                continue
+            other = family.samples.get(('wu',) + key[1:])
+            if other is not None and other.value == sample.value:
+                same += 1
+            else:
+                differ += 1
+                print(f'  {family.name}{key[1:]}: POST {sample.value}, GET {other and other.value}')
+    print(f'{same} series the same over both protocols, {differ} different')
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    app = ecowitt_exporter.create_app()
+    payloads = drifted_payloads(count)
+    compare(app, payloads[0])
+
+    ecowitt_post = requests_per_second(app, requests(payloads, False), seconds)
+    wunderground_get = requests_per_second(app, requests(payloads, True), seconds)
+    print(f'{count} payloads replayed for {seconds:g}s each')
+    print(f'  ecowitt POST  {ecowitt_post:10.0f} req/s')
+    print(f'  wu GET        {wunderground_get:10.0f} req/s')
+    print(f'  ratio         {wunderground_get / ecowitt_post:10.2f}x')
+
+
+if __name__ == '__main__':
+    main()
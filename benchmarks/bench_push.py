@@ -0,0 +1,109 @@
+'''
+Pushing to a Pushgateway with PUSH_URL, against the stand-in in
+fake_pushgateway.py.
+
+    python benchmarks/bench_push.py [seconds]
+
+First checks that what the stand-in receives matches /metrics, then that
+pushes made while it is down are queued and delivered once it is back.
+Finally times /report for `seconds` (default 3) with the stand-in answering
+at once and then taking a second over every push, which should make no
+difference since /report never waits for a push.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import glob
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_pushgateway
+
+pushgateway = fake_pushgateway.start()
+queue_dir = tempfile.mkdtemp(prefix='ecowitt-push-')
+os.environ.update(PUSH_URL=pushgateway.url, PUSH_INTERVAL='0.2', PUSH_QUEUE_DIR=queue_dir, PUSH_TIMEOUT='5')
+
+import ecowitt_exporter
+from bench_report import requests_per_second
+from payloads import drifted_payloads
+from urllib.parse import urlencode
+
+
+def report(app, payload: dict):
+    client = app.test_client()
+    client.post('/report', data=urlencode(payload), content_type='application/x-www-form-urlencoded')
+
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def compare(exporter: ecowitt_exporter.Exporter) -> tuple:
+    '''Numbers of series set in the exporter that the stand-in has the same and a different value for'''
+    pushed = pushgateway.samples()
+    same = differ = 0
+    for family in exporter.metrics.families.values():
+        if family.kind == 'counter':
+            continue
+        for sample in family.samples.values():
+            labels = dict(zip(family.labelnames, sample.labels))
+            station = labels.pop('station')
+            name = family.name + '_info' if family.kind == 'info' else family.name
+            key = (f'/metrics/job/ecowitt/station/{station}', name, tuple(sorted(labels.items())))
+            if key not in pushed:
+                continue
+            if pushed[key] == (1.0 if family.kind == 'info' else sample.value):
+                same += 1
+            else:
+                differ += 1
+    return same, differ
+
+
+def queued() -> int:
+    return len(glob.glob(os.path.join(queue_dir, '*.push')))
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    app = ecowitt_exporter.create_app()
+    exporter = app.extensions['ecowitt']
+    forwarder = exporter.forwarder
+    payloads = drifted_payloads(20)
+
+    for payload in payloads[:5]:
+        report(app, payload)
+    wait_for(lambda: forwarder.sent and not forwarder.waiting)
+    same, differ = compare(exporter)
+    print(f'Pushed: {same} series the same as /metrics, {differ} different, {pushgateway.pushes} pushes')
+
+    pushgateway.down = True
+    for payload in payloads[5:10]:
+        report(app, payload)
+        time.sleep(0.3)
+    print(f'While down: {queued()} pushes queued, {forwarder.failed} failed attempts')
+    pushgateway.down = False
+    delivered = wait_for(lambda: not queued() and not forwarder.waiting)
+    wait_for(lambda: compare(exporter)[1] == 0, 2)
+    same, differ = compare(exporter)
+    print(f'Back up: queue {"emptied" if delivered else "NOT emptied"}, '
+          f'{same} series the same as /metrics, {differ} different')
+
+    body = urlencode(payloads[0]).encode()
+    fast = requests_per_second(app.wsgi_app, body, seconds)
+    pushgateway.delay = 1.0
+    slow = requests_per_second(app.wsgi_app, body, seconds)
+    pushgateway.delay = 0.0
+    print(f'/report for {seconds:g}s each, pushing every 0.2s')
+    print(f'  immediate   {fast:10.0f} req/s')
+    print(f'  1s answers  {slow:10.0f} req/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+'''
+Requests/sec on /report, calling the WSGI app in-process so the numbers
+are not swamped by socket overhead.
+
+    python benchmarks/bench_report.py [seconds]
+
+"form" is the way /report used to read its body, through request.form and a
+before_request hook that always read the body and formatted the headers.
+"raw" is the current exporter app, which parses the raw body once.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, request
+import ecowitt_exporter
+from payloads import raw_payload
+
+
+def form_app(exporter: ecowitt_exporter.Exporter):
+    '''The exporter's /report as it was, reading request.form'''
+    legacy = Flask('legacy')
+
+    @legacy.before_request
+    def log_request_info():
+        legacy.logger.debug('Headers: %s', request.headers)
+        legacy.logger.debug('Body: %s', request.get_data())
+
+    @legacy.route('/report', methods=['POST'])
+    def logecowitt():
+        data = request.form
+        now = time.time()
+        for key, value in data.items():
+            legacy.logger.debug("Received raw value %s: %s", key, value)
+        station = exporter.stations.identify(data)
+        writes = station.plan.evaluate(data, now)
+        writes.append(('last_report_timestamp', (station.name,), now))
+        with station.lock:
+            exporter.metrics.apply(writes, now)
+        return legacy.response_class(response='OK', status=200, mimetype='application/json')
+
+    return legacy
+
+
+def environ(body: bytes) -> dict:
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/report',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '8088',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_HOST': 'localhost:8088',
+        'HTTP_USER_AGENT': 'ESP8266',
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.version': (1, 0),
+    }
+
+
+def requests_per_second(wsgi_app, body: bytes, seconds: float) -> float:
+    base = environ(body)
+
+    def start_response(status, headers):
+        assert status.startswith('200'), status
+        return headers
+
+    count = 0
+    deadline = time.perf_counter() + seconds
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for _ in range(100):
+            env = dict(base)
+            env['wsgi.input'] = io.BytesIO(body)
+            for _chunk in wsgi_app(env, start_response):
+                pass
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3
+    app = ecowitt_exporter.create_app()
+    body = raw_payload()
+
+    before = requests_per_second(form_app(app.extensions['ecowitt']).wsgi_app, body, seconds)
+    after = requests_per_second(app.wsgi_app, body, seconds)
+    print(f'/report with a {len(body)} byte payload, {seconds:g}s each')
+    print(f'  form     {before:10.0f} req/s')
+    print(f'  raw      {after:10.0f} req/s')
+    print(f'  speedup  {after / before:10.2f}x')
+
+
+if __name__ == '__main__':
+    main()
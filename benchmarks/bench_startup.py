@@ -0,0 +1,87 @@
+'''
+Cold start time, for running the exporter where it is scaled to zero and
+started by the first request.
+
+    python benchmarks/bench_startup.py [runs]
+
+Times fresh Python processes, taking the median of `runs` (default 5):
+the interpreter alone, importing ecowitt_exporter, creating the app with
+the default settings and with every optional feature turned on, and
+starting `python ecowitt_exporter.py` until its first /metrics answer on
+port 8088. Also shows whether importing the module loads Flask.
+'''
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Everything that imports a module of its own
+ALL_FEATURES = {
+    'DERIVED_METRICS': 'yes',
+    'AGGREGATE_WINDOWS': '10m,1h',
+    'INSTRUMENT': 'yes',
+    'SERIES_TTL': '86400',
+    'DISCOVER_KEYS': '*',
+    'INGEST_MODE': 'async',
+    'PUSH_URL': 'http://127.0.0.1:9',
+    'MQTT_URL': 'mqtt://127.0.0.1:9',
+}
+
+STAGES = [
+    ('interpreter', 'pass', {}),
+    ('import', 'import ecowitt_exporter', {}),
+    ('create_app', 'import ecowitt_exporter; ecowitt_exporter.create_app()', {}),
+    ('all features', 'import ecowitt_exporter; ecowitt_exporter.create_app()', ALL_FEATURES),
+]
+
+
+def run(code: str, env: dict) -> float:
+    '''Seconds for a fresh interpreter to run `code`'''
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, env={**os.environ, **env}, check=True)
+    return time.perf_counter() - start
+
+
+def first_scrape(timeout: float = 10) -> float:
+    '''Seconds from starting the exporter to its first /metrics answer'''
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'ecowitt_exporter.py'], cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            connection = http.client.HTTPConnection('127.0.0.1', 8088, timeout=1)
+            try:
+                connection.request('GET', '/metrics')
+                if connection.getresponse().status == 200:
+                    return time.perf_counter() - start
+            except OSError:
+                time.sleep(0.005)
+            finally:
+                connection.close()
+        raise TimeoutError('exporter did not answer on port 8088')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, ecowitt_exporter; print("flask" in sys.modules)'],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    print(f'Median of {runs} fresh processes, Flask loaded by import: {loaded}')
+    for label, code, env in STAGES:
+        seconds = statistics.median(run(code, env) for _ in range(runs))
+        print(f'  {label:14s} {seconds * 1000:8.1f} ms')
+    try:
+        seconds = statistics.median(first_scrape() for _ in range(runs))
+        print(f'  {"first scrape":14s} {seconds * 1000:8.1f} ms')
+    except TimeoutError as error:
+        print(f'  first scrape   {error}')
+
+
+if __name__ == '__main__':
+    main()
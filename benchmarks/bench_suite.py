@@ -0,0 +1,175 @@
+'''
+Benchmarks of /report and /metrics under fleet load, checked against
+stored baselines to catch performance regressions.
+
+    python benchmarks/bench_suite.py [--save] [--tolerance T] [--baselines FILE]
+
+Runs fixed scenarios with loadgen.py against exporters with the default
+settings, whatever the environment says, with stations that each have 8
+extra channels:
+
+    report   in-process, 10 stations, one report at a time for 2s: /report
+             latency at p50 and p99, and throughput
+    socket   over HTTP on a local port, 10 stations at 100 reports/s for
+             2s: /report latency at p50 and p99
+    scrape   a /metrics scrape that renders the snapshot again, with 1, 10
+             and 100 stations, and how many series each has
+    rss      in-process, 100 stations: RSS growth over 20000 reports, after
+             5000 to settle
+
+Timed scenarios run three times and keep the best of each figure, as
+noise from the rest of the machine only ever makes them worse.
+
+Compares each result with the baselines in baselines.json next to this
+file, and exits with status 1 if any is worse by more than `tolerance`
+(default 0.25, i.e. 25%) and by more than the noise allowed for it. --save
+stores the results as the new baselines instead. Timings depend on the
+machine, so no baselines come with the repository: save them from the
+revision to compare against, on the machine the suite is checked on, and
+every comparison is relative to that machine's own figures.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import argparse
+import json
+import os
+import platform
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from ecowitt_exporter import Exporter, create_app
+from loadgen import Fleet, InProcess, OverHttp, rss, run, scrape, serve, warm
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+CHANNELS = 8
+
+# Each checked result, as whether higher is better and the difference that
+# counts as noise however large the tolerance says it can be
+CHECKS = {
+    'report_p50_ms': (False, 0.05),
+    'report_p99_ms': (False, 0.5),
+    'report_throughput': (True, 0),
+    'socket_p50_ms': (False, 0.2),
+    'socket_p99_ms': (False, 1.0),
+    'scrape_1_ms': (False, 0.2),
+    'scrape_10_ms': (False, 0.5),
+    'scrape_100_ms': (False, 2.0),
+    'rss_growth_mb': (False, 2.0),
+}
+
+
+def app():
+    '''A fresh app with the default settings'''
+    exporter = Exporter(Config({}))
+    exporter.setup_metrics()
+    return create_app(exporter)
+
+
+def best(results: list) -> dict:
+    '''The best latencies and throughput of repeated runs'''
+    return {
+        'p50_ms': min(result['p50_ms'] for result in results),
+        'p99_ms': min(result['p99_ms'] for result in results),
+        'throughput': max(result['throughput'] for result in results),
+    }
+
+
+def report() -> dict:
+    target = InProcess(app())
+    fleet = Fleet(10, CHANNELS)
+    warm(target, fleet)
+    result = best([run(target, fleet, 2, connections=1) for _ in range(3)])
+    return {'report_p50_ms': result['p50_ms'], 'report_p99_ms': result['p99_ms'],
+            'report_throughput': result['throughput']}
+
+
+def socket() -> dict:
+    server, port = serve(app())
+    try:
+        target = OverHttp('127.0.0.1', port)
+        fleet = Fleet(10, CHANNELS)
+        warm(target, fleet)
+        result = best([run(target, fleet, 2, rate=100) for _ in range(3)])
+    finally:
+        server.shutdown()
+    return {'socket_p50_ms': result['p50_ms'], 'socket_p99_ms': result['p99_ms']}
+
+
+def scrapes() -> dict:
+    results = {}
+    for stations in (1, 10, 100):
+        target = InProcess(app())
+        fleet = Fleet(stations, CHANNELS)
+        warm(target, fleet)
+        seconds, series = scrape(target, fleet)
+        results[f'scrape_{stations}_ms'] = seconds * 1000
+        results[f'scrape_{stations}_series'] = series
+    return results
+
+
+def growth() -> dict:
+    target = InProcess(app())
+    fleet = Fleet(100, CHANNELS)
+    for index in range(5000):
+        target.post(*fleet.request(index))
+    before = rss()
+    for index in range(5000, 25000):
+        target.post(*fleet.request(index))
+    return {'rss_growth_mb': (rss() - before) / 2**20}
+
+
+def regressions(results: dict, baselines: dict, tolerance: float) -> list:
+    '''Descriptions of the results that are worse than their baselines'''
+    worse = []
+    for name, (higher, noise) in CHECKS.items():
+        if name not in results or name not in baselines:
+            continue
+        value, baseline = results[name], baselines[name]
+        change = baseline - value if higher else value - baseline
+        if change > max(abs(baseline) * tolerance, noise):
+            worse.append(f'{name} {value:.2f}, baseline {baseline:.2f}')
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the benchmark suite and check it against stored baselines')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baselines')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='fraction a result may be worse by (default: 0.25)')
+    parser.add_argument('--baselines', default=BASELINES, help='file of baselines (default: benchmarks/baselines.json)')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    print(f'Python {platform.python_version()} on {platform.machine()}, {os.cpu_count()} CPUs')
+    results = {}
+    for scenario in (report, socket, scrapes, growth):
+        results.update(scenario())
+    print(f'  {"":22s} {"result":>10s} {"baseline":>10s}')
+    for name, value in results.items():
+        baseline = baselines.get(name)
+        print(f'  {name:22s} {value:10.2f} {"" if baseline is None else f"{baseline:10.2f}"}')
+
+    if args.save:
+        with open(args.baselines, 'w', encoding='utf-8') as f:
+            json.dump({name: round(value, 3) for name, value in results.items()}, f, indent=2)
+            f.write('\n')
+        print(f'Saved as the baselines in {args.baselines}')
+        return
+    if not baselines:
+        print(f'No baselines in {args.baselines}, run with --save to store them')
+        return
+    worse = regressions(results, baselines, args.tolerance)
+    for line in worse:
+        print(f'REGRESSION {line}')
+    if worse:
+        sys.exit(1)
+    print(f'No regressions beyond {args.tolerance:.0%}')
+
+
+if __name__ == '__main__':
+    main()
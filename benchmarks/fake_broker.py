@@ -0,0 +1,207 @@
+'''
+Stand-in for an MQTT broker, for trying out and benchmarking MQTT_URL
+without a real one.
+
+    python benchmarks/fake_broker.py [port]
+
+Speaks enough MQTT 3.1.1 for the exporter and simple publishers (default
+port 1883): QoS 0 and 1, + and # wildcards, retained messages, and sessions
+kept across reconnects for clients that connect without a clean session,
+with their unacknowledged QoS 1 messages sent again. publish() sends a
+message from the broker itself, and drop() cuts every connection, to try
+out reconnecting.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mqtt import (CONNACK, CONNECT, DISCONNECT, PINGREQ, PINGRESP, PUBACK, PUBLISH, SUBACK, SUBSCRIBE,
+                  packet, read_publish, split_packets, string, topic_pattern)
+
+
+class Session:
+    '''A client's subscriptions and the QoS 1 messages it has not acknowledged'''
+
+    def __init__(self, client_id: str, clean: bool):
+        self.client_id = client_id
+        self.clean = clean
+        self.filters = {}
+        self.inflight = {}
+        self.next_id = 0
+        self.connection = None
+
+
+class Connection(socketserver.BaseRequestHandler):
+    '''One client connection'''
+
+    def setup(self):
+        self.session = None
+        self.buffer = bytearray()
+        self.send_lock = threading.Lock()
+
+    def handle(self):
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            self.buffer += chunk
+            for first, body in split_packets(self.buffer):
+                if not self.packet(first, body):
+                    return
+
+    def finish(self):
+        self.server.disconnected(self)
+
+    def send(self, data: bytes):
+        with self.send_lock:
+            try:
+                self.request.sendall(data)
+            except OSError:
+                pass
+
+    def packet(self, first: int, body: bytes) -> bool:
+        '''Act on one packet, returning False once the client disconnects'''
+        kind = first >> 4
+        if kind == CONNECT:
+            # Protocol name, level, flags and keepalive, then the client id
+            offset = 2 + int.from_bytes(body[:2], 'big')
+            flags = body[offset + 1]
+            offset += 4
+            length = int.from_bytes(body[offset:offset + 2], 'big')
+            client_id = body[offset + 2:offset + 2 + length].decode()
+            self.server.connected(self, client_id, clean=bool(flags & 0x02))
+        elif kind == SUBSCRIBE:
+            self.server.subscribe(self, body)
+        elif kind == PUBLISH:
+            topic, packet_id, payload = read_publish(first, body)
+            if packet_id is not None:
+                self.send(packet(PUBACK, packet_id))
+            self.server.publish(topic, payload, qos=min(first >> 1 & 3, 1), retain=bool(first & 1))
+        elif kind == PUBACK:
+            with self.server.lock:
+                self.session.inflight.pop(int.from_bytes(body[:2], 'big'), None)
+        elif kind == PINGREQ:
+            self.send(packet(PINGRESP))
+        elif kind == DISCONNECT:
+            return False
+        return True
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    '''The stand-in broker, with every session and retained message'''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(('127.0.0.1', port), Connection)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.retained = {}
+        self.published = 0
+        self.url = f'mqtt://127.0.0.1:{self.server_address[1]}'
+
+    def connected(self, connection: Connection, client_id: str, clean: bool):
+        '''Start or resume a session, then send what it has not acknowledged'''
+        with self.lock:
+            session = self.sessions.get(client_id)
+            present = session is not None and not clean
+            if not present:
+                session = self.sessions[client_id] = Session(client_id, clean)
+            session.clean = clean
+            session.connection = connection
+            connection.session = session
+            connection.send(packet(CONNACK, bytes([int(present), 0])))
+            for packet_id, (topic, payload) in session.inflight.items():
+                connection.send(packet(PUBLISH, string(topic) + packet_id.to_bytes(2, 'big') + payload, flags=0x0A))
+
+    def disconnected(self, connection: Connection):
+        with self.lock:
+            session = connection.session
+            if session is not None and session.connection is connection:
+                session.connection = None
+                if session.clean:
+                    del self.sessions[session.client_id]
+
+    def subscribe(self, connection: Connection, body: bytes):
+        '''Add a client's topic filters, then send it the retained messages they match'''
+        offset = 2
+        granted = bytearray()
+        with self.lock:
+            session = connection.session
+            added = []
+            while offset < len(body):
+                length = int.from_bytes(body[offset:offset + 2], 'big')
+                topic_filter = body[offset + 2:offset + 2 + length].decode()
+                qos = min(body[offset + 2 + length], 1)
+                offset += 3 + length
+                session.filters[topic_filter] = (topic_pattern(topic_filter), qos)
+                added.append((topic_pattern(topic_filter), qos))
+                granted.append(qos)
+            connection.send(packet(SUBACK, body[:2] + bytes(granted)))
+            for topic, (payload, retained_qos) in self.retained.items():
+                for pattern, qos in added:
+                    if pattern.match(topic):
+                        self.deliver(session, topic, payload, min(qos, retained_qos), retain=True)
+                        break
+
+    def publish(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        '''Send a message to every session subscribed to its topic'''
+        with self.lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = (payload, qos)
+            for session in self.sessions.values():
+                matched = [qos_limit for pattern, qos_limit in session.filters.values() if pattern.match(topic)]
+                if matched:
+                    self.deliver(session, topic, payload, min(qos, max(matched)))
+
+    def deliver(self, session: Session, topic: str, payload: bytes, qos: int, retain: bool = False):
+        '''Send one message to a session, keeping it until acknowledged at QoS 1'''
+        packet_id = b''
+        if qos:
+            session.next_id = session.next_id % 65535 + 1
+            session.inflight[session.next_id] = (topic, payload)
+            packet_id = session.next_id.to_bytes(2, 'big')
+        if session.connection:
+            session.connection.send(packet(PUBLISH, string(topic) + packet_id + payload,
+                                           flags=qos << 1 | int(retain)))
+
+    def drop(self):
+        '''Cut every client's connection, as a broker restart or network outage would'''
+        with self.lock:
+            for session in self.sessions.values():
+                if session.connection:
+                    try:
+                        session.connection.request.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+
+def start(port: int = 0) -> Broker:
+    '''Start a stand-in broker in a background thread'''
+    server = Broker(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1883
+    server = start(port)
+    print(f'Fake MQTT broker on {server.url}, Ctrl-C to stop')
+    print(f'MQTT_URL={server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
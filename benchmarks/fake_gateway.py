@@ -0,0 +1,125 @@
+'''
+Stand-in for Ecowitt gateways' local HTTP API, for trying out and
+benchmarking POLL_GATEWAYS without real hardware.
+
+    python benchmarks/fake_gateway.py [count] [first port]
+
+Serves /get_livedata_info on `count` consecutive ports (default 1 gateway
+on port 8089) with keep-alive connections. The readings are the sample
+payload in data.txt in metric units, as a gateway set to metric shows them,
+nudged a little on every request.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import json
+import os
+import random
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payloads import sample_payload
+
+
+def c(fahrenheit: str) -> str:
+    return f'{(float(fahrenheit) - 32) * 5/9:.1f}'
+
+def hpa(inhg: str) -> str:
+    return f'{float(inhg) * 33.8639:.1f} hPa'
+
+def ms(mph: str) -> str:
+    return f'{float(mph) / 2.237:.1f} m/s'
+
+def mm(inches: str, suffix: str = '') -> str:
+    return f'{float(inches) * 25.4:.1f} mm{suffix}'
+
+
+def livedata(payload: dict) -> dict:
+    '''A /get_livedata_info response with the readings of a pushed payload'''
+    return {
+        'common_list': [
+            {'id': '0x02', 'val': c(payload['tempf']), 'unit': 'C'},
+            {'id': '0x07', 'val': f'{payload["humidity"]}%'},
+            {'id': '0x03', 'val': c(payload['tempf']), 'unit': 'C'},
+            {'id': '0x0A', 'val': payload['winddir']},
+            {'id': '0x0B', 'val': ms(payload['windspeedmph'])},
+            {'id': '0x0C', 'val': ms(payload['windgustmph'])},
+            {'id': '0x19', 'val': ms(payload['maxdailygust'])},
+            {'id': '0x15', 'val': f'{payload["solarradiation"]} W/m2'},
+            {'id': '0x17', 'val': payload['uv']},
+            {'id': '5', 'val': f'{float(payload["vpd"]) * 3.38639:.3f} kPa'},
+        ],
+        'rain': [
+            {'id': '0x0D', 'val': mm(payload['eventrainin'])},
+            {'id': '0x0E', 'val': mm(payload['rainratein'], '/Hr')},
+            {'id': '0x10', 'val': mm(payload['dailyrainin'])},
+            {'id': '0x11', 'val': mm(payload['weeklyrainin'])},
+            {'id': '0x12', 'val': mm(payload['monthlyrainin'])},
+            {'id': '0x13', 'val': mm(payload['yearlyrainin'])},
+        ],
+        'wh25': [{
+            'intemp': c(payload['tempinf']), 'unit': 'C', 'inhumi': f'{payload["humidityin"]}%',
+            'abs': hpa(payload['baromabsin']), 'rel': hpa(payload['baromrelin']),
+        }],
+        'lightning': [{'distance': f'{payload["lightning"]} km', 'count': payload['lightning_num']}],
+        'ch_aisle': [
+            {'channel': str(n), 'name': '', 'battery': payload.get(f'batt{n}', '0'),
+             'temp': c(payload[f'temp{n}f']), 'unit': 'C', 'humidity': f'{payload[f"humidity{n}"]}%'}
+            for n in range(1, 9) if f'temp{n}f' in payload
+        ],
+        'ch_soil': [{'channel': '1', 'name': '', 'battery': '5', 'humidity': f'{payload["soilmoisture1"]}%'}],
+        'ch_pm25': [{'channel': '2', 'PM25': payload['pm25_ch2'], 'PM25_24H': payload['pm25_avg_24h_ch2']}],
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''Serves the sample readings with a bit of noise'''
+    protocol_version = 'HTTP/1.1'
+    payload = sample_payload()
+
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path != '/get_livedata_info':
+            self.send_error(404)
+            return
+        payload = dict(self.payload)
+        payload['tempf'] = f'{float(payload["tempf"]) + random.uniform(-0.5, 0.5):.2f}'
+        body = json.dumps(livedata(payload)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+
+def start_fleet(count: int, port: int = 0) -> list:
+    '''
+    Start `count` fake gateways in background threads, on consecutive ports
+    from `port` or on any free ports if it is 0. Returns their servers.
+    '''
+    servers = []
+    for index in range(count):
+        server = ThreadingHTTPServer(('127.0.0.1', port + index if port else 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8089
+    servers = start_fleet(count, port)
+    print(f'{count} fake gateway(s) on 127.0.0.1:{port}-{port + count - 1}, Ctrl-C to stop')
+    print('POLL_GATEWAYS=' + ','.join(f'gw{n}=127.0.0.1:{s.server_address[1]}' for n, s in enumerate(servers)))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
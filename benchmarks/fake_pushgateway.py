@@ -0,0 +1,117 @@
+'''
+Stand-in for a Prometheus Pushgateway, for trying out and benchmarking
+PUSH_URL without running one.
+
+    python benchmarks/fake_pushgateway.py [port]
+
+Accepts POST and PUT to /metrics/job/<job>/<label>/<value>..., plain or
+gzipped, parses the text exposition and keeps the latest samples of each
+group, as the Pushgateway does. It can be told to fail, to stand in for an
+outage, or to answer slowly. Serves the pushed samples on GET /metrics.
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import gzip
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prometheus_client.parser import text_string_to_metric_families
+
+
+class Pushgateway(ThreadingHTTPServer):
+    '''The pushed groups, and switches for outages and slow answers'''
+    daemon_threads = True
+
+    def __init__(self, port: int = 0):
+        super().__init__(('127.0.0.1', port), Handler)
+        # Group path to {(sample name, sorted labels): value}
+        self.groups = {}
+        self.pushes = 0
+        self.lock = threading.Lock()
+        self.down = False
+        self.delay = 0.0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def samples(self) -> dict:
+        '''Every pushed sample, keyed by (group, sample name, sorted labels)'''
+        with self.lock:
+            return {(group,) + key: value for group, samples in self.groups.items() for key, value in samples.items()}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: Pushgateway
+
+    def do_POST(self): # pylint: disable=invalid-name
+        self.push(replace=False)
+
+    def do_PUT(self): # pylint: disable=invalid-name
+        self.push(replace=True)
+
+    def push(self, replace: bool):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.down or not self.path.startswith('/metrics/job/'):
+            self.answer(503 if self.server.down else 404)
+            return
+        try:
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            families = list(text_string_to_metric_families(body.decode()))
+        except (OSError, ValueError) as error:
+            self.answer(400, str(error).encode())
+            return
+        with self.server.lock:
+            group = self.server.groups.setdefault(self.path, {})
+            # POST replaces the metrics of the same names, PUT the whole group
+            names = {family.name for family in families}
+            for key in list(group):
+                if replace or key[0] in names or key[0].rsplit('_', 1)[0] in names:
+                    del group[key]
+            for family in families:
+                for sample in family.samples:
+                    group[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+            self.server.pushes += 1
+        self.answer(200)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        lines = []
+        for (group, name, labels), value in sorted(self.server.samples().items()):
+            pairs = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{pairs}}} {value} # {group}\n')
+        self.answer(200, ''.join(lines).encode())
+
+    def answer(self, status: int, body: bytes = b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+
+def start(port: int = 0) -> Pushgateway:
+    '''Start a stand-in Pushgateway in a background thread'''
+    server = Pushgateway(port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9091
+    server = start(port)
+    print(f'Fake Pushgateway on {server.url}, Ctrl-C to stop')
+    print(f'PUSH_URL={server.url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
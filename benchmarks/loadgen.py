@@ -0,0 +1,273 @@
+'''
+Load generator for sizing the exporter for a fleet of gateways.
+
+    python benchmarks/loadgen.py [--stations N] [--channels M] [--rate R] [--seconds S]
+                                 [--connections C] [--socket | --url URL]
+
+Each of `stations` (default 10) gateways pushes the sample readings in
+data.txt with `channels` (default 8) extra soil probes to /report/<station>,
+its readings drifting from push to push as a real station's do. The fleet
+takes turns at `rate` reports a second in all (default 0, as fast as they
+are answered) for `seconds` (default 10), from `connections` (default 4)
+threads. Every station reports once before the clock starts.
+
+By default the app is created from the environment, as the exporter would
+be, with MAX_STATIONS raised to fit the fleet unless it is set, and called
+in-process, to measure the exporter and not the sockets.
+--socket serves it with werkzeug on a local port and sends over keep-alive
+HTTP connections; --url sends to an exporter that is already running.
+
+With a target rate every report is due at a set time, and its latency is
+counted from then, not from when it was sent, so an exporter that falls
+behind shows it in the latencies instead of slowing the generator down.
+
+Prints /report latency at p50 and p99, throughput, the time of a /metrics
+scrape that has to render the snapshot again and the number of series in
+it, and how much this process's RSS grew over the run (not with --url).
+'''
+# pylint: disable=wrong-import-position,wrong-import-order
+import argparse
+import gc
+import http.client
+import io
+import itertools
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_report import environ
+from payloads import realistic_payloads, with_channels
+
+
+class Fleet:
+    '''
+    Report bodies for `stations` stations with `channels` extra channels,
+    built ahead of time from `pushes` consecutive pushes, which each station
+    goes through from a different place
+    '''
+
+    def __init__(self, stations: int, channels: int = 0, pushes: int = 60, seed: int = 0):
+        self.names = [f'station{n}' for n in range(1, stations + 1)]
+        self.bodies = [urlencode(payload).encode()
+                       for payload in with_channels(realistic_payloads(pushes, seed), channels, seed)]
+
+    def request(self, index: int) -> tuple:
+        '''Path and body of the `index`th report, the stations taking turns'''
+        station = index % len(self.names)
+        push = (index // len(self.names) + station * 7) % len(self.bodies)
+        return f'/report/{self.names[station]}', self.bodies[push]
+
+
+class InProcess:
+    '''Calls a Flask app's WSGI app directly'''
+
+    def __init__(self, app):
+        self.wsgi_app = app.wsgi_app
+
+    def call(self, method: str, path: str, body: bytes = b'') -> tuple:
+        env = environ(body)
+        env.update(REQUEST_METHOD=method, PATH_INFO=path)
+        env['wsgi.input'] = io.BytesIO(body)
+        status = []
+
+        def start_response(line, headers, exc_info=None): # pylint: disable=unused-argument
+            status.append(line)
+
+        chunks = self.wsgi_app(env, start_response)
+        try:
+            content = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return int(status[0][:3]), content
+
+    def post(self, path: str, body: bytes) -> int:
+        return self.call('POST', path, body)[0]
+
+    def get(self, path: str) -> tuple:
+        return self.call('GET', path)
+
+
+class OverHttp:
+    '''Sends requests over keep-alive HTTP connections, one for each thread'''
+
+    def __init__(self, host: str, port: int, timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def call(self, method: str, path: str, body: bytes = None, headers: dict = None) -> tuple:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            # Counted as a failed request, on a new connection next time
+            connection.close()
+            self.local.connection = None
+            return 0, b''
+
+    def post(self, path: str, body: bytes) -> int:
+        return self.call('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})[0]
+
+    def get(self, path: str) -> tuple:
+        return self.call('GET', path)
+
+
+def serve(app) -> tuple:
+    '''Serve a WSGI app on a free local port in the background, returning the server and port'''
+    from werkzeug.serving import WSGIRequestHandler, make_server # pylint: disable=import-outside-toplevel
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_port
+
+
+def rss() -> int:
+    '''Resident set size of this process in bytes, 0 where /proc is not available'''
+    gc.collect()
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def warm(target, fleet: Fleet):
+    '''Have every station report once, so its keys are compiled'''
+    for index in range(len(fleet.names)):
+        target.post(*fleet.request(index))
+
+
+def run(target, fleet: Fleet, seconds: float, rate: float = 0, connections: int = 4) -> dict:
+    '''
+    Send reports from `connections` threads for `seconds`, at `rate` a
+    second in all or as fast as they are answered, and sum up their latencies
+    '''
+    latencies = [[] for _ in range(connections)]
+    errors = [0] * connections
+    counter = itertools.count()
+    start = time.perf_counter()
+    deadline = start + seconds
+
+    def send(slot: int):
+        record = latencies[slot].append
+        while True:
+            index = next(counter)
+            due = start + index / rate if rate else time.perf_counter()
+            if due >= deadline:
+                return
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            status = target.post(*fleet.request(index))
+            record(time.perf_counter() - due)
+            if status != 200:
+                errors[slot] += 1
+
+    threads = [threading.Thread(target=send, args=(slot,)) for slot in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    ordered = sorted(itertools.chain.from_iterable(latencies))
+    return {
+        'reports': len(ordered),
+        'errors': sum(errors),
+        'throughput': len(ordered) / elapsed,
+        'p50_ms': percentile(ordered, 0.50) * 1000,
+        'p99_ms': percentile(ordered, 0.99) * 1000,
+    }
+
+
+def scrape(target, fleet: Fleet, repeat: int = 3) -> tuple:
+    '''
+    Best time in seconds of a /metrics scrape just after a report, so that
+    it renders the snapshot again, and the number of series in it
+    '''
+    best = float('inf')
+    series = 0
+    for index in range(repeat):
+        target.post(*fleet.request(index))
+        start = time.perf_counter()
+        status, body = target.get('/metrics')
+        best = min(best, time.perf_counter() - start)
+        if status != 200:
+            raise RuntimeError(f'/metrics answered {status}')
+        series = sum(1 for line in body.splitlines() if line and not line.startswith(b'#'))
+    return best, series
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send reports from a synthetic fleet of gateways to the exporter')
+    parser.add_argument('--stations', type=int, default=10, help='gateways in the fleet (default: 10)')
+    parser.add_argument('--channels', type=int, default=8, help='extra soil probes on each (default: 8)')
+    parser.add_argument('--rate', type=float, default=0, help='reports a second in all, 0 for as fast as answered')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to send for (default: 10)')
+    parser.add_argument('--connections', type=int, default=4, help='threads sending at once (default: 4)')
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument('--socket', action='store_true', help='serve the app on a local port and send over HTTP')
+    where.add_argument('--url', help='send to an exporter already running here, e.g. http://localhost:8088')
+    args = parser.parse_args()
+
+    fleet = Fleet(args.stations, args.channels)
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        target = OverHttp(url.hostname, url.port or 80)
+    else:
+        import ecowitt_exporter # pylint: disable=import-outside-toplevel
+        # Room for the whole fleet, unless the environment says otherwise
+        os.environ.setdefault('MAX_STATIONS', str(max(args.stations, 100)))
+        app = ecowitt_exporter.create_app()
+        if args.socket:
+            server, port = serve(app)
+            target = OverHttp('127.0.0.1', port)
+        else:
+            target = InProcess(app)
+
+    warm(target, fleet)
+    before = rss() if not args.url else 0
+    result = run(target, fleet, args.seconds, args.rate, args.connections)
+    after = rss() if not args.url else 0
+    try:
+        seconds, series = scrape(target, fleet)
+    except RuntimeError as error:
+        seconds, series = None, error
+    if server:
+        server.shutdown()
+
+    print(f'{args.stations} stations with {args.channels} extra channels, '
+          f'{"as fast as answered" if not args.rate else f"{args.rate:g} reports/s"} for {args.seconds:g}s '
+          f'from {args.connections} connections, {"to " + args.url if args.url else "over HTTP" if args.socket else "in-process"}')
+    print(f'  reports     {result["reports"]:10d} ({result["errors"]} failed)')
+    print(f'  throughput  {result["throughput"]:10.1f} reports/s')
+    print(f'  latency p50 {result["p50_ms"]:10.2f} ms')
+    print(f'  latency p99 {result["p99_ms"]:10.2f} ms')
+    if seconds is None:
+        print(f'  /metrics    {series}')
+    else:
+        print(f'  /metrics    {seconds * 1000:10.2f} ms for {series} series')
+    if before and after:
+        print(f'  RSS         {after / 2**20:10.1f} MB, {(after - before) / 2**20:+.1f} MB over the run')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Sample Ecowitt payloads for the benchmarks, built from data.txt.
+'''
+import os
+import random
+from urllib.parse import parse_qsl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_TXT = os.path.join(ROOT, 'data.txt')
+
+def raw_payload() -> bytes:
+    '''The captured GW1100A push, exactly as the gateway sent it'''
+    with open(DATA_TXT, 'rb') as f:
+        return f.read().strip()
+
+def sample_payload() -> dict:
+    '''The captured GW1100A push as a flat dict'''
+    return dict(parse_qsl(raw_payload().decode(), keep_blank_values=True))
+
+def drifted_payloads(count: int, seed: int = 0) -> list:
+    '''
+    `count` variations of the sample payload with numeric readings nudged
+    around, so that consecutive pushes are not byte-identical.
+    '''
+    rng = random.Random(seed)
+    base = sample_payload()
+    payloads = []
+    for _ in range(count):
+        payload = {}
+        for key, value in base.items():
+            try:
+                number = float(value)
+            except ValueError:
+                payload[key] = value
+                continue
+            if '.' in value and not key.endswith('batt'):
+                number = max(0.0, number + rng.uniform(-0.5, 0.5))
+                payload[key] = '{:.2f}'.format(number)
+            else:
+                payload[key] = value
+        payloads.append(payload)
+    return payloads
+
+# Readings that change on almost every push, and ones that change now and
+# then. Everything else (rain totals, batteries, station info) rarely does.
+EVERY_PUSH = ('runtime', 'heap', 'dateutc', 'tempf', 'vpd', 'winddir', 'windspeedmph', 'windgustmph', 'solarradiation')
+SOMETIMES = ('tempinf', 'humidityin', 'baromrelin', 'baromabsin', 'humidity', 'pm25_ch2') + tuple(
+    f'{key}{n}' for n in range(1, 9) for key in ('humidity', 'soilad')) + tuple(f'temp{n}f' for n in range(1, 9))
+
+def realistic_payloads(count: int, seed: int = 0, sometimes: float = 0.3) -> list:
+    '''
+    `count` consecutive pushes from the sample gateway, as it would send
+    them a minute apart: the readings in EVERY_PUSH change each time, those
+    in SOMETIMES change with probability `sometimes`, and the rest stay put.
+    '''
+    rng = random.Random(seed)
+    payload = sample_payload()
+    payloads = []
+    for index in range(count):
+        payload = dict(payload)
+        for key in EVERY_PUSH + SOMETIMES:
+            if key not in payload or key in SOMETIMES and rng.random() >= sometimes:
+                continue
+            value = payload[key]
+            if key == 'dateutc':
+                payload[key] = f'2025-05-30+{19 + index // 60 % 5}:{index % 60:02d}:57'
+                continue
+            decimals = len(value.partition('.')[2])
+            step = 10 ** -decimals if decimals else 1
+            payload[key] = f'{max(0.0, float(value) + rng.choice((-2, -1, 1, 2)) * step):.{decimals}f}'
+        payloads.append(payload)
+    return payloads
+
+def with_channels(payloads: list, channels: int, seed: int = 0) -> list:
+    '''
+    `payloads` with `channels` extra soil probes added to each, numbered
+    from 9 up, each sending a moisture reading that moves now and then and
+    a battery voltage
+    '''
+    rng = random.Random(seed)
+    moisture = {n: rng.randint(20, 60) for n in range(9, 9 + channels)}
+    for payload in payloads:
+        for n in moisture:
+            if rng.random() < 0.05:
+                moisture[n] += rng.choice((-1, 1))
+            payload[f'soilmoisture{n}'] = str(moisture[n])
+            payload[f'soilbatt{n}'] = '1.5'
+    return payloads
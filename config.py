@@ -0,0 +1,291 @@
+'''
+The exporter's settings, read from environment variables.
+
+Reading them has no side effects, so the exporter can be set up from a
+Config in tests and tools as well as at startup, where show() prints it.
+The settings that are lists are parsed here, so that reading them does not
+import the modules of features that are turned off.
+'''
+import os
+import re
+import socket
+
+# Seconds in each unit of an AGGREGATE_WINDOWS duration
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_windows(value: str) -> dict:
+    '''
+    Parse AGGREGATE_WINDOWS, a comma-separated list of durations such as
+    10m or 1h, into a dict of label to seconds
+    '''
+    windows = {}
+    for label in value.split(','):
+        label = label.strip()
+        if not label:
+            continue
+        match = re.fullmatch(r'(\d+)([smhd])', label)
+        if not match:
+            raise ValueError(f'Unrecognised aggregate window {label}')
+        windows[label] = int(match.group(1)) * UNITS[match.group(2)]
+    return windows
+
+
+def parse_patterns(value: str):
+    '''
+    Compile DISCOVER_KEYS, a comma-separated list of glob patterns of keys
+    to expose, where a pattern starting with ! is one of keys not to, e.g.
+    *,!heap. Returns a function telling whether a key matches, or None if
+    no key can.
+    '''
+    allow = []
+    deny = []
+    for pattern in value.split(','):
+        pattern = pattern.strip()
+        if pattern.startswith('!'):
+            deny.append(pattern[1:].strip())
+        elif pattern:
+            allow.append(pattern)
+    if not allow:
+        return None
+    import fnmatch # pylint: disable=import-outside-toplevel
+    allowed = re.compile('|'.join(fnmatch.translate(pattern) for pattern in allow)).match
+    if not deny:
+        return lambda key: allowed(key) is not None
+    denied = re.compile('|'.join(fnmatch.translate(pattern) for pattern in deny)).match
+    return lambda key: allowed(key) is not None and denied(key) is None
+
+
+def parse_ttls(value: str) -> dict:
+    '''Parse SERIES_TTLS, a comma-separated list of metric=seconds pairs'''
+    ttls = {}
+    for pair in value.split(','):
+        name, _, seconds = pair.partition('=')
+        if name.strip() and seconds.strip():
+            ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+def parse_gateways(value: str) -> list:
+    '''
+    Parse POLL_GATEWAYS, a comma-separated list of gateways as host,
+    host:port or station=host[:port], into (station, host, port) tuples.
+    A gateway with no station name is named after its host.
+    '''
+    gateways = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, address = entry.rpartition('=')
+        host, _, port = address.partition(':')
+        gateways.append((name or host, host, int(port or 80)))
+    return gateways
+
+
+def parse_passkeys(value: str) -> dict:
+    '''Parse STATION_PASSKEYS, a comma-separated list of PASSKEY=station pairs'''
+    passkeys = {}
+    for pair in value.split(','):
+        passkey, _, name = pair.partition('=')
+        if passkey.strip() and name.strip():
+            passkeys[passkey.strip()] = name.strip()
+    return passkeys
+
+
+class Config:
+    '''Every setting, from `environ` or the process environment'''
+
+    # pylint: disable=too-many-instance-attributes,too-many-statements
+    def __init__(self, environ: dict = None):
+        environ = os.environ if environ is None else environ
+        # Per-station location overrides are looked up in here too
+        self.environ = environ
+
+        self.debug = environ.get('DEBUG', 'no') == 'yes'
+        self.temperature_unit = environ.get('TEMPERATURE_UNIT', 'c')
+        self.pressure_unit = environ.get('PRESSURE_UNIT', 'hpa')
+        self.wind_unit = environ.get('WIND_UNIT', 'kmh')
+        self.rain_unit = environ.get('RAIN_UNIT', 'mm')
+        self.distance_unit = environ.get('DISTANCE_UNIT', 'km')
+        self.irradiance_unit = environ.get('IRRADIANCE_UNIT', 'wm2')
+        self.aqi_standard = environ.get('AQI_STANDARD', 'uk')
+        self.station_id = environ.get('STATION_ID', 'ecowitt')
+
+        # How to serve HTTP. 'flask' is Flask's built-in development server;
+        # 'gunicorn' runs WORKERS processes of THREADS threads each.
+        self.server = environ.get('SERVER', 'flask')
+        self.workers = int(environ.get('WORKERS', '1'))
+        self.threads = int(environ.get('THREADS', '4'))
+        self.keepalive = int(environ.get('KEEPALIVE', '5'))
+        self.max_request_size = int(environ.get('MAX_REQUEST_SIZE', '65536'))
+        # With more than one worker, each one shares its metrics with the others
+        # through files in this directory
+        self.multiproc_dir = environ.get('MULTIPROC_DIR', '/tmp/ecowitt-exporter')
+
+        # 'sync' applies each report before answering the gateway. 'async' queues
+        # it for a background thread and answers straight away, or with a 503 and
+        # Retry-After if INGEST_QUEUE_SIZE reports are already waiting.
+        self.ingest_mode = environ.get('INGEST_MODE', 'sync')
+        self.ingest_queue_size = int(environ.get('INGEST_QUEUE_SIZE', '1000'))
+        self.retry_after = int(environ.get('RETRY_AFTER', '10'))
+
+        # File to keep the metrics in across restarts, saved at most every
+        # STATE_INTERVAL seconds and at exit. Unset to start empty every time.
+        self.state_file = environ.get('STATE_FILE')
+        self.state_interval = float(environ.get('STATE_INTERVAL', '60'))
+
+        # Seconds after which a series that has not been reported again is dropped,
+        # e.g. a sensor that was removed or renamed. 0 keeps series forever.
+        # SERIES_TTLS overrides it per metric, as comma-separated metric=seconds
+        # pairs, e.g. ecowitt_batterylevel=86400. Gateway report times are kept
+        # unless overridden, as they are what a stale gateway alert looks at.
+        self.series_ttl = float(environ.get('SERIES_TTL', '0'))
+        self.series_ttls = {
+            'ecowitt_last_report_timestamp_seconds': 0,
+            **parse_ttls(environ.get('SERIES_TTLS', '')),
+        }
+
+        # Number of recent payloads kept from each station for /debug/recent and
+        # /debug/keys. 0 turns the ring buffer and both endpoints off.
+        self.recent_payloads_size = int(environ.get('RECENT_PAYLOADS', '10'))
+
+        # Work out dew point, heat index, wind chill, feels-like temperature and
+        # absolute humidity from each sensor's temperature and humidity
+        self.derived_metrics = environ.get('DERIVED_METRICS', 'no') == 'yes'
+
+        # Comma-separated list of windows, e.g. 10m,1h, over which to keep rolling
+        # aggregates of wind, rain and temperature. Empty for none.
+        self.aggregate_windows = parse_windows(environ.get('AGGREGATE_WINDOWS', ''))
+
+        # Expose the exporter's own timings, payload sizes and unknown keys
+        self.instrument = environ.get('INSTRUMENT', 'no') == 'yes'
+
+        # Comma-separated list of glob patterns of report keys the exporter does not
+        # recognise to expose as ecowitt_raw{key="..."} when their value is a number,
+        # e.g. * for all of them. Patterns starting with ! exclude keys, e.g. *,!heap.
+        # Each station keeps at most DISCOVER_MAX_SERIES of them, the least recently
+        # updated are dropped first. Empty for none.
+        self.discover_keys = environ.get('DISCOVER_KEYS', '')
+        self.discover = parse_patterns(self.discover_keys)
+        self.discover_max_series = int(environ.get('DISCOVER_MAX_SERIES', '100'))
+
+        # Comma-separated list of gateways to poll on their local HTTP API, as
+        # host, host:port or station=host[:port], for gateways that cannot push or
+        # to fetch readings more often than they push. Each is polled every
+        # POLL_INTERVAL seconds by a pool of POLL_CONCURRENCY threads.
+        self.poll_gateways = parse_gateways(environ.get('POLL_GATEWAYS', ''))
+        self.poll_interval = float(environ.get('POLL_INTERVAL', '10'))
+        self.poll_timeout = float(environ.get('POLL_TIMEOUT', '5'))
+        self.poll_concurrency = int(environ.get('POLL_CONCURRENCY', '4'))
+
+        # MQTT broker to take reports from, as mqtt://[user:password@]host[:port] or
+        # mqtts:// for TLS, for gateways whose uploads are bridged onto MQTT rather
+        # than posted to /report. Each message on MQTT_TOPICS, comma-separated topic
+        # filters, is a report body. The station is the topic level matched by the
+        # filter's first + or #, e.g. garden for ecowitt/garden on ecowitt/+, or
+        # comes from the PASSKEY if it has none. At MQTT_QOS 1 the broker keeps
+        # reports that arrive while the exporter is disconnected, under
+        # MQTT_CLIENT_ID, which must be unique to each exporter.
+        self.mqtt_url = environ.get('MQTT_URL')
+        self.mqtt_topics = [
+            topic.strip() for topic in environ.get('MQTT_TOPICS', 'ecowitt/+').split(',') if topic.strip()
+        ]
+        self.mqtt_qos = int(environ.get('MQTT_QOS', '0'))
+        self.mqtt_client_id = environ.get('MQTT_CLIENT_ID', f'ecowitt-exporter-{socket.gethostname()}')
+        self.mqtt_keepalive = int(environ.get('MQTT_KEEPALIVE', '60'))
+        self.mqtt_batch_size = int(environ.get('MQTT_BATCH_SIZE', '1000'))
+
+        # Pushgateway to push the metrics to, e.g. http://pushgateway:9091, for when
+        # Prometheus cannot scrape the exporter. Each station's updated series are
+        # pushed every PUSH_INTERVAL seconds, or as soon as PUSH_FLUSH_SIZE series
+        # updates are waiting. Pushes that fail wait in PUSH_QUEUE_DIR, up to
+        # PUSH_QUEUE_BYTES, to be sent again.
+        self.push_url = environ.get('PUSH_URL')
+        self.push_job = environ.get('PUSH_JOB', 'ecowitt')
+        self.push_interval = float(environ.get('PUSH_INTERVAL', '15'))
+        self.push_flush_size = int(environ.get('PUSH_FLUSH_SIZE', '1000'))
+        self.push_timeout = float(environ.get('PUSH_TIMEOUT', '10'))
+        self.push_queue_dir = environ.get('PUSH_QUEUE_DIR', '/tmp/ecowitt-push')
+        self.push_queue_bytes = int(environ.get('PUSH_QUEUE_BYTES', str(10 * 1024 * 1024)))
+
+        # Comma-separated list of PASSKEY=station pairs, naming the gateways that
+        # report to this exporter. Gateways can also name themselves by posting to
+        # /report/<station>; anything else is labelled with STATION_ID.
+        self.station_passkeys = parse_passkeys(environ.get('STATION_PASSKEYS', ''))
+        # Most stations there can be. Once there are this many, reports naming any
+        # other are refused, so made-up names cannot grow the exporter without end.
+        # 0 for no limit.
+        self.max_stations = int(environ.get('MAX_STATIONS', '100'))
+
+        # Comma-separated list of sensor names to pre-seed in
+        # ecowitt_sensor_last_report_timestamp_seconds at startup. Without this, the
+        # per-sensor freshness metric is only created when a sensor first pushes data,
+        # which means staleness alerts of the form
+        # `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > N`
+        # return no data (and therefore never fire) if the exporter restarts while
+        # the sensor is already offline. Seeding with the current time gives the alert
+        # a grace period equal to its `for:` duration.
+        self.sensors_to_track = [
+            s.strip() for s in environ.get('SENSORS_TO_TRACK', '').split(',') if s.strip()
+        ]
+
+        # Location label of each sensor, unless overridden per station
+        self.locations = {
+            'co2': environ.get('CO2_LOCATION'),
+            'outdoor': environ.get('OUTDOOR_LOCATION'),
+            'indoor': environ.get('INDOOR_LOCATION'),
+            'temp1': environ.get('TEMP1_LOCATION'),
+            'temp2': environ.get('TEMP2_LOCATION'),
+            'temp3': environ.get('TEMP3_LOCATION'),
+            'temp4': environ.get('TEMP4_LOCATION'),
+            'temp5': environ.get('TEMP5_LOCATION'),
+            'temp6': environ.get('TEMP6_LOCATION'),
+            'temp7': environ.get('TEMP7_LOCATION'),
+            'temp8': environ.get('TEMP8_LOCATION'),
+        }
+
+    def show(self):
+        '''Print the configuration, as the exporter starts'''
+        print ("Ecowitt Exporter")
+        print ("================")
+        print ("Configuration:")
+        print ('  DEBUG:            ' + str(self.debug))
+        print ('  TEMPERATURE_UNIT: ' + self.temperature_unit)
+        print ('  PRESSURE_UNIT:    ' + self.pressure_unit)
+        print ('  WIND_UNIT:        ' + self.wind_unit)
+        print ('  RAIN_UNIT:        ' + self.rain_unit)
+        print ('  DISTANCE_UNIT:    ' + self.distance_unit)
+        print ('  IRRADIANCE_UNIT:  ' + self.irradiance_unit)
+        print ('  AQI STANDARD:     ' + self.aqi_standard)
+        print ('  STATION_ID:       ' + self.station_id)
+        print ('  STATION_PASSKEYS: ' + (','.join(self.station_passkeys.values()) if self.station_passkeys else '(none)'))
+        print ('  MAX_STATIONS:     ' + (str(self.max_stations) if self.max_stations else '(none)'))
+        print ('  POLL_GATEWAYS:    ' + (','.join(f'{name}={host}:{port}' for name, host, port in self.poll_gateways)
+                                         if self.poll_gateways else '(none)'))
+        if self.poll_gateways:
+            print ('  POLL_INTERVAL:    ' + str(self.poll_interval))
+        # Without the password
+        print ('  MQTT_URL:         ' + (re.sub(r'(//[^:@/]*):[^@/]*@', r'\1@', self.mqtt_url) if self.mqtt_url else '(none)'))
+        if self.mqtt_url:
+            print ('  MQTT_TOPICS:      ' + ','.join(self.mqtt_topics))
+        print ('  PUSH_URL:         ' + (self.push_url or '(none)'))
+        if self.push_url:
+            print ('  PUSH_INTERVAL:    ' + str(self.push_interval))
+        print ('  SERVER:           ' + self.server)
+        if self.server == 'gunicorn':
+            print ('  WORKERS:          ' + str(self.workers))
+            print ('  THREADS:          ' + str(self.threads))
+            print ('  KEEPALIVE:        ' + str(self.keepalive))
+        print ('  MAX_REQUEST_SIZE: ' + str(self.max_request_size))
+        print ('  INGEST_MODE:      ' + self.ingest_mode)
+        print ('  STATE_FILE:       ' + (self.state_file or '(none)'))
+        print ('  RECENT_PAYLOADS:  ' + str(self.recent_payloads_size))
+        print ('  DERIVED_METRICS:  ' + str(self.derived_metrics))
+        print ('  AGGREGATE_WINDOWS:' + (' ' + ','.join(self.aggregate_windows) if self.aggregate_windows else ' (none)'))
+        print ('  INSTRUMENT:       ' + str(self.instrument))
+        print ('  DISCOVER_KEYS:    ' + (self.discover_keys if self.discover else '(none)'))
+        if self.discover:
+            print ('  DISCOVER_MAX_SERIES: ' + str(self.discover_max_series))
+        print ('  SERIES_TTL:       ' + (str(self.series_ttl) if self.series_ttl else '(none)'))
+        print ('  SENSORS_TO_TRACK: ' + (','.join(self.sensors_to_track) if self.sensors_to_track else '(none)'))
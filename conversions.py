@@ -1,148 +1,223 @@
-import aqi
+from bisect import bisect_left, bisect_right
+from math import isnan
 
-def mph2kmh(mph: str) -> str:
+def rounded(value: float, ndigits: int = None) -> float:
+    '''Round a converted value, or pass it through if ndigits is None'''
+    if ndigits is None:
+        return value
+    return round(value, ndigits)
+
+# Float-in/float-out conversions, rounded to the places the exporter has
+# always shown unless ndigits is None. A whole payload is converted in one
+# pass by IngestPlan.evaluate(), which binds each key to one of these when
+# it is first seen.
+
+def mph2kmh_float(mph: float, ndigits: int = 2) -> float:
     '''Convert mph to km/h'''
-    kmh = float(mph) * 1.60934
-    return "{:.2f}".format(kmh)
+    return rounded(mph * 1.60934, ndigits)
 
-def mph2ms(mph: str) -> str:
+def mph2ms_float(mph: float, ndigits: int = 2) -> float:
     '''Convert mph to m/s'''
-    speedms = float(mph) / 2.237
-    return "{:.2f}".format(speedms)
+    return rounded(mph / 2.237, ndigits)
 
-def mph2kts(mph: str) -> str:
+def mph2kts_float(mph: float, ndigits: int = 2) -> float:
     '''Convert mph to knots'''
-    knots = float(mph) / 1.151
-    return "{:.2f}".format(knots)
+    return rounded(mph / 1.151, ndigits)
 
-def mph2fps(mph: str) -> str:
+def mph2fps_float(mph: float, ndigits: int = 2) -> float:
     '''Convert mph to fps'''
-    fps = float(mph) * 1.467
-    return "{:.2f}".format(fps)
+    return rounded(mph * 1.467, ndigits)
 
-def in2mm(inches: str) -> str:
+def in2mm_float(inches: float, ndigits: int = 1) -> float:
     '''Convert inches to mm'''
-    mm = float(inches) * 25.4
-    return "{:.1f}".format(mm)
+    return rounded(inches * 25.4, ndigits)
 
-def km2mi(km: str) -> str:
+def km2mi_float(km: float, ndigits: int = 2) -> float:
     '''Convert km to miles'''
-    distancemi = float(km) / 1.60934
-    return "{:.2f}".format(distancemi)
+    return rounded(km / 1.60934, ndigits)
 
-def inhg2hpa(inhg: str) -> str:
+def inhg2hpa_float(inhg: float, ndigits: int = 2) -> float:
     '''Convert inches Hg to hPa'''
-    pressurehpa = float(inhg) * 33.8639
-    return "{:.2f}".format(pressurehpa)
+    return rounded(inhg * 33.8639, ndigits)
 
-def inhg2mmhg(inhg: str) -> str:
+def inhg2mmhg_float(inhg: float, ndigits: int = 2) -> float:
     '''Convert inches Hg to mmHg'''
-    pressuremmhg = float(inhg) * 25.4
-    return "{:.2f}".format(pressuremmhg)
+    return rounded(inhg * 25.4, ndigits)
 
-def wm22lux(wm2: str) -> str:
+def wm22lux_float(wm2: float, ndigits: int = 2) -> float:
     '''Convert degrees W/m2 to lux'''
-    irradiance_lx = float(wm2) / 0.0079
-    return "{:.2f}".format(irradiance_lx)
+    return rounded(wm2 / 0.0079, ndigits)
 
-def wm22fc(wm2: str) -> str:
+def wm22fc_float(wm2: float, ndigits: int = 2) -> float:
     '''Convert degrees W/m2 to foot candle'''
-    irradiance_lx = float(wm2) * 6.345
-    return "{:.2f}".format(irradiance_lx)
+    return rounded(wm2 * 6.345, ndigits)
 
-def f2c(f: str) -> str:
+def f2c_float(f: float, ndigits: int = 2) -> float:
     '''Convert degrees Fahrenheit to Celsius'''
-    tempc = (float(f) - 32) * 5/9
-    return "{:.2f}".format(tempc)
+    return rounded((f - 32) * 5/9, ndigits)
 
-def f2k(f: str) -> str:
+def f2k_float(f: float, ndigits: int = 2) -> float:
     '''Convert degrees Fahrenheit to Kelvin'''
-    tempk = (float(f) - 32) * 5/9 + 273.15
-    return "{:.2f}".format(tempk)
+    return rounded((f - 32) * 5/9 + 273.15, ndigits)
+
+class PiecewiseIndex:
+    '''
+    Piecewise-linear air quality index from a breakpoint table, as used by
+    the US EPA and China MEP standards. Each row of the table is
+    (concentration low, concentration high, index low, index high).
+
+    The concentration is truncated to `precision` decimal places and the
+    index rounded half-even, exactly as python-aqi does, but in integer
+    arithmetic with a bisect over the table instead of Decimal and a linear
+    scan. Results for recent concentrations are kept in a bounded memo;
+    pass memo=0 to disable it. Concentrations beyond the top of the table
+    are capped at its highest index, and NaN is passed through.
+    '''
+
+    def __init__(self, table: tuple, precision: int = 0, memo: int = 256):
+        self.scale = 10 ** precision
+        self.rows = tuple(
+            (round(cclo * self.scale), round(cchi * self.scale), aqilo, aqihi)
+            for cclo, cchi, aqilo, aqihi in table
+        )
+        self.lows = [row[0] for row in self.rows]
+        self.top = self.rows[-1][1]
+        self.memo = {}
+        self.memo_size = memo
+
+    def __call__(self, concentration: float) -> int:
+        concentration = float(concentration)
+        if isnan(concentration):
+            return concentration
+        # Truncate to the table's precision. The small offset stops values
+        # like 0.7 (0.69999...) being truncated a step too low.
+        cc = max(0, int(concentration * self.scale + 1e-9))
+        try:
+            return self.memo[cc]
+        except KeyError:
+            pass
+        index = self.index(cc)
+        if self.memo_size:
+            if len(self.memo) >= self.memo_size:
+                self.memo.clear()
+            self.memo[cc] = index
+        return index
+
+    def index(self, cc: int) -> int:
+        '''The index for a concentration already scaled to an integer'''
+        if cc > self.top:
+            return self.rows[-1][3]
+        cclo, cchi, aqilo, aqihi = self.rows[bisect_right(self.lows, cc) - 1]
+        # (aqihi - aqilo) / (cchi - cclo) * (cc - cclo) + aqilo, rounded
+        # half-even, without leaving integers
+        index, remainder = divmod((aqihi - aqilo) * (cc - cclo), cchi - cclo)
+        index += aqilo
+        if 2 * remainder > cchi - cclo or (2 * remainder == cchi - cclo and index % 2):
+            index += 1
+        return index
+
+# https://www.airnow.gov/sites/default/files/2020-05/aqi-technical-assistance-document-sept2018.pdf
+EPA_PM25 = (
+    (0.0, 12.0, 0, 50),
+    (12.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 150.4, 151, 200),
+    (150.5, 250.4, 201, 300),
+    (250.5, 350.4, 301, 400),
+    (350.5, 500.4, 401, 500),
+)
+
+# HJ 633-2012 Technical Regulation on Ambient Air Quality Index
+MEP_PM25 = (
+    (0, 35, 0, 50),
+    (36, 75, 51, 100),
+    (76, 115, 101, 150),
+    (116, 150, 151, 200),
+    (151, 250, 201, 300),
+    (251, 350, 301, 400),
+    (351, 500, 401, 500),
+)
+
+# Lower bounds of DAQI bands 2 to 10
+# https://en.wikipedia.org/wiki/Air_quality_index#United_Kingdom
+UK_PM25 = (12, 24, 36, 42, 48, 54, 59, 65, 71)
+
+# Upper bounds of Beaufort numbers 0 to 11, in mph
+BEAUFORT_MPH = (1, 3, 7, 12, 18, 24, 31, 38, 46, 54, 63, 73)
+
+# Australian NEPM 24 hour PM2.5 standard, µg/m3
+NEPM_PM25 = 25
+
+# Breakpoint indexes by table, built the first time a table is used, so
+# only the configured AQI_STANDARD's is ever built
+piecewise_indexes = {}
+
+def piecewise_index(table: tuple, precision: int) -> PiecewiseIndex:
+    '''The shared PiecewiseIndex for a breakpoint table'''
+    index = piecewise_indexes.get(table)
+    if index is None:
+        index = piecewise_indexes[table] = PiecewiseIndex(table, precision)
+    return index
 
 def aqi_uk(concentration):
     '''
-    Calculate the AQI using the UK DAQI standard
+    Calculate the AQI using the UK DAQI standard, NaN for a NaN concentration
     https://en.wikipedia.org/wiki/Air_quality_index#United_Kingdom
     '''
     concentration = float(concentration)
-    if concentration < 12:
-        index = 1
-    elif 12 <= concentration < 24:
-        index = 2
-    elif 24 <= concentration < 36:
-        index = 3
-    elif 36 <= concentration < 42:
-        index = 4
-    elif 42 <= concentration < 48:
-        index = 5
-    elif 48 <= concentration < 54:
-        index = 6
-    elif 54 <= concentration < 59:
-        index = 7
-    elif 59 <= concentration < 65:
-        index = 8
-    elif 65 <= concentration < 71:
-        index = 9
-    elif concentration >= 71:
-        index = 10
-    else:
-        index = None
-    return index
+    if isnan(concentration):
+        return concentration
+    return bisect_right(UK_PM25, concentration) + 1
 
 def aqi_nepm(concentration):
     '''
-    Calculate the AQI using the Austration NEPM standard
+    Calculate the AQI using the Austration NEPM standard, NaN for a NaN
+    concentration
     '''
     concentration = float(concentration)
-    index = int(round(100 * concentration / 25))
+    if isnan(concentration):
+        return concentration
+    index = int(round(100 * concentration / NEPM_PM25))
     return index
 
 def aqi_epa(concentration):
     '''
     Calculate the AQI using the US EPA standard
     '''
-    index = aqi.to_iaqi(aqi.POLLUTANT_PM25, concentration, algo=aqi.ALGO_EPA)
-    return index
+    return piecewise_index(EPA_PM25, 1)(concentration)
 
 def aqi_mep(concentration):
     '''
     Calculate the AQI using the China MEP standard
     '''
-    index = aqi.to_iaqi(aqi.POLLUTANT_PM25, concentration, algo=aqi.ALGO_MEP)
-    return index
+    return piecewise_index(MEP_PM25, 0)(concentration)
 
-def mph2beaufort(speed: str):
+# AQI function for each supported AQI_STANDARD
+aqi_standards = {
+    'uk': aqi_uk,
+    'epa': aqi_epa,
+    'mep': aqi_mep,
+    'nepm': aqi_nepm,
+}
+
+def aqi_function(standard: str):
+    '''
+    The AQI function for an AQI_STANDARD, for handlers to call directly.
+    For EPA and MEP that is their breakpoint index, built on first use.
+    '''
+    match standard:
+        case 'epa':
+            return piecewise_index(EPA_PM25, 1)
+        case 'mep':
+            return piecewise_index(MEP_PM25, 0)
+    return aqi_standards[standard]
+
+def mph2beaufort(speed: float):
     '''
-    Calculate the Beaufort scale number from the windspeed in mph
+    Calculate the Beaufort scale number from the windspeed in mph, NaN
+    for a NaN speed
     '''
     speed = float(speed)
-    if speed <= 1:
-        beaufort = 0
-    elif 1 < speed <= 3:
-        beaufort = 1
-    elif 3 < speed <= 7:
-        beaufort = 2
-    elif 7 < speed <= 12:
-        beaufort = 3
-    elif 12 < speed <= 18:
-        beaufort = 4
-    elif 18 < speed <= 24:
-        beaufort = 5
-    elif 24 < speed <= 31:
-        beaufort = 6
-    elif 31 < speed <= 38:
-        beaufort = 7
-    elif 38 < speed <= 46:
-        beaufort = 8
-    elif 46 < speed <= 54:
-        beaufort = 9
-    elif 54 < speed <= 63:
-        beaufort = 10
-    elif 63 < speed <= 73:
-        beaufort = 11
-    elif speed >= 73:
-        beaufort = 12
-    else:
-        beaufort = None
-    return beaufort
\ No newline at end of file
+    if isnan(speed):
+        return speed
+    return bisect_left(BEAUFORT_MPH, speed)
@@ -0,0 +1,150 @@
+'''
+Metrics derived from temperature, humidity and wind: dew point, heat index,
+wind chill, feels-like temperature and absolute humidity.
+
+Every sensor that reports both temperature and humidity is a channel. The
+formulas work on the raw Fahrenheit and mph values from the payload, so
+the results go through the same conversion as the temperature they were
+derived from. A channel is only recomputed when its inputs have changed
+since the last report; otherwise its previous results are written again.
+'''
+import math
+from ingest import IngestPlan
+
+# (sensor label, temperature key, humidity key, wind key, location key)
+CHANNELS = (
+    ('outdoor', 'tempf', 'humidity', 'windspeedmph', 'outdoor'),
+    ('indoor', 'tempinf', 'humidityin', None, 'indoor'),
+    ('co2', 'tf_co2', 'humi_co2', None, 'co2'),
+) + tuple(
+    (f'ch{n}', f'temp{n}f', f'humidity{n}', None, f'temp{n}') for n in range(1, 9)
+)
+
+
+def dew_point_f(temp: float, humidity: float) -> float:
+    '''Dew point by the Magnus formula, in Fahrenheit'''
+    celsius = (temp - 32) * 5/9
+    gamma = math.log(humidity / 100) + 17.62 * celsius / (243.12 + celsius)
+    return 243.12 * gamma / (17.62 - gamma) * 9/5 + 32
+
+
+def heat_index_f(temp: float, humidity: float) -> float:
+    '''US National Weather Service heat index, in Fahrenheit'''
+    index = 0.5 * (temp + 61.0 + (temp - 68.0) * 1.2 + humidity * 0.094)
+    if (index + temp) / 2 < 80:
+        return index
+    index = (-42.379 + 2.04901523 * temp + 10.14333127 * humidity
+             - .22475541 * temp * humidity - .00683783 * temp * temp
+             - .05481717 * humidity * humidity + .00122874 * temp * temp * humidity
+             + .00085282 * temp * humidity * humidity - .00000199 * temp * temp * humidity * humidity)
+    if humidity < 13 and 80 <= temp <= 112:
+        index -= (13 - humidity) / 4 * math.sqrt((17 - abs(temp - 95)) / 17)
+    elif humidity > 85 and 80 <= temp <= 87:
+        index += (humidity - 85) / 10 * (87 - temp) / 5
+    return index
+
+
+def wind_chill_f(temp: float, wind: float) -> float:
+    '''
+    US National Weather Service wind chill, in Fahrenheit. Only defined at
+    or below 50F with more than 3 mph of wind; otherwise the temperature.
+    '''
+    if temp > 50 or wind <= 3:
+        return temp
+    power = wind ** 0.16
+    return 35.74 + 0.6215 * temp - 35.75 * power + 0.4275 * temp * power
+
+
+def feels_like_f(temp: float, humidity: float, wind: float) -> float:
+    '''Wind chill when it is cold and windy, heat index when it is hot, otherwise the temperature'''
+    if temp <= 50 and wind > 3:
+        return wind_chill_f(temp, wind)
+    if temp >= 80:
+        return heat_index_f(temp, humidity)
+    return temp
+
+
+def absolute_humidity(temp: float, humidity: float) -> float:
+    '''Water vapour density in g/m^3'''
+    celsius = (temp - 32) * 5/9
+    return 6.112 * math.exp(17.67 * celsius / (celsius + 243.5)) * humidity * 2.1674 / (273.15 + celsius)
+
+
+class Channel:
+    '''One sensor's inputs and the writes last derived from them'''
+    __slots__ = ('temp_key', 'humidity_key', 'wind_key', 'labels', 'humidity_labels', 'inputs', 'writes')
+
+    def __init__(self, temp_key: str, humidity_key: str, wind_key: str, labels: tuple, humidity_labels: tuple):
+        self.temp_key = temp_key
+        self.humidity_key = humidity_key
+        self.wind_key = wind_key
+        self.labels = labels
+        self.humidity_labels = humidity_labels
+        self.inputs = None
+        self.writes = ()
+
+
+class DerivedMetrics:
+    '''
+    Derived metric writes for every channel in a payload. The channels of
+    each IngestPlan, i.e. each station, are set up on first use with the
+    plan's labels and temperature conversion.
+    '''
+
+    def __init__(self):
+        self.channels = {}
+
+    def setup(self, plan: IngestPlan) -> list:
+        prefix = () if plan.station is None else (plan.station,)
+        channels = []
+        for sensor, temp_key, humidity_key, wind_key, location_key in CHANNELS:
+            # The same location label as the sensor's ecowitt_temp series
+            if sensor.startswith('ch'):
+                location = plan.locations[location_key]
+            else:
+                location = plan.locations.get(location_key) or sensor
+            channels.append(Channel(
+                temp_key, humidity_key, wind_key,
+                prefix + (sensor, plan.temperature_unit, location),
+                prefix + (sensor, 'gm3', location),
+            ))
+        self.channels[plan] = channels
+        return channels
+
+    def evaluate(self, plan: IngestPlan, data: dict) -> list:
+        '''(metric, labels, value) writes for every channel in `data`'''
+        channels = self.channels.get(plan) or self.setup(plan)
+        convert = plan.converter('temperature') or (lambda value: round(value, 2))
+        writes = []
+        for channel in channels:
+            temp = data.get(channel.temp_key)
+            humidity = data.get(channel.humidity_key)
+            if temp is None or humidity is None:
+                continue
+            wind = data.get(channel.wind_key) if channel.wind_key else None
+            inputs = (temp, humidity, wind)
+            if inputs != channel.inputs:
+                channel.writes = self.derive(channel, convert, inputs)
+                channel.inputs = inputs
+            writes.extend(channel.writes)
+        return writes
+
+    @staticmethod
+    def derive(channel: Channel, convert, inputs: tuple) -> tuple:
+        try:
+            temp, humidity = float(inputs[0]), float(inputs[1])
+            wind = float(inputs[2]) if inputs[2] is not None else 0.0
+        except ValueError:
+            return ()
+        if not 0 < humidity <= 100 or math.isnan(temp) or math.isnan(wind):
+            return ()
+        labels = channel.labels
+        writes = [
+            ('dewpoint', labels, convert(dew_point_f(temp, humidity))),
+            ('heatindex', labels, convert(heat_index_f(temp, humidity))),
+            ('feelslike', labels, convert(feels_like_f(temp, humidity, wind))),
+            ('absolute_humidity', channel.humidity_labels, round(absolute_humidity(temp, humidity), 2)),
+        ]
+        if channel.wind_key:
+            writes.append(('windchill', labels, convert(wind_chill_f(temp, wind))))
+        return tuple(writes)
@@ -0,0 +1,87 @@
+'''
+Expose report keys the exporter does not recognise, within bounds.
+
+New gateway firmware and sensors add keys before the exporter knows what
+they mean. With DISCOVER_KEYS, unrecognised keys that match its patterns
+are set as ecowitt_raw{key="..."} as long as their value is a number, so
+they can be graphed before proper support is added. The patterns are
+compiled once by Config into a single regular expression each for allowing
+and denying, and each key is only matched the first time it is seen.
+
+A gateway that sends a new key on every push must not grow the snapshot or
+the scrape without end, so each station keeps at most DISCOVER_MAX_SERIES
+discovered series. Beyond that, the least recently updated ones are
+dropped. Series are queued in the order they were created; the one at the
+front is dropped if it has not been updated since it was queued, and
+queued again otherwise, so writes never have to reorder the queue.
+'''
+from collections import OrderedDict
+from snapshot import Snapshot
+
+
+class Discovery:
+    '''
+    Keeps the series of `metric` in `snapshot` to at most `max_series` for
+    each set of common labels, i.e. each station, dropping the least
+    recently updated ones first. Drops are counted in the `counter` metric,
+    by the common labels, if given.
+    '''
+
+    def __init__(self, snapshot: Snapshot, max_series: int, metric: str = 'raw', counter: str = None):
+        self.snapshot = snapshot
+        self.max_series = max_series
+        self.metric = metric
+        self.counter = counter
+        # Common labels to the series of each, as key to when it was last
+        # known to be updated, in the order they were queued
+        self.series = {}
+        # Shared with whatever else watches new series, e.g. an Evictor
+        self.on_create = snapshot.on_create
+        snapshot.on_create = self.track
+
+    def track(self, metric: str, key: tuple, sample):
+        '''Queue a new series'''
+        if self.on_create:
+            self.on_create(metric, key, sample)
+        if metric == self.metric:
+            common = key[:len(self.snapshot.common_labels)]
+            queue = self.series.get(common)
+            if queue is None:
+                queue = self.series[common] = OrderedDict()
+            queue[key] = sample.updated
+
+    def track_all(self):
+        '''Queue every series already in the snapshot, e.g. restored ones'''
+        for key, sample in list(self.snapshot.families[self.metric].samples.items()):
+            self.track(self.metric, key, sample)
+
+    def trim(self, common: tuple, now: float, forget=None) -> int:
+        '''
+        Drop series of one set of common labels beyond max_series, returning
+        how many. `forget`, if given, is called with the last label of each,
+        e.g. the report key. Callers hold the lock their series are written
+        under.
+        '''
+        queue = self.series.get(common)
+        if queue is None or len(queue) <= self.max_series:
+            return 0
+        samples = self.snapshot.families[self.metric].samples
+        dropped = 0
+        while len(queue) > self.max_series:
+            key, updated = queue.popitem(last=False)
+            sample = samples.get(key)
+            if sample is None:
+                # Already removed, e.g. by SERIES_TTL
+                continue
+            if sample.updated > updated:
+                queue[key] = sample.updated
+                continue
+            self.snapshot.remove(self.metric, key)
+            if forget:
+                forget(key[-1])
+            dropped += 1
+        if dropped:
+            if self.counter:
+                self.snapshot.inc(self.counter, common, dropped, now)
+            self.snapshot.changed()
+        return dropped
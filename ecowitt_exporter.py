@@ -1,434 +1,70 @@
+'''
+Ecowitt Exporter: receives reports from Ecowitt gateways and exposes them
+as Prometheus metrics.
+
+Importing this module has no side effects. Exporter sets up the metrics and
+ingest from a Config, create_app() builds the Flask app around one, and
+main() reads the environment, prints the configuration and serves. Flask
+and the modules of features that are turned off are only imported when
+needed, so tools such as backfill.py get the same ingest without them, and
+a cold start only pays for what is configured.
+'''
+# pylint: disable=import-outside-toplevel
 import os
 import logging
-import re
+import signal
+import sys
 import time
-from flask import Flask, request
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
-from prometheus_client import make_wsgi_app, Gauge, Info
-from conversions import mph2kmh, mph2ms, mph2kts, mph2fps, in2mm, km2mi, inhg2hpa, inhg2mmhg, wm22lux, wm22fc, f2c, f2k, aqi_epa, aqi_mep, aqi_nepm, aqi_uk, mph2beaufort
-
-app = Flask(__name__)
-
-debug = os.environ.get('DEBUG', 'no') == 'yes'
-temperature_unit = os.environ.get('TEMPERATURE_UNIT', 'c')
-pressure_unit = os.environ.get('PRESSURE_UNIT', 'hpa')
-wind_unit = os.environ.get('WIND_UNIT', 'kmh')
-rain_unit = os.environ.get('RAIN_UNIT', 'mm')
-distance_unit = os.environ.get('DISTANCE_UNIT', 'km')
-irradiance_unit = os.environ.get('IRRADIANCE_UNIT', 'wm2')
-aqi_standard = os.environ.get('AQI_STANDARD', 'uk')
-station_id = os.environ.get('STATION_ID', 'ecowitt')
-
-# Comma-separated list of sensor names to pre-seed in
-# ecowitt_sensor_last_report_timestamp_seconds at startup. Without this, the
-# per-sensor freshness metric is only created when a sensor first pushes data,
-# which means staleness alerts of the form
-# `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > N`
-# return no data (and therefore never fire) if the exporter restarts while
-# the sensor is already offline. Seeding with the current time gives the alert
-# a grace period equal to its `for:` duration.
-sensors_to_track = [
-    s.strip() for s in os.environ.get('SENSORS_TO_TRACK', '').split(',') if s.strip()
-]
-
-co2_location = os.environ.get('CO2_LOCATION')
-outdoor_location = os.environ.get('OUTDOOR_LOCATION')
-indoor_location = os.environ.get('INDOOR_LOCATION')
-temp1_location = os.environ.get('TEMP1_LOCATION')
-temp2_location = os.environ.get('TEMP2_LOCATION')
-temp3_location = os.environ.get('TEMP3_LOCATION')
-temp4_location = os.environ.get('TEMP4_LOCATION')
-temp5_location = os.environ.get('TEMP5_LOCATION')
-temp6_location = os.environ.get('TEMP6_LOCATION')
-temp7_location = os.environ.get('TEMP7_LOCATION')
-temp8_location = os.environ.get('TEMP8_LOCATION')
-
-print ("Ecowitt Exporter")
-print ("================")
-print ("Configuration:")
-print ('  DEBUG:            ' + str(debug))
-print ('  TEMPERATURE_UNIT: ' + temperature_unit)
-print ('  PRESSURE_UNIT:    ' + pressure_unit)
-print ('  WIND_UNIT:        ' + wind_unit)
-print ('  RAIN_UNIT:        ' + rain_unit)
-print ('  DISTANCE_UNIT:    ' + distance_unit)
-print ('  IRRADIANCE_UNIT:  ' + irradiance_unit)
-print ('  AQI STANDARD:     ' + aqi_standard)
-print ('  STATION_ID:       ' + station_id)
-print ('  SENSORS_TO_TRACK: ' + (','.join(sensors_to_track) if sensors_to_track else '(none)'))
-
-# Declare metrics as a global
-metrics={}
-
-@app.route('/')
-def version():
-    return "Ecowitt Exporter\n"
-
-
-@app.before_request
-def log_request_info():
-    app.logger.debug('Headers: %s', request.headers)
-    app.logger.debug('Body: %s', request.get_data())
-
-
-# Support for WS90 with a haptic rain sensor
-rainmaps = {
-        "rrain_piezo": "rainrate",
-        "erain_piezo": "eventrain",
-        "hrain_piezo": "hourlyrain",
-        "drain_piezo": "dailyrain",
-        "wrain_piezo": "weeklyrain",
-        "mrain_piezo": "monthlyrain",
-        "yrain_piezo": "yearlyrain",
-        "last24hrain_piezo": "last24hrain"
-}
-
-# pylint: disable=dangerous-default-value
-def addmetric(metric: str, value: str, label: list = []):
-    '''
-    Set a metric in the Prometheus exporter 
-    and optionally log a debug message.
-    '''
-    if debug:
-        app.logger.debug("Set Prometheus metric %s: %s", metric, value)
-    if label:
-        status = metrics[metric].labels(*label).set(value)
-    else:
-        status = metrics[metric].set(value)
-    return status
-
-def calculate_aqi(standard: str, value: str) -> str:
-    '''
-    Calculate AQI (air quality index) using various
-    different national standards.
-    '''
-    match standard:
-        case 'uk':
-            aqi = aqi_uk(value)
-        case 'epa':
-            aqi = aqi_epa(value)
-        case 'mep':
-            aqi = aqi_mep(value)
-        case 'nepm':
-            aqi = aqi_nepm(value)
-    return aqi
-
-@app.route('/report', methods=['POST'])
-def logecowitt():
-
-    # Retrieve the POST body
-    data = request.form
-
-    for key in data:
-        # Process each key from the raw data, do unit conversions if necessary,
-        # then add the results to the Prometheus exporter
-        value = data[key]
-        app.logger.debug("Received raw value %s: %s", key, value)
-
-        # Ignore these fields
-        if key in ['PASSKEY', 'dateutc', 'runtime']:
-            continue
-        
-        # Add these fields as INFO
-        elif key in ['stationtype', 'freq', 'model']:
-            metrics[key].info({key: value})
-
-        # No conversions needed
-        elif key in ['winddir', 'uv', 'lightning_num', 'lightning_time']:
-            addmetric(metric=key, value=value)
-        
-        # Support for WS90 capacitor
-        elif key in ['ws90cap_volt']:
-            addmetric(metric='ws90', label=[key, 'volt'], value=value)
-
-        # Battery status & levels
-        elif 'batt' in key:
-            # Battery level - returns battery level from 0-5
-            if key in ['wh57batt', 'pm25batt1', 'pm25batt2']:
-                addmetric(metric='batterylevel', label=[key], value=value)
-                # Per-sensor last-seen timestamp for PM2.5 sensors (see note
-                # on sensor freshness tracking at bottom of /report handler).
-                # The WH41 PM2.5 sensor can drop off the radio and we want to
-                # alert on that independently of the gateway.
-                if key.startswith('pm25batt'):
-                    addmetric(metric='sensor_last_report_timestamp',
-                              label=[key], value=time.time())
-            # Battery voltage - returns a decimal voltage e.g. 1.7
-            elif key.startswith('soil') or key.startswith('ws90'):
-                addmetric(metric='batteryvoltage', label=[key, 'volt'], value=value)
-                # Per-sensor last-seen timestamp (see note on sensor freshness
-                # tracking at bottom of /report handler).
-                if key.startswith('soilbatt'):
-                    addmetric(metric='sensor_last_report_timestamp',
-                              label=[key], value=time.time())
-            # Battery status - returns 0 for OK and 1 for low
-            else:
-                addmetric(metric='batterystatus', label=[key], value=value)
-
-        # Soil moisture
-        elif key.startswith('soilmoisture'):
-            addmetric(metric='soilmoisture', label=[key, 'percent'], value=value)
-            # Per-sensor last-seen timestamp (see note on sensor freshness
-            # tracking at bottom of /report handler).
-            addmetric(metric='sensor_last_report_timestamp',
-                      label=[key], value=time.time())
-
-        # WH45 CO2/AQI multi-sensor (tf_co2, humi_co2, pm25_co2,
-        # pm25_24h_co2, pm10_co2, pm10_24h_co2, co2, co2_24h)
-        # Must be checked BEFORE the generic pm25 handler.
-        elif key == 'tf_co2':
-            if temperature_unit == 'c':
-                value = f2c(value)
-            elif temperature_unit == 'k':
-                value = f2k(value)
-            location = co2_location if co2_location else 'co2'
-            addmetric(metric='temp', label=['co2', temperature_unit, location], value=value)
-            addmetric(metric='sensor_last_report_timestamp',
-                      label=['co2'], value=time.time())
-
-        elif key == 'humi_co2':
-            location = co2_location if co2_location else 'co2'
-            addmetric(metric='humidity', label=['co2', 'percent', location], value=value)
-
-        elif key == 'pm25_co2':
-            addmetric(metric='pm25', label=['realtime', 'co2', 'μgm3'], value=value)
-
-        elif key == 'pm25_24h_co2':
-            addmetric(metric='pm25', label=['avg_24h', 'co2', 'μgm3'], value=value)
-            aqi = calculate_aqi(standard=aqi_standard, value=value)
-            addmetric(metric='aqi', label=[aqi_standard, 'co2'], value=aqi)
-
-        elif key == 'pm10_co2':
-            addmetric(metric='pm10', label=['realtime', 'co2', 'μgm3'], value=value)
-
-        elif key == 'pm10_24h_co2':
-            addmetric(metric='pm10', label=['avg_24h', 'co2', 'μgm3'], value=value)
-
-        elif key == 'co2':
-            addmetric(metric='co2', label=['realtime', 'ppm'], value=value)
-
-        elif key == 'co2_24h':
-            addmetric(metric='co2', label=['avg_24h', 'ppm'], value=value)
-
-        # PM25 (WH41 channel sensors)
-        # 'pm25_ch1', 'pm25_avg_24h_ch1'
-        elif key.startswith('pm25'):
-            # Check for invalid readings from the WH41 PM2.5 sensor when the battery is low
-            # https://github.com/djjudas21/ecowitt-exporter/issues/17
-            # If we find bad data, just skip the entire PM2.5 section
-            if (data.get('pm25batt1') == '1' and data.get('pm25_ch1') == '1000') or (data.get('pm25batt2') == '1' and data.get('pm25_ch2') == '1000'):
-                app.logger.debug(f"Drop erroneous PM25 reading {key}: {value}")
-                continue
-
-            # Preserve the original key (e.g. 'pm25_ch1') so we can use it as
-            # a per-sensor last-seen label below.
-            original_key = key
-
-            # Drop PM25 prefix
-            key = key.replace('pm25_', '')
-
-            # Get & drop sensor ch suffix
-            sensorsearch = re.search(r"(ch\d)$", key)
-            sensor = sensorsearch.group(1)
-            key = re.sub(r"ch\d$", '', key)
-
-            # Generate series label
-            if key.startswith('avg_24h'):
-                series = 'avg_24h'
-            else:
-                series = 'realtime'
-
-            # Log the PM25 metric
-            addmetric(metric='pm25', label=[series, sensor, 'μgm3'], value=value)
-
-            # Per-sensor last-seen timestamp for PM2.5 sensors (see note on
-            # sensor freshness tracking at bottom of /report handler). Only
-            # update on the realtime series; avg_24h is a derived rollup and
-            # doesn't represent a fresh sensor push.
-            if series == 'realtime':
-                addmetric(metric='sensor_last_report_timestamp',
-                          label=[original_key], value=time.time())
-
-            # Calculate AQI from PM25
-            if key.startswith('avg_24h'):
-                aqi = calculate_aqi(standard=aqi_standard, value=value)
-                addmetric(metric='aqi', label=[aqi_standard, sensor], value=aqi)
-
-        # Humidity - no conversion needed
-        elif key.startswith('humidity'):
-            match key:
-                case 'humidity':
-                    label = 'outdoor'
-                    location = outdoor_location if outdoor_location else label
-                case 'humidityin':
-                    label = 'indoor'
-                    location = indoor_location if indoor_location else label
-                case _:
-                    label = f'ch{key[-1]}'
-                    location = globals()[f'temp{key[-1]}_location']
-            # pylint: disable=used-before-assignment
-            addmetric(metric='humidity', label=[label, 'percent', location], value=value)
-
-        # Solar irradiance, default W/m^2
-        elif key in ['solarradiation']:
-            if irradiance_unit == 'lx':
-                value = wm22lux(value)
-            elif irradiance_unit == 'fc':
-                value = wm22fc(value)
-            addmetric(metric='solarradiation', label=[irradiance_unit], value=value)
-
-        # Temperature, default Fahrenheit
-        # 'tempinf', 'tempf', 'temp1f', 'temp2f', 'temp3f', 'temp4f', 'temp5f', 'temp6f', 'temp7f', 'temp8f'
-        elif key.startswith('temp'):
-            # Strip trailing f
-            key = key[:-1]
-
-            if temperature_unit == 'c':
-                value = f2c(value)
-            elif temperature_unit == 'k':
-                value = f2k(value)
-
-            if key == 'tempin':
-                label = 'indoor'
-                location = indoor_location if indoor_location else label
-            elif key == 'temp':
-                label = 'outdoor'
-                location = outdoor_location if outdoor_location else label
-            else:
-                label = f'ch{key[-1]}'
-                location = globals()[f'temp{key[-1]}_location']
-
-            addmetric(metric='temp', label=[label, temperature_unit, location], value=value)
-
-        # Pressure, default inches Hg
-        elif key.startswith('barom'):
-            if pressure_unit == 'hpa':
-                value = inhg2hpa(value)
-            elif pressure_unit == 'mmhg':
-                value = inhg2mmhg(value)
-            # Remove 'in' suffix
-            key = key[:-2]
-
-            if key == 'baromrel':
-                label = 'relative'
-            elif key == 'baromabs':
-                label = 'absolute'
-            addmetric(metric='barom', label=[label, pressure_unit], value=value)
-
-        # VPD, default inches Hg
-        elif key in ['vpd']:
-            if pressure_unit == 'hpa':
-                value = inhg2hpa(value)
-            elif pressure_unit == 'mmhg':
-                value = inhg2mmhg(value)
-
-            addmetric(metric='vpd', label=[pressure_unit], value=value)
-
-        # Wind speed, default mph
-        elif key in ['windspeedmph', 'windgustmph', 'maxdailygust']:
-            if wind_unit == 'kmh':
-                value = mph2kmh(value)
-            elif wind_unit == 'ms':
-                value = mph2ms(value)
-            elif wind_unit == 'knots':
-                value = mph2kts(value)
-            elif wind_unit == 'fps':
-                value = mph2fps(value)
-
-            if key == 'windspeedmph':
-                beaufort = mph2beaufort(value)
-                addmetric(metric='wind_beaufort', value=beaufort)
-
-            if key != 'maxdailygust':
-                key = key[:-3]
-            addmetric(metric='wind', label=[key, wind_unit], value=value)
-        
-        # Support for WS90 with a haptic rain sensor (rain state)
-        elif key == 'srain_piezo':
-            # Rain state: 0 = no rain, 1 = rain
-            addmetric(metric='rain_state', label=[key], value=value)
-
-        # Support for WS90 with a haptic rain sensor (cumulative rain amounts)
-        elif key.endswith('piezo'):
-            if rain_unit == 'mm':
-                value = in2mm(value)
-            mkey = rainmaps[key]
-            addmetric(metric='rain', label=[key, rain_unit], value=value)
-
-        # Rainfall, default inches
-        elif 'rain' in key:
-        # 'rainratein', 'eventrainin', 'hourlyrainin', 'dailyrainin', 'weeklyrainin', 'monthlyrainin', 'yearlyrainin', 'totalrainin'
-            if rain_unit == 'mm':
-                value = in2mm(value)
-            key = key[:-2]
-            key = key.replace('rain', '')
-            addmetric(metric='rain', label=[key, rain_unit], value=value)
-
-        # Lightning distance, default kilometers
-        elif key in ['lightning']:
-            if distance_unit == 'km':
-                addmetric(metric='lightning', label=[distance_unit], value=value)
-            elif distance_unit == 'mi':
-                value = km2mi(value)
-                addmetric(metric='lightning', label=[distance_unit], value=value)
-
-
-    # Record the wall-clock time of this successful push from the gateway.
-    # Prometheus can then use `time() - ecowitt_last_report_timestamp_seconds`
-    # to detect a stale gateway (gauges persist their last value forever,
-    # so absent_over_time() on data metrics never fires if the gateway dies).
-    #
-    # Per-sensor timestamps are updated inline above as each sensor's key is
-    # processed, so individual sensor staleness can also be detected even when
-    # the gateway is otherwise healthy (e.g. a single soil probe goes offline
-    # or out of radio range).
-    metrics['last_report_timestamp'].set(time.time())
-
-    # Return a 200 to the weather station
-    response = app.response_class(
-            response='OK',
-            status=200,
-            mimetype='application/json'
-    )
-    return response
-
-if __name__ == "__main__":
-
-    # Set up various Prometheus metrics with descriptions and units
-    metrics['stationtype'] = Info(name='ecowitt_stationtype', documentation='Ecowitt station type')
-    metrics['freq'] = Info(name='ecowitt_freq', documentation='Ecowitt radio frequency')
-    metrics['model'] = Info(name='ecowitt_model', documentation='Ecowitt model')
-    metrics['temp'] = Gauge(name='ecowitt_temp', documentation='Temperature', labelnames=['sensor', 'unit', 'location'])
-    metrics['humidity'] = Gauge(name='ecowitt_humidity', documentation='Relative humidity', labelnames=['sensor', 'unit', 'location'])
-    metrics['winddir'] = Gauge(name='ecowitt_winddir', documentation='Wind direction')
-    metrics['uv'] = Gauge(name='ecowitt_uv', documentation='UV index')
-    metrics['pm25'] = Gauge(name='ecowitt_pm25', documentation='PM2.5 concentration', labelnames=['series', 'sensor', 'unit'])
-    metrics['aqi'] = Gauge(name='ecowitt_aqi', documentation='Air quality index', labelnames=['standard', 'sensor'])
-    metrics['pm10'] = Gauge(name='ecowitt_pm10', documentation='PM10 concentration', labelnames=['series', 'sensor', 'unit'])
-    metrics['co2'] = Gauge(name='ecowitt_co2', documentation='CO2 concentration', labelnames=['series', 'unit'])
-    metrics['batterystatus'] = Gauge(name='ecowitt_batterystatus', documentation='Battery status', labelnames=['sensor'])
-    metrics['batterylevel'] = Gauge(name='ecowitt_batterylevel', documentation='Battery level', labelnames=['sensor'])
-    metrics['batteryvoltage'] = Gauge(name='ecowitt_batteryvoltage', documentation='Battery voltage', labelnames=['sensor', 'unit'])
-    metrics['solarradiation'] = Gauge(name='ecowitt_solarradiation', documentation='Solar irradiance', labelnames=['unit'])
-    metrics['barom'] = Gauge(name='ecowitt_barom', documentation='Barometer', labelnames=['sensor', 'unit'])
-    metrics['vpd'] = Gauge(name='ecowitt_vpd', documentation='Vapour pressure deficit', labelnames=['unit'])
-    metrics['wind'] = Gauge(name='ecowitt_windspeed', documentation='Wind speed', labelnames=['sensor', 'unit'])
-    metrics['wind_beaufort'] = Gauge(name='ecowitt_windspeed_beaufort', documentation='Wind Beaufort scale')
-    metrics['rain'] = Gauge(name='ecowitt_rain', documentation='Rainfall', labelnames=['sensor', 'unit'])
-    metrics['rain_state'] = Gauge(name='ecowitt_rain_state', documentation='Rain state (0=no rain, 1=rain)', labelnames=['sensor'])
-    metrics['lightning'] = Gauge(name='ecowitt_lightning', documentation='Lightning distance', labelnames=['unit'])
-    metrics['lightning_num'] = Gauge(name='ecowitt_lightning_num', documentation='Lightning daily count')
-    metrics['lightning_time'] = Gauge(name='ecowitt_lightning_time', documentation='Lightning last strike')
-    metrics['ws90'] = Gauge(name='ecowitt_wh90', documentation='WS90 electrical energy stored', labelnames=['sensor', 'unit'])
-    metrics['soilmoisture'] = Gauge(name='ecowitt_soilmoisture', documentation='Soil moisture', labelnames=['sensor', 'unit'])
-    metrics['last_report_timestamp'] = Gauge(
-        name='ecowitt_last_report_timestamp_seconds',
-        documentation='Unix timestamp of the most recent successful POST from the Ecowitt gateway to /report. Use `time() - ecowitt_last_report_timestamp_seconds > N` to detect a stale or offline gateway.'
-    )
-    # Seed with current time so the freshness alert does not fire immediately
-    # after an exporter restart (it gets a grace period equal to the alert
-    # `for:` duration before a real gateway push updates the value).
-    metrics['last_report_timestamp'].set(time.time())
+from config import Config
+from ingest import IngestPlan, parse_body, pm25_erroneous
+from recent import recent_payloads, seen_keys
+from snapshot import Snapshot, make_snapshot_app
+from stations import Stations, station_locations
+
+# Every metric a report can set, as (kind, metric, name, documentation,
+# labelnames). The station label comes first in all of them.
+METRICS = (
+    ('info', 'stationtype', 'ecowitt_stationtype', 'Ecowitt station type', ()),
+    ('info', 'freq', 'ecowitt_freq', 'Ecowitt radio frequency', ()),
+    ('info', 'model', 'ecowitt_model', 'Ecowitt model', ()),
+    ('gauge', 'temp', 'ecowitt_temp', 'Temperature', ('sensor', 'unit', 'location')),
+    ('gauge', 'humidity', 'ecowitt_humidity', 'Relative humidity', ('sensor', 'unit', 'location')),
+    ('gauge', 'winddir', 'ecowitt_winddir', 'Wind direction', ()),
+    ('gauge', 'uv', 'ecowitt_uv', 'UV index', ()),
+    ('gauge', 'pm25', 'ecowitt_pm25', 'PM2.5 concentration', ('series', 'sensor', 'unit')),
+    ('gauge', 'aqi', 'ecowitt_aqi', 'Air quality index', ('standard', 'sensor')),
+    ('gauge', 'pm10', 'ecowitt_pm10', 'PM10 concentration', ('series', 'sensor', 'unit')),
+    ('gauge', 'co2', 'ecowitt_co2', 'CO2 concentration', ('series', 'unit')),
+    ('gauge', 'batterystatus', 'ecowitt_batterystatus', 'Battery status', ('sensor',)),
+    ('gauge', 'batterylevel', 'ecowitt_batterylevel', 'Battery level', ('sensor',)),
+    ('gauge', 'batteryvoltage', 'ecowitt_batteryvoltage', 'Battery voltage', ('sensor', 'unit')),
+    ('gauge', 'solarradiation', 'ecowitt_solarradiation', 'Solar irradiance', ('unit',)),
+    ('gauge', 'barom', 'ecowitt_barom', 'Barometer', ('sensor', 'unit')),
+    ('gauge', 'vpd', 'ecowitt_vpd', 'Vapour pressure deficit', ('unit',)),
+    ('gauge', 'wind', 'ecowitt_windspeed', 'Wind speed', ('sensor', 'unit')),
+    ('gauge', 'wind_beaufort', 'ecowitt_windspeed_beaufort', 'Wind Beaufort scale', ()),
+    ('gauge', 'rain', 'ecowitt_rain', 'Rainfall', ('sensor', 'unit')),
+    ('gauge', 'rain_state', 'ecowitt_rain_state', 'Rain state (0=no rain, 1=rain)', ('sensor',)),
+    ('gauge', 'lightning', 'ecowitt_lightning', 'Lightning distance', ('unit',)),
+    ('gauge', 'lightning_num', 'ecowitt_lightning_num', 'Lightning daily count', ()),
+    ('gauge', 'lightning_time', 'ecowitt_lightning_time', 'Lightning last strike', ()),
+    ('gauge', 'ws90', 'ecowitt_wh90', 'WS90 electrical energy stored', ('sensor', 'unit')),
+    ('gauge', 'soilmoisture', 'ecowitt_soilmoisture', 'Soil moisture', ('sensor', 'unit')),
+)
+
+# Worked out from temperature and humidity, with DERIVED_METRICS
+DERIVED_METRICS = (
+    ('gauge', 'dewpoint', 'ecowitt_dewpoint', 'Dew point', ('sensor', 'unit', 'location')),
+    ('gauge', 'heatindex', 'ecowitt_heatindex', 'Heat index', ('sensor', 'unit', 'location')),
+    ('gauge', 'windchill', 'ecowitt_windchill', 'Wind chill', ('sensor', 'unit', 'location')),
+    ('gauge', 'feelslike', 'ecowitt_feelslike', 'Feels-like temperature', ('sensor', 'unit', 'location')),
+    ('gauge', 'absolute_humidity', 'ecowitt_absolute_humidity', 'Absolute humidity', ('sensor', 'unit', 'location')),
+)
+
+TIMESTAMP_METRICS = (
+    ('gauge', 'last_report_timestamp', 'ecowitt_last_report_timestamp_seconds',
+     'Unix timestamp of the most recent successful POST from the Ecowitt gateway to /report. '
+     'Use `time() - ecowitt_last_report_timestamp_seconds > N` to detect a stale or offline gateway.', ()),
 
     # Per-sensor last-seen timestamp. Updated whenever a specific sensor's
     # data appears in a push, so individual sensors can be monitored for
@@ -436,30 +72,466 @@ if __name__ == "__main__":
     # soilbatt*, pm25_ch* and pm25batt* in particular - both soil probes
     # losing radio sync (plants going unwatered) and WH41 PM2.5 sensors going
     # offline are real failure modes we want to alert on.
-    metrics['sensor_last_report_timestamp'] = Gauge(
-        name='ecowitt_sensor_last_report_timestamp_seconds',
-        documentation='Unix timestamp of the most recent report from a specific sensor. Use `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > N` to detect a stale individual sensor.',
-        labelnames=['sensor']
-    )
-
-    # Pre-seed per-sensor freshness timestamps for every sensor named in
-    # SENSORS_TO_TRACK. This ensures the metric exists for each expected
-    # sensor immediately at exporter startup, so staleness alerts like
-    # `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > 600`
-    # return a value (and can fire) even if the exporter restarted while the
-    # sensor was offline. Without seeding, the metric wouldn't exist until
-    # the sensor's first push, so `time() - <missing>` returns no data and
-    # the alert silently never fires. Seeding with `time.time()` gives a
-    # grace period equal to the alert's `for:` duration before it trips.
-    for sensor_name in sensors_to_track:
-        metrics['sensor_last_report_timestamp'].labels(sensor=sensor_name).set(time.time())
-
-    # Increase Flask logging if in debug mode
-    if debug:
-        app.logger.setLevel(logging.DEBUG)
+    ('gauge', 'sensor_last_report_timestamp', 'ecowitt_sensor_last_report_timestamp_seconds',
+     'Unix timestamp of the most recent report from a specific sensor. '
+     'Use `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > N` '
+     'to detect a stale individual sensor.', ('sensor',)),
+
+    # Most keys in a push are unchanged since the previous one, so their
+    # conversion is skipped. hits / lookups is how many.
+    ('counter', 'change_cache_hits', 'ecowitt_exporter_change_cache_hits',
+     'Report keys whose value was unchanged since the station last sent them, so were not converted again', ()),
+    ('counter', 'change_cache_lookups', 'ecowitt_exporter_change_cache_lookups',
+     'Report keys looked up in the change cache', ()),
+)
+
+# With SERIES_TTL or SERIES_TTLS
+EVICTION_METRICS = (
+    ('counter', 'evicted_series', 'ecowitt_evicted_series',
+     'Series dropped because they were not reported within their TTL', ('metric',)),
+)
+
+# With DISCOVER_KEYS
+DISCOVERY_METRICS = (
+    ('gauge', 'raw', 'ecowitt_raw', 'Value of a report key the exporter does not recognise', ('key',)),
+    ('counter', 'raw_evicted', 'ecowitt_raw_evicted_series',
+     'Series of ecowitt_raw dropped to keep within DISCOVER_MAX_SERIES', ()),
+)
+
+
+class Exporter:
+    '''
+    The metrics and everything that feeds them for one configuration:
+    stations and their ingest plans, and whichever of state saving, derived
+    metrics, aggregates, instrumentation, forwarding, eviction, discovery,
+    the ingest queue, polling and MQTT are turned on
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, config: Config):
+        self.config = config
+        self.debug = config.debug
+        self.logger = logging.getLogger('ecowitt_exporter')
+
+        # The latest value of every series is held in this snapshot, which
+        # /metrics serves from a cached rendering
+        self.metrics = Snapshot(common_labels=['station'])
+
+        # Set in multiprocess mode, to share the snapshot with the other workers
+        self.shared = None
+
+        self.state = None
+        if config.state_file:
+            from state import StateFile
+            self.state = StateFile(config.state_file, interval=config.state_interval, logger=self.logger, config=(
+                config.temperature_unit, config.pressure_unit, config.wind_unit, config.rain_unit,
+                config.distance_unit, config.irradiance_unit, config.aqi_standard,
+            ))
+
+        self.derived = None
+        if config.derived_metrics:
+            from derived import DerivedMetrics
+            self.derived = DerivedMetrics()
+
+        # Rolling aggregates over each of AGGREGATE_WINDOWS, labelled with the window
+        self.aggregator = None
+        if config.aggregate_windows:
+            from aggregates import Aggregator, Rule
+            self.aggregator = Aggregator(self.metrics, config.aggregate_windows, [
+                Rule('wind', 'mean', 'wind_avg', 'ecowitt_windspeed_avg', 'Mean wind speed', sensors=('windspeed',)),
+                Rule('wind', 'max', 'wind_max', 'ecowitt_windspeed_max', 'Maximum wind speed', sensors=('windspeed', 'windgust')),
+                Rule('winddir', 'vector_mean', 'winddir_avg', 'ecowitt_winddir_avg', 'Vector mean wind direction'),
+                Rule('rain', 'max', 'rain_max', 'ecowitt_rain_max', 'Maximum rain rate', sensors=('rate', 'rrain_piezo')),
+                Rule('temp', 'max', 'temp_max', 'ecowitt_temp_max', 'Maximum temperature'),
+                Rule('temp', 'min', 'temp_min', 'ecowitt_temp_min', 'Minimum temperature'),
+            ])
+
+        # The exporter's own metrics, in a prometheus_client registry of its own
+        self.instrumentation = None
+        if config.instrument:
+            from instrument import Instrumentation
+            self.instrumentation = Instrumentation()
+
+        # Pushes each report's series to PUSH_URL in the background
+        self.forwarder = None
+        if config.push_url:
+            from forward import Forwarder
+            self.forwarder = Forwarder(
+                self.metrics, config.push_url, job=config.push_job, interval=config.push_interval,
+                flush_size=config.push_flush_size, timeout=config.push_timeout,
+                queue_dir=config.push_queue_dir, queue_bytes=config.push_queue_bytes, logger=self.logger,
+            )
+
+        self.stations = Stations(default=config.station_id, passkeys=config.station_passkeys,
+                                 make_plan=self.make_plan, recent=config.recent_payloads_size,
+                                 max_stations=config.max_stations)
+
+        # Drops series that have not been reported for their TTL. Sensors named in
+        # SENSORS_TO_TRACK are expected to come back, so they are never dropped.
+        self.evictor = None
+        if config.series_ttl or any(config.series_ttls.values()):
+            from eviction import Evictor
+            self.evictor = Evictor(
+                self.metrics,
+                default_ttl=config.series_ttl,
+                ttls=config.series_ttls,
+                keep={'sensor': set(config.sensors_to_track)},
+                counter='evicted_series',
+                lock=lambda labels: self.stations.get(labels[0]).lock,
+                forget=self.aggregator.forget if self.aggregator else None,
+            )
+
+        # Caps the series of unrecognised keys exposed with DISCOVER_KEYS
+        self.discovery = None
+        if config.discover:
+            from discovery import Discovery
+            self.discovery = Discovery(self.metrics, config.discover_max_series, counter='raw_evicted')
+
+        self.ingest_queue = None
+        if config.ingest_mode == 'async':
+            from pipeline import IngestQueue
+            self.ingest_queue = IngestQueue(self.ingest, maxsize=config.ingest_queue_size, logger=self.logger)
+
+        # Polls POLL_GATEWAYS into the same ingest as /report
+        self.poller = None
+        if config.poll_gateways:
+            from poller import Poller
+            self.poller = Poller(config.poll_gateways, self.ingest, self.stations, interval=config.poll_interval,
+                                 timeout=config.poll_timeout, concurrency=config.poll_concurrency, logger=self.logger)
+
+        # Takes reports from MQTT_TOPICS on MQTT_URL into the same ingest as /report
+        self.subscriber = None
+        if config.mqtt_url:
+            from mqtt import Subscriber
+            self.subscriber = Subscriber(config.mqtt_url, config.mqtt_topics, self.ingest, self.stations,
+                                         qos=config.mqtt_qos, client_id=config.mqtt_client_id,
+                                         keepalive=config.mqtt_keepalive, batch_size=config.mqtt_batch_size,
+                                         logger=self.logger)
+
+        # Increase logging if in debug mode
+        if self.debug:
+            self.logger.setLevel(logging.DEBUG)
+
+    # pylint: disable=dangerous-default-value
+    def addmetric(self, metric: str, value: float, label: list = []):
+        '''
+        Set a metric in the Prometheus exporter
+        and optionally log a debug message.
+        '''
+        if self.debug:
+            self.logger.debug("Set Prometheus metric %s: %s", metric, value)
+        self.metrics.set(metric, tuple(label), value, time.time())
+
+    def make_plan(self, station: str) -> IngestPlan:
+        '''
+        Compiled handlers for each payload key from one station, see ingest.py
+        '''
+        config = self.config
+        return IngestPlan(
+            temperature_unit=config.temperature_unit,
+            pressure_unit=config.pressure_unit,
+            wind_unit=config.wind_unit,
+            rain_unit=config.rain_unit,
+            distance_unit=config.distance_unit,
+            irradiance_unit=config.irradiance_unit,
+            aqi_standard=config.aqi_standard,
+            locations=station_locations(station, config.environ, config.locations),
+            station=station,
+            snapshot=self.metrics,
+            discover=config.discover,
+        )
+
+    def setup_metrics(self):
+        '''
+        Set up various Prometheus metrics with descriptions and units
+        '''
+        metrics = self.metrics
+        metrics.declare(METRICS)
+        if self.derived:
+            metrics.declare(DERIVED_METRICS)
+        if self.discovery:
+            metrics.declare(DISCOVERY_METRICS)
+        if self.aggregator:
+            self.aggregator.setup()
+        metrics.declare(TIMESTAMP_METRICS)
+
+        # Put back everything the exporter knew before it was restarted,
+        # including the real last report times
+        if self.state and self.state.restore(metrics):
+            self.logger.info("Restored metrics from %s", self.config.state_file)
+
+        if self.evictor:
+            metrics.declare(EVICTION_METRICS)
+            self.evictor.track_all()
+        if self.discovery:
+            self.discovery.track_all()
+
+        # Seed with current time so the freshness alert does not fire immediately
+        # after an exporter restart (it gets a grace period equal to the alert
+        # `for:` duration before a real gateway push updates the value). Series
+        # restored from STATE_FILE keep their real time instead.
+        for station in self.stations.names():
+            if not metrics.has('last_report_timestamp', (station,)):
+                self.addmetric('last_report_timestamp', time.time(), [station])
+
+        # Pre-seed per-sensor freshness timestamps for every sensor named in
+        # SENSORS_TO_TRACK. This ensures the metric exists for each expected
+        # sensor immediately at exporter startup, so staleness alerts like
+        # `time() - ecowitt_sensor_last_report_timestamp_seconds{sensor="soilmoisture1"} > 600`
+        # return a value (and can fire) even if the exporter restarted while the
+        # sensor was offline. Without seeding, the metric wouldn't exist until
+        # the sensor's first push, so `time() - <missing>` returns no data and
+        # the alert silently never fires. Seeding with `time.time()` gives a
+        # grace period equal to the alert's `for:` duration before it trips.
+        for station in self.stations.names():
+            for sensor_name in self.config.sensors_to_track:
+                if metrics.has('sensor_last_report_timestamp', (station, sensor_name)):
+                    continue
+                self.addmetric('sensor_last_report_timestamp', time.time(), [station, sensor_name])
+
+    def share(self):
+        '''Share the metrics with other worker processes through MULTIPROC_DIR'''
+        import atexit
+        from shared import SharedSnapshot, clear_directory
+        clear_directory(self.config.multiproc_dir)
+        self.shared = SharedSnapshot(self.metrics, self.config.multiproc_dir,
+                                     deadline=self.evictor.deadline if self.evictor else None)
+        self.shared.save()
+        # In whichever process exits. Registered before any exit save to
+        # STATE_FILE, so that runs first and sees this process's series.
+        atexit.register(self.shared.close)
+
+    def ingest(self, station, data: dict, now: float):
+        '''
+        Apply one parsed payload from a station, received at `now`, to the metrics
+        '''
+        started = time.perf_counter()
+        if self.debug:
+            for key, value in data.items():
+                self.logger.debug("Received raw value %s: %s", key, value)
+            if pm25_erroneous(data):
+                self.logger.debug("Drop erroneous PM25 readings")
+
+        # Each key is looked up in the compiled plan and converted to the
+        # configured unit, unless it has the same value as last time
+        counts = [0, 0]
+        handles = []
+        instrumentation = self.instrumentation
+        if instrumentation:
+            timings = instrumentation.timings()
+            writes = station.plan.evaluate(data, now, timings, counts, handles)
+            instrumentation.observe_handlers(timings, data, station.plan)
+        else:
+            writes = station.plan.evaluate(data, now, counts=counts, handles=handles)
+
+        # Record the wall-clock time of this successful push from the gateway.
+        # Prometheus can then use `time() - ecowitt_last_report_timestamp_seconds`
+        # to detect a stale gateway (gauges persist their last value forever,
+        # so absent_over_time() on data metrics never fires if the gateway dies).
+        #
+        # Per-sensor timestamps are updated inline above as each sensor's key is
+        # processed, so individual sensor staleness can also be detected even when
+        # the gateway is otherwise healthy (e.g. a single soil probe goes offline
+        # or out of radio range).
+        writes.append(('last_report_timestamp', (station.name,), now))
+
+        if self.debug:
+            for metric, label, value in writes:
+                self.logger.debug("Set Prometheus metric %s%s: %s", metric, label, value)
+
+        # Add the results to the Prometheus exporter in one batch. Only pushes
+        # from the same station wait for each other.
+        metrics = self.metrics
+        with station.lock:
+            if self.derived:
+                writes.extend(self.derived.evaluate(station.plan, data))
+            if self.aggregator:
+                writes.extend(self.aggregator.update(writes, now))
+            metrics.inc('change_cache_hits', (station.name,), counts[0], now)
+            metrics.inc('change_cache_lookups', (station.name,), counts[1], now)
+            metrics.apply(writes, now, handles)
+            if self.discovery:
+                self.discovery.trim((station.name,), now, station.plan.forget)
+            if station.recent:
+                station.recent.add(now, time.perf_counter() - started, data)
+        if self.forwarder:
+            self.forwarder.add(station.name, writes)
+        if self.evictor:
+            self.evictor.sweep(now)
+        if self.shared:
+            self.shared.changed()
+        if self.state:
+            self.state.changed(self.current_snapshot)
+
+    def evict(self):
+        '''Drop expired series ahead of a scrape, in case no reports are coming in'''
+        if self.evictor.sweep(time.time()) and self.shared:
+            self.shared.changed()
+
+    def current_snapshot(self) -> Snapshot:
+        '''The snapshot as served on /metrics, including other workers' data'''
+        return self.shared.load() if self.shared else self.metrics
+
+
+def create_app(exporter: Exporter = None):
+    '''
+    The Flask app serving /report, the Weather Underground upload path, the
+    debug endpoints and /metrics for `exporter`. Without one, an exporter is
+    set up from the environment. The exporter is kept in
+    app.extensions['ecowitt'].
+    '''
+    from flask import Flask, abort, jsonify, request
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from wunderground import UPLOAD_PATH, parse_query
+
+    if exporter is None:
+        exporter = Exporter(Config())
+        exporter.setup_metrics()
+    config = exporter.config
+    stations = exporter.stations
+    instrumentation = exporter.instrumentation
+
+    app = Flask('ecowitt_exporter')
+    app.config['MAX_CONTENT_LENGTH'] = config.max_request_size
+    app.extensions['ecowitt'] = exporter
+
+    @app.route('/')
+    def version():
+        return "Ecowitt Exporter\n"
+
+    @app.before_request
+    def log_request_info():
+        # Only pay for reading the body and formatting the headers when the
+        # output is actually going somewhere
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug('Headers: %s', request.headers)
+            app.logger.debug('Body: %s', request.get_data())
+
+    @app.route('/report', methods=['POST'])
+    @app.route('/report/<station>', methods=['POST'])
+    def logecowitt(station: str = None):
+        started = time.perf_counter()
+
+        # Retrieve and parse the raw POST body, skipping Flask's form decoding
+        body = request.get_data()
+        return accept(station, body, parse_body(body), started, 'OK')
+
+    @app.route(UPLOAD_PATH)
+    def logwunderground():
+        started = time.perf_counter()
+
+        # Weather Underground uploads are a GET with the readings in the query
+        # string, read straight into Ecowitt's keys
+        query = request.query_string
+        return accept(None, query, parse_query(query), started, 'success')
+
+    def accept(station: str, body: bytes, data: dict, started: float, reply: str):
+        '''Ingest or queue a parsed report and answer the gateway'''
+        now = time.time()
+        name = station
+        station = stations.identify(data, name)
+        if station is None:
+            # A new name beyond MAX_STATIONS
+            app.logger.warning('Refused report from station %s, there are already MAX_STATIONS stations', name)
+            return app.response_class(response='Too many stations', status=403, mimetype='application/json')
+        if instrumentation:
+            instrumentation.observe_payload(body, data)
+
+        # Return a 200 to the weather station
+        response = app.response_class(
+                response=reply,
+                status=200,
+                mimetype='application/json'
+        )
+
+        if exporter.ingest_queue:
+            # Hand the report to the background thread. If it is too far behind,
+            # tell the gateway to come back later.
+            if not exporter.ingest_queue.submit(station, data, now):
+                response = app.response_class(
+                        response='Busy',
+                        status=503,
+                        headers={'Retry-After': str(config.retry_after)},
+                        mimetype='application/json'
+                )
+        else:
+            exporter.ingest(station, data, now)
+
+        if instrumentation:
+            instrumentation.report_seconds.observe(time.perf_counter() - started)
+        return response
+
+    def debug_stations() -> list:
+        '''Stations to show on a /debug endpoint, optionally picked with ?station='''
+        if not config.recent_payloads_size:
+            abort(404)
+        name = request.args.get('station')
+        if name:
+            if name not in stations.stations:
+                abort(404)
+            return [stations.stations[name]]
+        return list(stations.stations.values())
+
+    @app.route('/debug/recent')
+    def debug_recent():
+        '''The last RECENT_PAYLOADS payloads from each station, newest first'''
+        return jsonify({station.name: recent_payloads(station.recent) for station in debug_stations()})
+
+    @app.route('/debug/keys')
+    def debug_keys():
+        '''Every key each station has sent, with its last value and when it was first seen'''
+        return jsonify({station.name: seen_keys(station.plan, station.recent) for station in debug_stations()})
+
+    if instrumentation:
+        scrape_app = instrumentation.timed_app(make_snapshot_app(
+            exporter.shared or exporter.metrics, registry=instrumentation.registry,
+            before=exporter.evict if exporter.evictor else None))
+    else:
+        scrape_app = make_snapshot_app(exporter.shared or exporter.metrics,
+                                       before=exporter.evict if exporter.evictor else None)
 
     # Add prometheus wsgi middleware to route /metrics requests
     app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {
-        '/metrics': make_wsgi_app()
+        '/metrics': scrape_app
     })
-    app.run(host="0.0.0.0", port=8088, debug=debug)
+    return app
+
+
+def main():
+    config = Config()
+    config.show()
+
+    exporter = Exporter(config)
+    exporter.setup_metrics()
+
+    # Share metrics between worker processes. The poller and MQTT subscriber run
+    # in gunicorn's master process, so even a single worker needs to see their metrics.
+    if config.server == 'gunicorn' and (config.workers > 1 or exporter.poller or exporter.subscriber):
+        exporter.share()
+
+    if exporter.state:
+        exporter.state.save_at_exit(exporter.current_snapshot)
+
+    app = create_app(exporter)
+
+    # Not in the reloader's parent process, which only watches for changes
+    background = config.server == 'gunicorn' or not config.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    if exporter.poller and background:
+        exporter.poller.start()
+    if exporter.subscriber and background:
+        exporter.subscriber.start()
+
+    if config.server == 'gunicorn':
+        from server import serve
+        serve(app, port=8088, workers=config.workers, threads=config.threads,
+              keepalive=config.keepalive, max_request_size=config.max_request_size)
+    else:
+        # docker stop sends SIGTERM, which would otherwise end the process
+        # without running the exit save to STATE_FILE. gunicorn handles it
+        # itself.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        app.run(host="0.0.0.0", port=8088, debug=config.debug)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+'''
+Drop series that have stopped being reported.
+
+A sensor that is removed, renamed or moved to another location leaves its
+old series behind, and Prometheus would scrape them forever. Every series
+gets a deadline of its last update plus its metric's TTL, and a heap of
+deadlines says which series to look at next, so a sweep with nothing due
+costs one comparison. A series that was updated since its deadline was set
+goes back on the heap with a new one; one that was not is removed.
+'''
+import heapq
+import threading
+from snapshot import Snapshot
+
+
+class Evictor: # pylint: disable=too-many-instance-attributes
+    '''
+    Removes series from `snapshot` that have not been updated for their
+    metric's TTL: `ttls` by Prometheus metric name, otherwise `default_ttl`.
+    A TTL of 0 keeps a metric's series forever, as does a label in `keep`,
+    a dict of label name to the values to keep, e.g. {'sensor': {'wh51'}}.
+
+    Removals are counted in the `counter` metric, which must be declared
+    with a `metric` label, by the common labels of the removed series.
+    `lock`, if given, is called with a series' labels and returns the lock
+    its writers hold. `forget`, if given, is called with the metric and
+    key, the labels it was written with, of each removed series while that
+    lock is held.
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, snapshot: Snapshot, default_ttl: float, ttls: dict = None,
+                 keep: dict = None, counter: str = None, lock=None, forget=None):
+        self.snapshot = snapshot
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.keep = keep or {}
+        self.counter = counter
+        self.lock = lock
+        self.forget = forget
+        self.heap = []
+        self.heap_lock = threading.Lock()
+        snapshot.on_create = self.track
+
+    def ttl(self, metric: str) -> float:
+        '''TTL in seconds of a metric's series, 0 if they never expire'''
+        family = self.snapshot.families[metric]
+        if family.kind == 'counter':
+            return 0
+        return self.ttls.get(family.name, self.default_ttl)
+
+    def kept(self, metric: str, labels: tuple) -> bool:
+        '''Whether a series is exempt because of one of its labels'''
+        for name, value in zip(self.snapshot.families[metric].labelnames, labels):
+            if value in self.keep.get(name, ()):
+                return True
+        return False
+
+    def deadline(self, metric: str, sample) -> float:
+        '''When a series expires unless it is updated again, or None if it never does'''
+        ttl = self.ttl(metric)
+        if ttl <= 0 or self.kept(metric, sample.labels):
+            return None
+        return sample.updated + ttl
+
+    def track(self, metric: str, key: tuple, sample):
+        '''Start watching a new series'''
+        deadline = self.deadline(metric, sample)
+        if deadline is None:
+            return
+        with self.heap_lock:
+            heapq.heappush(self.heap, (deadline, metric, key))
+
+    def track_all(self):
+        '''Start watching every series already in the snapshot, e.g. restored ones'''
+        for metric, family in list(self.snapshot.families.items()):
+            for key, sample in list(family.samples.items()):
+                self.track(metric, key, sample)
+
+    def sweep(self, now: float) -> int:
+        '''Remove every series whose TTL has run out, returning how many'''
+        evicted = 0
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            with self.heap_lock:
+                if not heap or heap[0][0] > now:
+                    break
+                _deadline, metric, key = heapq.heappop(heap)
+            if self.expire(metric, key, now):
+                evicted += 1
+        if evicted:
+            self.snapshot.changed()
+        return evicted
+
+    def expire(self, metric: str, key: tuple, now: float) -> bool:
+        '''Remove one series if it is still stale, or watch it again if not'''
+        family = self.snapshot.families[metric]
+        sample = family.samples.get(key)
+        if sample is None:
+            return False
+        lock = self.lock(sample.labels) if self.lock else None
+        if lock:
+            lock.acquire()
+        try:
+            # Looked up again, as it may have been written to since
+            sample = family.samples.get(key)
+            if sample is None:
+                return False
+            deadline = sample.updated + self.ttl(metric)
+            if deadline > now:
+                with self.heap_lock:
+                    heapq.heappush(self.heap, (deadline, metric, key))
+                return False
+            self.snapshot.remove(metric, key)
+            if self.forget:
+                self.forget(metric, key)
+            if self.counter:
+                common = sample.labels[:len(self.snapshot.common_labels)]
+                self.snapshot.inc(self.counter, common + (family.name,), 1, now)
+        finally:
+            if lock:
+                lock.release()
+        return True
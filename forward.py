@@ -0,0 +1,215 @@
+'''
+Push the metrics to a Pushgateway, for exporters that Prometheus cannot
+scrape, e.g. behind NAT.
+
+Each report's writes are noted as the latest value of their series, which
+takes a lock and a few dict updates, never any I/O. A background thread
+pushes the series noted since the last push every `interval` seconds, or
+sooner once `flush_size` writes are waiting, as one gzipped POST per
+station over a kept-alive connection. Each station is its own Pushgateway
+group, so a push replaces only that station's metrics of the same names.
+
+Pushes that fail are kept in a directory and sent again, oldest first,
+before anything newer, so a station's older state never replaces a newer
+one. The directory is capped at `queue_bytes`, dropping the oldest pushes.
+A process claims a push by renaming it while it sends it, and pushes
+claimed by a process that died are put back when pushing starts.
+'''
+import glob
+import gzip
+import http.client
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote, urlsplit
+from prometheus_client.utils import floatToGoString
+from ingest import INFO
+from keepalive import KeepAlive
+from pipeline import ProcessThread
+from shared import alive
+from snapshot import Snapshot, escape
+
+
+class Forwarder:
+    '''
+    Pushes series from `snapshot`'s families to the Pushgateway at `url`
+    under `job`, waiting at most `timeout` seconds for it to answer. Failed
+    pushes are queued in `queue_dir`.
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-instance-attributes
+    def __init__(self, snapshot: Snapshot, url: str, job: str = 'ecowitt', interval: float = 15,
+                 flush_size: int = 1000, timeout: float = 10, queue_dir: str = '/tmp/ecowitt-push',
+                 queue_bytes: int = 10 * 1024 * 1024, logger: logging.Logger = None):
+        self.snapshot = snapshot
+        parts = urlsplit(url)
+        self.connection = KeepAlive(parts.hostname, parts.port, timeout, tls=parts.scheme == 'https')
+        self.base = f'{parts.path.rstrip("/")}/metrics/job/{quote(job, safe="")}'
+        self.interval = interval
+        self.flush_size = flush_size
+        self.timeout = timeout
+        self.queue_dir = queue_dir
+        self.queue_bytes = queue_bytes
+        self.logger = logger or logging.getLogger(__name__)
+        # Station name to {(metric, series key): (labels, value)}
+        self.pending = {}
+        self.waiting = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pusher = ProcessThread(self.run, 'forward', setup=self.prepare)
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def prepare(self):
+        '''Get this process ready to push, before its pushing thread starts'''
+        # Anything noted before a fork is the parent's to push
+        self.pending = {}
+        self.waiting = 0
+        # The parent's connection, which only the parent may use
+        self.connection.close()
+        os.makedirs(self.queue_dir, exist_ok=True)
+        self.reclaim()
+
+    def add(self, station: str, writes: list):
+        '''Note the (metric, labels, value) writes of a report from `station` for the next push'''
+        self.pusher.ensure()
+        with self.lock:
+            series = self.pending.get(station)
+            if series is None:
+                series = self.pending[station] = {}
+            for metric, labels, value in writes:
+                # An Info metric's value is its last label
+                series[(metric, labels[:-1] if value is INFO else labels)] = (labels, value)
+            self.waiting += len(writes)
+            if self.waiting >= self.flush_size:
+                self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception: # pylint: disable=broad-exception-caught
+                self.logger.exception("Failed to push metrics")
+
+    def flush(self):
+        '''Push everything queued, then everything noted since the last push'''
+        with self.lock:
+            pending, self.pending, self.waiting = self.pending, {}, 0
+        delivering = self.retry()
+        for station, series in pending.items():
+            path = f'{self.base}/station/{quote(station, safe="")}'
+            body = gzip.compress(self.render(series), 6)
+            if not (delivering and self.send(path, body)):
+                delivering = False
+                self.enqueue(path, body)
+
+    def render(self, series: dict) -> bytes:
+        '''Text exposition of the given series, without their common labels'''
+        common = len(self.snapshot.common_labels)
+        families = {}
+        for (metric, _key), sample in series.items():
+            families.setdefault(metric, []).append(sample)
+        lines = []
+        for metric, samples in families.items():
+            family = self.snapshot.families[metric]
+            kind = family.kind
+            name = family.name
+            if kind == 'info':
+                name, kind = name + '_info', 'gauge'
+            elif kind == 'counter':
+                name += '_total'
+            lines.append(f'# HELP {name} {escape(family.documentation)}\n# TYPE {name} {kind}\n')
+            labelnames = family.labelnames[common:]
+            for labels, value in samples:
+                pairs = ','.join(f'{labelname}="{escape(str(label))}"' for labelname, label in zip(labelnames, labels[common:]))
+                value = '1.0' if value is INFO else floatToGoString(value)
+                lines.append(f'{name}{{{pairs}}} {value}\n' if pairs else f'{name} {value}\n')
+        return ''.join(lines).encode()
+
+    def send(self, path: str, body: bytes) -> bool:
+        '''
+        POST a gzipped push, returning False if it should be tried again
+        later. Pushes the Pushgateway rejects as invalid are dropped.
+        '''
+        headers = {'Content-Type': 'text/plain; version=0.0.4', 'Content-Encoding': 'gzip'}
+        try:
+            status, _body = self.connection.request('POST', path, body, headers)
+        except (http.client.HTTPException, OSError) as error:
+            self.logger.warning("Push to %s failed: %s", path, error)
+            self.failed += 1
+            return False
+        if status >= 500:
+            self.logger.warning("Push to %s failed: HTTP %d", path, status)
+            self.failed += 1
+            return False
+        if status >= 300:
+            self.logger.warning("Push to %s rejected, dropping it: HTTP %d", path, status)
+            self.dropped += 1
+        else:
+            self.sent += 1
+        return True
+
+    def enqueue(self, path: str, body: bytes):
+        '''Keep a failed push to send again, dropping the oldest if over queue_bytes'''
+        name = os.path.join(self.queue_dir, f'{time.time_ns():020d}-{os.getpid()}.push')
+        with open(name + '.tmp', 'wb') as f:
+            f.write(path.encode() + b'\n' + body)
+        os.replace(name + '.tmp', name)
+        queued = []
+        for queued_path in sorted(glob.glob(os.path.join(self.queue_dir, '*.push'))):
+            try:
+                queued.append((queued_path, os.path.getsize(queued_path)))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _path, size in queued)
+        for queued_path, size in queued:
+            if total <= self.queue_bytes:
+                break
+            try:
+                os.remove(queued_path)
+                self.dropped += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def reclaim(self):
+        '''
+        Put back pushes claimed by a process that died while sending them,
+        and remove any it was still writing, so none are left out of the
+        queue or its size
+        '''
+        for name in glob.glob(os.path.join(self.queue_dir, '*.push.*')):
+            queued, _, suffix = name.rpartition('.')
+            writing = suffix == 'tmp'
+            # Pushes are written to <time>-<pid>.push.tmp and claimed as <name>.push.<pid>
+            pid = os.path.basename(queued)[:-len('.push')].rpartition('-')[2] if writing else suffix
+            if not pid.isdigit() or alive(int(pid)):
+                continue
+            try:
+                if writing:
+                    os.remove(name)
+                else:
+                    os.rename(name, queued)
+            except FileNotFoundError:
+                pass
+
+    def retry(self) -> bool:
+        '''Send queued pushes, oldest first. Returns whether they all went.'''
+        for name in sorted(glob.glob(os.path.join(self.queue_dir, '*.push'))):
+            # Claim it, in case another worker is retrying too
+            claimed = f'{name}.{os.getpid()}'
+            try:
+                os.rename(name, claimed)
+                with open(claimed, 'rb') as f:
+                    path, _, body = f.read().partition(b'\n')
+            except FileNotFoundError:
+                continue
+            if not self.send(path.decode(), body):
+                os.rename(claimed, name)
+                return False
+            os.remove(claimed)
+        return True
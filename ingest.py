@@ -0,0 +1,517 @@
+'''
+Compile Ecowitt payload keys into cached handlers.
+
+The gateway sends the same set of keys on every push, so the branch logic
+that decides what a key means only needs to run once per key. The result is
+a Handler holding every metric write for that key with its labels, unit
+conversion and location already bound.
+'''
+# pylint: disable=too-many-instance-attributes,too-many-arguments,too-many-positional-arguments,too-many-return-statements
+from time import perf_counter, time
+from urllib.parse import unquote_plus
+from conversions import mph2kmh_float, mph2ms_float, mph2kts_float, mph2fps_float, in2mm_float, km2mi_float, inhg2hpa_float, inhg2mmhg_float, wm22lux_float, wm22fc_float, f2c_float, f2k_float, aqi_function, aqi_standards, mph2beaufort
+
+# Sentinel converters understood by the code that applies a Handler.
+# INFO sets an Info metric from the raw value, STAMP sets the time of the push,
+# RAW sets the raw value of a discovered key if it is a number.
+INFO = object()
+STAMP = object()
+RAW = object()
+
+# Ignore these fields
+IGNORED_KEYS = ('PASSKEY', 'dateutc', 'runtime')
+
+# Handler categories of keys that do not set any metric
+IGNORED = 'ignored'
+UNKNOWN = 'unknown'
+
+# Handlers of keys that are not recognised are only cached for this many keys
+# in each plan, so a client posting made-up keys cannot grow it without end
+MAX_UNKNOWN_KEYS = 100
+
+# Sensors that can be given a physical location label
+LOCATION_KEYS = ('outdoor', 'indoor', 'co2', 'temp1', 'temp2', 'temp3', 'temp4', 'temp5', 'temp6', 'temp7', 'temp8')
+
+# Support for WS90 with a haptic rain sensor
+rainmaps = {
+        "rrain_piezo": "rainrate",
+        "erain_piezo": "eventrain",
+        "hrain_piezo": "hourlyrain",
+        "drain_piezo": "dailyrain",
+        "wrain_piezo": "weeklyrain",
+        "mrain_piezo": "monthlyrain",
+        "yrain_piezo": "yearlyrain",
+        "last24hrain_piezo": "last24hrain"
+}
+
+def calculate_aqi(standard: str, value: float):
+    '''
+    Calculate AQI (air quality index) using various
+    different national standards.
+    '''
+    return aqi_standards[standard](value)
+
+def parse_body(body: bytes, keys: dict = None) -> dict:
+    '''
+    Parse an urlencoded Ecowitt POST body into a flat dict in one pass.
+    Like request.form, the first value wins if a key is repeated, but no
+    multidict is built and only the few values that need it are unquoted.
+
+    If `keys` is given, keys found in it are renamed to their value there,
+    or dropped if that is None, so another protocol's fields can be read
+    straight into Ecowitt's.
+    '''
+    data = {}
+    for pair in body.decode('utf-8', 'replace').split('&'):
+        if not pair:
+            continue
+        key, _, value = pair.partition('=')
+        if '%' in pair or '+' in pair:
+            key = unquote_plus(key)
+            value = unquote_plus(value)
+        if keys is not None and key in keys:
+            key = keys[key]
+            if key is None:
+                continue
+        if key not in data:
+            data[key] = value
+    return data
+
+def pm25_erroneous(data) -> bool:
+    '''
+    Check for invalid readings from the WH41 PM2.5 sensor when the battery is low
+    https://github.com/djjudas21/ecowitt-exporter/issues/17
+    If we find bad data, the entire PM2.5 section of the push is skipped.
+    '''
+    return (data.get('pm25batt1') == '1' and data.get('pm25_ch1') == '1000') or (data.get('pm25batt2') == '1' and data.get('pm25_ch2') == '1000')
+
+
+class Handler:
+    '''
+    Everything needed to apply one payload key. `writes` is a tuple of
+    (metric, labels, convert) where convert is a float converter taking the
+    parsed value, None to use the parsed value as-is, or one of INFO, STAMP
+    and RAW.
+    `pm25` marks keys that are dropped by pm25_erroneous(). `category`
+    groups handlers for instrumentation: the first metric written, or
+    IGNORED or UNKNOWN for keys that write nothing.
+    '''
+    __slots__ = ('key', 'writes', 'pm25', 'category', 'first_seen')
+
+    def __init__(self, key: str, writes: tuple = (), pm25: bool = False):
+        self.key = key
+        self.writes = writes
+        self.pm25 = pm25
+        # Handlers are compiled the first time their key is seen
+        self.first_seen = time()
+        if writes:
+            self.category = writes[0][0]
+        else:
+            self.category = IGNORED if key in IGNORED_KEYS else UNKNOWN
+
+    def __repr__(self):
+        return f'Handler({self.key!r}, {self.writes!r}, pm25={self.pm25})'
+
+
+class IngestPlan:
+    '''
+    Cache of compiled Handlers, one per payload key, for one set of unit and
+    location settings. Keys are compiled on first sight; after that handling
+    a key is a single dict lookup. Beyond `max_unknown` keys that are not
+    recognised, any more are compiled again each time they are seen.
+    '''
+
+    def __init__(self, temperature_unit: str = 'c', pressure_unit: str = 'hpa',
+                 wind_unit: str = 'kmh', rain_unit: str = 'mm',
+                 distance_unit: str = 'km', irradiance_unit: str = 'wm2',
+                 aqi_standard: str = 'uk', locations: dict = None,
+                 station: str = None, snapshot=None, discover=None, max_unknown: int = MAX_UNKNOWN_KEYS):
+        self.temperature_unit = temperature_unit
+        self.pressure_unit = pressure_unit
+        self.wind_unit = wind_unit
+        self.rain_unit = rain_unit
+        self.distance_unit = distance_unit
+        self.irradiance_unit = irradiance_unit
+        self.aqi_standard = aqi_standard
+        self.locations = dict.fromkeys(LOCATION_KEYS)
+        self.locations.update(locations or {})
+        # If set, every series gets the station name as its first label
+        self.station = station
+        # If set, called with each key that is not recognised to tell whether
+        # to expose it as it is, see discovery.py
+        self.discover = discover
+        self.handlers = {}
+        self.max_unknown = max_unknown
+        self.unknown = 0
+        # Each key's last raw value, Handler, resolved writes and the Samples
+        # they go to, once they have all been set, for keys with a cached Handler
+        self.last = {}
+        # The Snapshot the writes are applied to, and its epoch when the
+        # Samples were looked up
+        self.snapshot = snapshot
+        self.epoch = None
+
+    def handler(self, key: str) -> Handler:
+        '''Return the Handler for a key, compiling it on first use'''
+        try:
+            return self.handlers[key]
+        except KeyError:
+            try:
+                writes, pm25 = self.compile(key)
+            except (KeyError, ValueError):
+                # A key that looks like one of a kind but is not, e.g. a new
+                # *_piezo rain total, is an error unless it is discovered
+                writes, pm25 = self.unrecognised(key), False
+                if not writes:
+                    raise
+            if self.station is not None:
+                prefix = (self.station,)
+                writes = tuple((metric, prefix + labels, convert) for metric, labels, convert in writes)
+            handler = Handler(key, writes, pm25)
+            if handler.category == UNKNOWN:
+                if self.unknown >= self.max_unknown:
+                    return handler
+                self.unknown += 1
+            self.handlers[key] = handler
+            return handler
+
+    def forget(self, key: str):
+        '''Drop a key's Handler and last value, e.g. once its series are removed'''
+        handler = self.handlers.pop(key, None)
+        if handler is not None and handler.category == UNKNOWN:
+            self.unknown -= 1
+        self.last.pop(key, None)
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def evaluate(self, data: dict, now: float, timings: dict = None, counts: list = None,
+                 handles: list = None) -> list:
+        '''
+        Resolve a whole payload to a list of (metric, labels, value) writes,
+        with every value already converted to a float in the configured
+        unit. Info metrics come out as (metric, labels + (raw value,), INFO).
+
+        Most keys arrive with the same raw value as last time, so each key's
+        writes are kept with the value they came from and reused as they
+        are while it stays the same. Only the push timestamps are new.
+
+        If `timings` is given, the seconds spent on each handler category
+        and the number of keys in it are added to it as [seconds, keys].
+        If `counts` is given, the number of keys whose value was unchanged
+        and of all keys are added to it as [unchanged, keys].
+        If `handles` is given, the snapshot's epoch and then the Sample of
+        each write, as far as they are known, are added to it for
+        Snapshot.apply(). A key's writes set the same series whatever its
+        value, so its Samples are looked up once, after it is first set, and
+        kept until the epoch moves on.
+        '''
+        drop_pm25 = pm25_erroneous(data)
+        handlers = self.handlers
+        last = self.last
+        unchanged = 0
+        writes = []
+        append = writes.append
+        if handles is not None:
+            epoch = self.snapshot.epoch
+            if epoch != self.epoch:
+                # Some Samples may have been removed since they were looked up
+                for key, entry in list(last.items()):
+                    last[key] = entry[:4] + (None,)
+                self.epoch = epoch
+            handles.append(epoch)
+        if timings is not None:
+            last_tick = perf_counter()
+        for key, value in data.items():
+            cached = last.get(key)
+            if cached is not None and cached[0] == value:
+                _, handler, resolved, stamps, samples = cached
+                unchanged += 1
+            else:
+                handler = handlers.get(key) or self.handler(key)
+                resolved, stamps = self.resolve(handler, value)
+                # Discovered keys have no writes while their value is not a number
+                samples = cached[4] if cached is not None and len(cached[2]) == len(resolved) else None
+                if key in handlers:
+                    last[key] = (value, handler, resolved, stamps, samples)
+            if handler.pm25 and drop_pm25:
+                continue
+            if handles is not None:
+                if samples is None:
+                    samples = self.bind(resolved, stamps)
+                    if None not in samples and key in handlers:
+                        last[key] = (value, handler, resolved, stamps, samples)
+                handles.extend(samples)
+            writes.extend(resolved)
+            for metric, labels in stamps:
+                append((metric, labels, now))
+            if timings is not None:
+                # One clock read per key, charging each key with the time
+                # since the previous one
+                tick = perf_counter()
+                timing = timings.get(handler.category)
+                if timing is None:
+                    timing = timings[handler.category] = [0.0, 0]
+                timing[0] += tick - last_tick
+                timing[1] += 1
+                last_tick = tick
+        if counts is not None:
+            counts[0] += unchanged
+            counts[1] += len(data)
+        return writes
+
+    def bind(self, resolved: tuple, stamps: tuple) -> tuple:
+        '''
+        The Sample of each of a key's writes in the snapshot, None for any
+        not set yet, and False for Info writes, as their series is replaced
+        whenever the value changes
+        '''
+        handle = self.snapshot.handle
+        samples = [False if value is INFO else handle(metric, labels) for metric, labels, value in resolved]
+        samples.extend(handle(metric, labels) for metric, labels in stamps)
+        return tuple(samples)
+
+    @staticmethod
+    def resolve(handler: Handler, value: str) -> tuple:
+        '''
+        A handler's writes for one raw value, as the (metric, labels, value)
+        writes and the (metric, labels) of the writes that take the time
+        '''
+        writes = []
+        stamps = []
+        number = None
+        for metric, labels, convert in handler.writes:
+            if convert is STAMP:
+                stamps.append((metric, labels))
+            elif convert is INFO:
+                writes.append((metric, labels + (value,), INFO))
+            elif convert is RAW:
+                try:
+                    writes.append((metric, labels, float(value)))
+                except ValueError:
+                    pass
+            else:
+                if number is None:
+                    number = float(value)
+                writes.append((metric, labels, convert(number) if convert else number))
+        return tuple(writes), tuple(stamps)
+
+    def converter(self, kind: str):
+        '''Return the converter from Ecowitt's native unit for a quantity, or None'''
+        match kind:
+            case 'temperature':
+                return {'c': f2c_float, 'k': f2k_float}.get(self.temperature_unit)
+            case 'pressure':
+                return {'hpa': inhg2hpa_float, 'mmhg': inhg2mmhg_float}.get(self.pressure_unit)
+            case 'wind':
+                return {'kmh': mph2kmh_float, 'ms': mph2ms_float, 'knots': mph2kts_float, 'fps': mph2fps_float}.get(self.wind_unit)
+            case 'rain':
+                return in2mm_float if self.rain_unit == 'mm' else None
+            case 'irradiance':
+                return {'lx': wm22lux_float, 'fc': wm22fc_float}.get(self.irradiance_unit)
+            case 'distance':
+                return km2mi_float if self.distance_unit == 'mi' else None
+            case 'aqi':
+                return aqi_function(self.aqi_standard)
+        return None
+
+    def compile(self, key: str) -> tuple:
+        '''
+        Resolve a payload key to its metric writes. This is the branch chain
+        that used to run for every key of every push, so the order of the
+        tests matters and must be preserved.
+        Returns a tuple of (writes, pm25).
+        '''
+        temperature_unit = self.temperature_unit
+        pressure_unit = self.pressure_unit
+        locations = self.locations
+
+        # Ignore these fields
+        if key in IGNORED_KEYS:
+            return (), False
+
+        # Add these fields as INFO
+        elif key in ['stationtype', 'freq', 'model']:
+            return ((key, (), INFO),), False
+
+        # No conversions needed
+        elif key in ['winddir', 'uv', 'lightning_num', 'lightning_time']:
+            return ((key, (), None),), False
+
+        # Support for WS90 capacitor
+        elif key in ['ws90cap_volt']:
+            return (('ws90', (key, 'volt'), None),), False
+
+        # Battery status & levels
+        elif 'batt' in key:
+            # Battery level - returns battery level from 0-5
+            if key in ['wh57batt', 'pm25batt1', 'pm25batt2']:
+                writes = [('batterylevel', (key,), None)]
+                # The WH41 PM2.5 sensor can drop off the radio and we want to
+                # alert on that independently of the gateway.
+                if key.startswith('pm25batt'):
+                    writes.append(('sensor_last_report_timestamp', (key,), STAMP))
+                return tuple(writes), False
+            # Battery voltage - returns a decimal voltage e.g. 1.7
+            elif key.startswith('soil') or key.startswith('ws90'):
+                writes = [('batteryvoltage', (key, 'volt'), None)]
+                if key.startswith('soilbatt'):
+                    writes.append(('sensor_last_report_timestamp', (key,), STAMP))
+                return tuple(writes), False
+            # Battery status - returns 0 for OK and 1 for low
+            else:
+                return (('batterystatus', (key,), None),), False
+
+        # Soil moisture
+        elif key.startswith('soilmoisture'):
+            return (('soilmoisture', (key, 'percent'), None),
+                    ('sensor_last_report_timestamp', (key,), STAMP)), False
+
+        # WH45 CO2/AQI multi-sensor (tf_co2, humi_co2, pm25_co2,
+        # pm25_24h_co2, pm10_co2, pm10_24h_co2, co2, co2_24h)
+        # Must be checked BEFORE the generic pm25 handler.
+        elif key == 'tf_co2':
+            location = locations.get('co2') or 'co2'
+            return (('temp', ('co2', temperature_unit, location), self.converter('temperature')),
+                    ('sensor_last_report_timestamp', ('co2',), STAMP)), False
+
+        elif key == 'humi_co2':
+            location = locations.get('co2') or 'co2'
+            return (('humidity', ('co2', 'percent', location), None),), False
+
+        elif key == 'pm25_co2':
+            return (('pm25', ('realtime', 'co2', 'μgm3'), None),), False
+
+        elif key == 'pm25_24h_co2':
+            return (('pm25', ('avg_24h', 'co2', 'μgm3'), None),
+                    ('aqi', (self.aqi_standard, 'co2'), self.converter('aqi'))), False
+
+        elif key == 'pm10_co2':
+            return (('pm10', ('realtime', 'co2', 'μgm3'), None),), False
+
+        elif key == 'pm10_24h_co2':
+            return (('pm10', ('avg_24h', 'co2', 'μgm3'), None),), False
+
+        elif key == 'co2':
+            return (('co2', ('realtime', 'ppm'), None),), False
+
+        elif key == 'co2_24h':
+            return (('co2', ('avg_24h', 'ppm'), None),), False
+
+        # PM25 (WH41 channel sensors)
+        # 'pm25_ch1', 'pm25_avg_24h_ch1'
+        elif key.startswith('pm25'):
+            # Drop PM25 prefix, then get & drop sensor ch suffix
+            name = key.replace('pm25_', '')
+            if len(name) < 3 or name[-3:-1] != 'ch' or not name[-1].isdigit():
+                raise ValueError(f'Unrecognised PM2.5 key {key}')
+            sensor = name[-3:]
+            name = name[:-3]
+
+            # Generate series label
+            series = 'avg_24h' if name.startswith('avg_24h') else 'realtime'
+            writes = [('pm25', (series, sensor, 'μgm3'), None)]
+
+            # Per-sensor last-seen timestamp. Only update on the realtime
+            # series; avg_24h is a derived rollup and doesn't represent a
+            # fresh sensor push.
+            if series == 'realtime':
+                writes.append(('sensor_last_report_timestamp', (key,), STAMP))
+
+            # Calculate AQI from PM25
+            if name.startswith('avg_24h'):
+                writes.append(('aqi', (self.aqi_standard, sensor), self.converter('aqi')))
+            return tuple(writes), True
+
+        # Humidity - no conversion needed
+        elif key.startswith('humidity'):
+            match key:
+                case 'humidity':
+                    label = 'outdoor'
+                    location = locations.get('outdoor') or label
+                case 'humidityin':
+                    label = 'indoor'
+                    location = locations.get('indoor') or label
+                case _:
+                    label = f'ch{key[-1]}'
+                    location = locations[f'temp{key[-1]}']
+            return (('humidity', (label, 'percent', location), None),), False
+
+        # Solar irradiance, default W/m^2
+        elif key in ['solarradiation']:
+            return (('solarradiation', (self.irradiance_unit,), self.converter('irradiance')),), False
+
+        # Temperature, default Fahrenheit
+        # 'tempinf', 'tempf', 'temp1f', 'temp2f', 'temp3f', 'temp4f', 'temp5f', 'temp6f', 'temp7f', 'temp8f'
+        elif key.startswith('temp'):
+            # Strip trailing f
+            name = key[:-1]
+            if name == 'tempin':
+                label = 'indoor'
+                location = locations.get('indoor') or label
+            elif name == 'temp':
+                label = 'outdoor'
+                location = locations.get('outdoor') or label
+            else:
+                label = f'ch{name[-1]}'
+                location = locations[f'temp{name[-1]}']
+            return (('temp', (label, temperature_unit, location), self.converter('temperature')),), False
+
+        # Pressure, default inches Hg
+        elif key.startswith('barom'):
+            # Remove 'in' suffix
+            name = key[:-2]
+            if name == 'baromrel':
+                label = 'relative'
+            elif name == 'baromabs':
+                label = 'absolute'
+            else:
+                raise ValueError(f'Unrecognised pressure key {key}')
+            return (('barom', (label, pressure_unit), self.converter('pressure')),), False
+
+        # VPD, default inches Hg
+        elif key in ['vpd']:
+            return (('vpd', (pressure_unit,), self.converter('pressure')),), False
+
+        # Wind speed, default mph
+        elif key in ['windspeedmph', 'windgustmph', 'maxdailygust']:
+            convert = self.converter('wind')
+            writes = []
+            if key == 'windspeedmph':
+                # The Beaufort number is taken from the converted speed
+                if convert:
+                    writes.append(('wind_beaufort', (), lambda value: mph2beaufort(convert(value))))
+                else:
+                    writes.append(('wind_beaufort', (), mph2beaufort))
+            name = key if key == 'maxdailygust' else key[:-3]
+            writes.append(('wind', (name, self.wind_unit), convert))
+            return tuple(writes), False
+
+        # Support for WS90 with a haptic rain sensor (rain state)
+        elif key == 'srain_piezo':
+            # Rain state: 0 = no rain, 1 = rain
+            return (('rain_state', (key,), None),), False
+
+        # Support for WS90 with a haptic rain sensor (cumulative rain amounts)
+        elif key.endswith('piezo'):
+            if key not in rainmaps:
+                raise KeyError(key)
+            return (('rain', (key, self.rain_unit), self.converter('rain')),), False
+
+        # Rainfall, default inches
+        elif 'rain' in key:
+            # 'rainratein', 'eventrainin', 'hourlyrainin', 'dailyrainin', 'weeklyrainin', 'monthlyrainin', 'yearlyrainin', 'totalrainin'
+            name = key[:-2].replace('rain', '')
+            return (('rain', (name, self.rain_unit), self.converter('rain')),), False
+
+        # Lightning distance, default kilometers
+        elif key in ['lightning']:
+            if self.distance_unit in ('km', 'mi'):
+                return (('lightning', (self.distance_unit,), self.converter('distance')),), False
+
+        # Anything else is not recognised, and dropped unless it is discovered
+        return self.unrecognised(key), False
+
+    def unrecognised(self, key: str) -> tuple:
+        '''Writes for a key that is not recognised: its raw value if it is discovered, else none'''
+        if self.discover is not None and self.discover(key):
+            return (('raw', (key,), RAW),)
+        return ()
@@ -0,0 +1,130 @@
+'''
+The exporter's own metrics: how long reports and scrapes take, how big
+payloads are, where ingest time goes and which keys are not understood.
+
+These are ordinary prometheus_client metrics, in a registry of each
+exporter's own so that several exporters can be set up in one process,
+and are rendered fresh on every scrape after the cached weather metrics.
+In multiprocess mode each scrape shows the worker that served it.
+'''
+import threading
+import time
+from prometheus_client import REGISTRY, CollectorRegistry, Histogram
+from prometheus_client.core import CounterMetricFamily
+from ingest import UNKNOWN
+
+# Label for unknown keys beyond the first `max_unknown_keys`
+OTHER_KEY = '(other)'
+
+
+class Instrumentation: # pylint: disable=too-many-instance-attributes
+    '''
+    Self-instrumentation metrics, in a new `registry` that this is also a
+    collector for, and which also collects `base`, e.g. the process metrics
+    in the default registry. At most `max_unknown_keys` distinct keys get
+    their own ecowitt_unknown_key_total series; any more are counted
+    together.
+
+    Timing every key costs more than the rest put together, so handler
+    timings are only taken from one report in `sample_every`.
+    '''
+
+    def __init__(self, base: CollectorRegistry = REGISTRY, max_unknown_keys: int = 50, sample_every: int = 10):
+        registry = self.registry = CollectorRegistry(auto_describe=False)
+        registry.register(base)
+        self.report_seconds = Histogram(
+            'ecowitt_exporter_report_seconds', 'Time spent handling a report',
+            buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1),
+            registry=registry,
+        )
+        self.render_seconds = Histogram(
+            'ecowitt_exporter_render_seconds', 'Time spent serving a scrape of /metrics',
+            buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1),
+            registry=registry,
+        )
+        self.payload_bytes = Histogram(
+            'ecowitt_exporter_payload_bytes', 'Size of report bodies',
+            buckets=(256, 512, 1024, 2048, 4096, 8192, 16384, 65536),
+            registry=registry,
+        )
+        self.payload_keys = Histogram(
+            'ecowitt_exporter_payload_keys', 'Number of keys in a report',
+            buckets=(10, 20, 40, 60, 80, 100, 150, 200),
+            registry=registry,
+        )
+        # Added to on every report, so kept as plain numbers behind one lock
+        # and only turned into metrics when scraped, see collect()
+        self.handlers = {}
+        self.unknown = {}
+        self.max_unknown_keys = max_unknown_keys
+        self.sample_every = sample_every
+        self.reports = 0
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe_payload(self, body: bytes, data: dict):
+        '''Record the size of a report'''
+        self.payload_bytes.observe(len(body))
+        self.payload_keys.observe(len(data))
+
+    def timings(self):
+        '''
+        A dict for IngestPlan.evaluate() to collect handler timings in, or
+        None if this report is not one of the ones sampled
+        '''
+        self.reports += 1
+        if self.reports % self.sample_every:
+            return None
+        return {}
+
+    def observe_handlers(self, timings, data: dict, plan):
+        '''
+        Record the timings that IngestPlan.evaluate() collected for a
+        payload, if any, and count the keys in it that `plan` did not
+        recognise.
+        '''
+        # Read without the station lock, which discovery may be dropping
+        # handlers under, so a key without one counts as not recognised
+        handlers = plan.handlers
+        unknown = [key for key in data if (handler := handlers.get(key)) is None or handler.category == UNKNOWN]
+        if not timings and not unknown:
+            return
+        with self.lock:
+            totals = self.handlers
+            for category, (seconds, keys) in (timings or {}).items():
+                total = totals.get(category)
+                if total is None:
+                    totals[category] = [seconds, keys]
+                else:
+                    total[0] += seconds
+                    total[1] += keys
+            for key in unknown:
+                if key not in self.unknown and len(self.unknown) >= self.max_unknown_keys:
+                    key = OTHER_KEY
+                self.unknown[key] = self.unknown.get(key, 0) + 1
+
+    def collect(self):
+        with self.lock:
+            handlers = {category: tuple(total) for category, total in self.handlers.items()}
+            unknown = dict(self.unknown)
+        seconds = CounterMetricFamily('ecowitt_exporter_handler_seconds', 'Time spent converting keys in sampled reports, by the metric they set', labels=['category'])
+        keys = CounterMetricFamily('ecowitt_exporter_handler_keys', 'Keys converted in sampled reports, by the metric they set', labels=['category'])
+        for category, (spent, count) in handlers.items():
+            seconds.add_metric([category], spent)
+            keys.add_metric([category], count)
+        yield seconds
+        yield keys
+        metric = CounterMetricFamily('ecowitt_unknown_key', 'Report keys the exporter does not recognise and drops', labels=['key'])
+        for key, count in unknown.items():
+            metric.add_metric([key], count)
+        yield metric
+
+    def timed_app(self, wsgi_app):
+        '''Wrap the /metrics WSGI app to record how long each scrape takes'''
+        def app(environ, start_response):
+            started = time.perf_counter()
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                self.render_seconds.observe(time.perf_counter() - started)
+        return app
@@ -0,0 +1,52 @@
+'''
+A kept-alive HTTP connection, as the poller holds to each gateway and the
+forwarder to the Pushgateway.
+
+Servers close connections that sit idle, which only shows up when the
+next request on one fails, so a request that fails that way is sent once
+more on a new connection before the failure counts.
+'''
+import http.client
+
+
+class KeepAlive:
+    '''
+    One HTTP connection to `host`:`port`, opened when first needed and
+    again after it fails, waiting at most `timeout` seconds for answers.
+    Only one thread may use it at a time.
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, host: str, port: int = None, timeout: float = 10, tls: bool = False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection_class = http.client.HTTPSConnection if tls else http.client.HTTPConnection
+        self.connection = None
+
+    def request(self, method: str, path: str, body: bytes = None, headers: dict = None) -> tuple:
+        '''
+        Send a request and return the (status, body) of the response. Any
+        error closes the connection and is raised, except the server having
+        closed it while idle the first time, when the request is sent again.
+        '''
+        for attempt in (1, 2):
+            if self.connection is None:
+                self.connection = self.connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                self.connection.request(method, path, body, headers or {})
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.close()
+                if attempt == 2:
+                    raise
+            except Exception:
+                self.close()
+                raise
+        raise http.client.HTTPException('No response')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
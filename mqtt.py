@@ -0,0 +1,335 @@
+'''
+Take reports from an MQTT broker, for fleets that bridge their gateways'
+uploads onto MQTT instead of posting them to each exporter's /report.
+
+Each message is the urlencoded body of an Ecowitt report. It goes through
+the same parsing and ingest as /report, with the station named by the
+topic: the level matched by the first + or # in the topic filter it came
+in on, e.g. ecowitt/garden on ecowitt/+. A filter without a wildcard leaves
+the station to the report's PASSKEY, as /report does. Reports naming a new
+station once there are MAX_STATIONS are dropped, as /report refuses them.
+
+This is a subscribe-only MQTT 3.1.1 client on one long-lived connection.
+A client library such as paho-mqtt would be a dependency for the few
+packets a subscriber needs, and calls back once per message, where the
+exporter wants a whole read at a time and to acknowledge only what it has
+ingested. Whatever has arrived is read and parsed in
+one go, up to `batch_size` messages, and each station's latest report in
+the batch is ingested. With QoS 1 the session is kept by the broker while
+the connection is down, and messages are only acknowledged once ingested,
+so none are lost to a reconnect. Connections that fail are opened again,
+backing off exponentially up to `max_backoff` seconds. Retained messages
+are skipped, as they are reports from before the exporter subscribed.
+'''
+import logging
+import os
+import re
+import select
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+from ingest import parse_body
+
+# Packet types, in the high nibble of a packet's first byte
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+RECV_SIZE = 256 * 1024
+
+
+def string(value: str) -> bytes:
+    '''A UTF-8 string as MQTT encodes it, with its length first'''
+    encoded = value.encode('utf-8')
+    return len(encoded).to_bytes(2, 'big') + encoded
+
+
+def packet(kind: int, body: bytes = b'', flags: int = 0) -> bytes:
+    '''A whole packet: type and flags, remaining length and body'''
+    header = bytearray([kind << 4 | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+def split_packets(buffer: bytearray) -> list:
+    '''
+    Every complete packet at the start of `buffer`, as (first byte, body),
+    removing them from it. An incomplete one is left for more to arrive.
+    '''
+    packets = []
+    position = 0
+    size = len(buffer)
+    while size - position >= 2:
+        length = 0
+        index = position + 1
+        for shift in (0, 7, 14, 21):
+            if index >= size:
+                break
+            byte = buffer[index]
+            index += 1
+            length |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                break
+        else:
+            raise ConnectionError('Malformed packet length')
+        if byte & 0x80 or index + length > size:
+            break
+        packets.append((buffer[position], bytes(buffer[index:index + length])))
+        position = index + length
+    del buffer[:position]
+    return packets
+
+
+def read_publish(first: int, body: bytes) -> tuple:
+    '''The topic, packet id (None at QoS 0) and payload of a PUBLISH'''
+    length = int.from_bytes(body[:2], 'big')
+    topic = body[2:2 + length].decode('utf-8', 'replace')
+    offset = 2 + length
+    packet_id = None
+    if first >> 1 & 3:
+        packet_id = body[offset:offset + 2]
+        offset += 2
+    return topic, packet_id, body[offset:]
+
+
+def topic_pattern(topic_filter: str) -> re.Pattern:
+    '''A regular expression matching the topics of a filter, capturing its wildcards'''
+    pattern = ''
+    for index, level in enumerate(topic_filter.split('/')):
+        separator = '/' if index else ''
+        if level == '#':
+            # Also matches the level above, e.g. ecowitt/# matches ecowitt
+            pattern += f'(?:{separator}(.*))?' if index else '(.*)'
+            break
+        pattern += separator + ('([^/]*)' if level == '+' else re.escape(level))
+    return re.compile(pattern + r'\Z')
+
+
+class Subscriber: # pylint: disable=too-many-instance-attributes
+    '''
+    Subscribes to `topics` on the broker at `url`, mqtt:// or mqtts://
+    with an optional user:password@, and passes each report to `ingest`
+    with its Station from `stations` and the time its batch was received.
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, url: str, topics: list, ingest, stations, qos: int = 0,
+                 client_id: str = 'ecowitt-exporter', keepalive: int = 60, batch_size: int = 1000,
+                 max_backoff: float = 300, logger: logging.Logger = None):
+        parts = urlsplit(url)
+        self.tls = parts.scheme == 'mqtts'
+        self.host = parts.hostname
+        self.port = parts.port or (8883 if self.tls else 1883)
+        self.username = unquote(parts.username) if parts.username else None
+        self.password = unquote(parts.password) if parts.password else None
+        self.topics = list(topics)
+        self.patterns = [topic_pattern(topic) for topic in self.topics]
+        self.ingest = ingest
+        self.stations = stations
+        self.qos = min(qos, 1)
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self.socket = None
+        self.buffer = bytearray()
+        # Messages and acknowledgements that came in while connecting
+        self.early = ([], [])
+        self.packet_id = 0
+        # When the unanswered ping was sent, if there is one
+        self.pinged = None
+        self.running = False
+        self.stopped = threading.Event()
+        self.connects = 0
+        self.messages = 0
+        self.batches = 0
+        self.errors = 0
+        # Held while a batch is ingested, and taken before forking, as in Poller
+        self.gate = threading.Lock()
+
+    def start(self):
+        '''Connect and take reports in the background'''
+        self.running = True
+        os.register_at_fork(before=self.gate.acquire, after_in_parent=self.gate.release,
+                            after_in_child=self.gate.release)
+        threading.Thread(target=self.run, name='mqtt', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        # The connection may close, and run() let go of it, at any point here
+        sock = self.socket
+        if sock:
+            try:
+                sock.sendall(packet(DISCONNECT))
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        failures = 0
+        while self.running:
+            try:
+                self.connect()
+                failures = 0
+                self.consume()
+            except OSError as error:
+                if not self.running:
+                    break
+                self.errors += 1
+                failures += 1
+                delay = min(2 ** (failures - 1), self.max_backoff)
+                self.logger.warning("MQTT connection to %s:%s failed, retrying in %.0fs: %s",
+                                    self.host, self.port, delay, error)
+                self.stopped.wait(delay)
+            finally:
+                if self.socket:
+                    self.socket.close()
+                    self.socket = None
+
+    def connect(self):
+        '''Connect, subscribe and wait for the broker to confirm both'''
+        sock = socket.create_connection((self.host, self.port), timeout=self.keepalive)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+        self.socket = sock
+        self.buffer = bytearray()
+        self.early = ([], [])
+
+        # At QoS 1 the broker keeps the session, so nothing is lost while disconnected
+        flags = 0x00 if self.qos else 0x02
+        payload = string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += string(self.password)
+        sock.sendall(packet(CONNECT, string('MQTT') + bytes([4, flags]) + self.keepalive.to_bytes(2, 'big') + payload))
+        body = self.expect(CONNACK)
+        if len(body) < 2 or body[1] != 0:
+            raise ConnectionRefusedError(f'Broker refused the connection with code {body[1:2].hex()}')
+
+        self.packet_id = self.packet_id % 65535 + 1
+        sock.sendall(packet(SUBSCRIBE, self.packet_id.to_bytes(2, 'big') + b''.join(
+            string(topic) + bytes([self.qos]) for topic in self.topics), flags=2))
+        body = self.expect(SUBACK)
+        if 0x80 in body[2:]:
+            raise ConnectionRefusedError(f'Broker refused to subscribe to {",".join(self.topics)}')
+        self.connects += 1
+        self.logger.info("Connected to MQTT broker %s:%s, subscribed to %s", self.host, self.port, ','.join(self.topics))
+
+    def expect(self, kind: int) -> bytes:
+        '''Read until a packet of `kind` arrives and return its body'''
+        found = None
+        while found is None:
+            chunk = self.socket.recv(RECV_SIZE)
+            if not chunk:
+                raise ConnectionResetError('Broker closed the connection')
+            self.buffer += chunk
+            for first, body in split_packets(self.buffer):
+                if first >> 4 == kind and found is None:
+                    found = body
+                else:
+                    self.handle(first, body, *self.early)
+        return found
+
+    def handle(self, first: int, body: bytes, messages: list, acks: list):
+        '''Take the message of a PUBLISH into `messages`, and its acknowledgement into `acks`'''
+        kind = first >> 4
+        if kind == PUBLISH:
+            topic, packet_id, payload = read_publish(first, body)
+            if packet_id is not None:
+                acks.append(packet(PUBACK, packet_id))
+            if not first & 1:
+                messages.append((topic, payload))
+        elif kind == PINGRESP:
+            self.pinged = None
+
+    def consume(self):
+        '''Ingest messages in batches until the connection fails or stop() is called'''
+        sock = self.socket
+        sock.settimeout(self.keepalive / 2)
+        messages, acks = self.early
+        self.pinged = None
+        sent = time.monotonic()
+        while self.running:
+            if messages:
+                self.apply(messages)
+            if acks:
+                sock.sendall(b''.join(acks))
+                sent = time.monotonic()
+            messages = []
+            acks = []
+
+            # The broker drops clients that send nothing for the keepalive,
+            # and a ping that is not answered within it means the broker is gone
+            now = time.monotonic()
+            if self.pinged is not None and now - self.pinged > self.keepalive:
+                raise TimeoutError('Broker did not answer a ping')
+            if self.pinged is None and now - sent >= self.keepalive / 2:
+                sock.sendall(packet(PINGREQ))
+                self.pinged = sent = now
+
+            try:
+                chunk = sock.recv(RECV_SIZE)
+            except TimeoutError:
+                continue
+            while True:
+                if not chunk:
+                    raise ConnectionResetError('Broker closed the connection')
+                self.buffer += chunk
+                for first, body in split_packets(self.buffer):
+                    self.handle(first, body, messages, acks)
+                # Take whatever else has arrived already into the same batch
+                if len(messages) >= self.batch_size or not (
+                        self.tls and sock.pending() or select.select([sock], [], [], 0)[0]):
+                    break
+                chunk = sock.recv(RECV_SIZE)
+
+    def station_name(self, topic: str) -> str:
+        '''The station a topic names, or None to work it out from the report'''
+        for pattern in self.patterns:
+            match = pattern.match(topic)
+            if match:
+                return next((group for group in match.groups() if group), None)
+        return None
+
+    def apply(self, messages: list):
+        '''Ingest a batch of (topic, payload) messages, the latest from each station'''
+        now = time.time()
+        latest = {}
+        refused = set()
+        for topic, payload in messages:
+            data = parse_body(payload)
+            name = self.station_name(topic)
+            station = self.stations.identify(data, name)
+            if station is None:
+                refused.add(name)
+                continue
+            latest[station.name] = (station, data)
+        if refused:
+            self.logger.warning("Refused MQTT reports from %d stations beyond MAX_STATIONS, e.g. %s",
+                                len(refused), next(iter(refused)))
+        with self.gate:
+            for station, data in latest.values():
+                try:
+                    self.ingest(station, data, now)
+                except Exception: # pylint: disable=broad-exception-caught
+                    self.logger.exception("Failed to ingest MQTT report from station %s", station.name)
+        self.messages += len(messages)
+        self.batches += 1
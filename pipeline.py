@@ -0,0 +1,90 @@
+'''
+Asynchronous ingest: /report queues the parsed payload and returns at once,
+and a single consumer thread applies queued payloads to the metrics.
+
+The queue is bounded. When it is full the caller is told so, and /report
+answers 503 with Retry-After rather than piling up request threads. The
+consumer drains everything queued in one go and keeps only the latest
+payload from each station, so a burst costs one apply per station.
+
+ProcessThread starts such a background thread on first use in each process,
+which the forwarder uses for its pushing thread too.
+'''
+import logging
+import os
+import queue
+import threading
+
+
+class ProcessThread:
+    '''
+    A daemon thread running `target`, started by ensure() the first time it
+    is called in each process. Servers load the app before forking their
+    workers, and a forked worker has none of its parent's threads, so
+    each worker starts its own when it first needs it. `setup`, if given,
+    is called first, in the new process, before the thread starts.
+    '''
+
+    def __init__(self, target, name: str, setup=None):
+        self.target = target
+        self.name = name
+        self.setup = setup
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def ensure(self):
+        '''Start the thread unless it is already running in this process'''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.setup:
+                self.setup()
+            threading.Thread(target=self.target, name=self.name, daemon=True).start()
+            self.pid = os.getpid()
+
+
+class IngestQueue:
+    '''
+    Bounded queue of (station, data, received time) feeding `apply`, which
+    is called with the same three arguments from the consumer thread.
+    '''
+
+    def __init__(self, apply, maxsize: int = 1000, logger: logging.Logger = None):
+        self.apply = apply
+        self.queue = queue.Queue(maxsize)
+        self.logger = logger or logging.getLogger(__name__)
+        self.consumer = ProcessThread(self.run, 'ingest')
+
+    def submit(self, station, data: dict, now: float) -> bool:
+        '''Queue a payload, returning False if the queue is full'''
+        self.consumer.ensure()
+        try:
+            self.queue.put_nowait((station, data, now))
+        except queue.Full:
+            return False
+        return True
+
+    def drain(self) -> list:
+        '''
+        Wait for a payload, then take everything else already queued and
+        return the latest (station, data, now) for each station.
+        '''
+        station, data, now = self.queue.get()
+        latest = {station.name: (station, data, now)}
+        while True:
+            try:
+                station, data, now = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            latest[station.name] = (station, data, now)
+        return list(latest.values())
+
+    def run(self):
+        while True:
+            for station, data, now in self.drain():
+                try:
+                    self.apply(station, data, now)
+                except Exception: # pylint: disable=broad-exception-caught
+                    self.logger.exception("Failed to ingest report from station %s", station.name)
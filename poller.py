@@ -0,0 +1,235 @@
+'''
+Poll gateways' local HTTP API instead of waiting for them to push.
+
+Ecowitt gateways serve their live readings as JSON on /get_livedata_info,
+in whatever units they are set to display. Each response is turned into
+the same keys and imperial units as a pushed report, so it goes through
+exactly the same ingest as /report.
+
+A small pool of threads polls any number of gateways. Each gateway keeps
+one keep-alive connection, which only one poll uses at a time, and is
+polled again `interval` seconds after its last poll started. Failures back
+off exponentially up to `max_backoff` seconds.
+'''
+import heapq
+import http.client
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from keepalive import KeepAlive
+
+# Factors to the units of the Ecowitt push protocol, by the unit the
+# gateway reports in
+TO_INHG = {'hpa': 1 / 33.8639, 'inhg': 1.0, 'mmhg': 1 / 25.4, 'kpa': 10 / 33.8639}
+TO_MPH = {'mph': 1.0, 'km/h': 1 / 1.60934, 'm/s': 2.237, 'knots': 1.151, 'ft/s': 1 / 1.467}
+TO_IN = {'in': 1.0, 'mm': 1 / 25.4, 'in/hr': 1.0, 'mm/hr': 1 / 25.4}
+TO_WM2 = {'w/m2': 1.0, 'lux': 0.0079, 'klux': 7.9, 'fc': 1 / 6.345}
+TO_KM = {'km': 1.0, 'mi': 1.60934}
+
+# common_list ids and their push keys, by the kind of value
+COMMON = {
+    '0x02': ('tempf', 'temperature'),
+    '0x07': ('humidity', 'number'),
+    '0x0A': ('winddir', 'number'),
+    '0x0B': ('windspeedmph', 'wind'),
+    '0x0C': ('windgustmph', 'wind'),
+    '0x19': ('maxdailygust', 'wind'),
+    '0x15': ('solarradiation', 'irradiance'),
+    '0x17': ('uv', 'number'),
+    '5': ('vpd', 'pressure'),
+}
+RAIN = {
+    '0x0D': 'eventrainin', '0x0E': 'rainratein', '0x0F': 'hourlyrainin', '0x10': 'dailyrainin',
+    '0x11': 'weeklyrainin', '0x12': 'monthlyrainin', '0x13': 'yearlyrainin',
+}
+PIEZO_RAIN = {
+    '0x0D': 'erain_piezo', '0x0E': 'rrain_piezo', '0x0F': 'hrain_piezo', '0x10': 'drain_piezo',
+    '0x11': 'wrain_piezo', '0x12': 'mrain_piezo', '0x13': 'yrain_piezo', 'srain_piezo': 'srain_piezo',
+}
+CO2 = {
+    'temperature': ('tf_co2', 'temperature'), 'humidity': ('humi_co2', 'number'),
+    'PM25': ('pm25_co2', 'number'), 'PM25_24H': ('pm25_24h_co2', 'number'),
+    'PM10': ('pm10_co2', 'number'), 'PM10_24H': ('pm10_24h_co2', 'number'),
+    'CO2': ('co2', 'number'), 'CO2_24H': ('co2_24h', 'number'),
+}
+
+
+def split_value(value: str, unit: str = None) -> tuple:
+    '''
+    Split a reading such as "1013.2 hPa" or "65%" into its number and
+    lower-case unit, which can also be given separately
+    '''
+    match = re.match(r'\s*(-?[\d.]+)\s*(.*)', str(value))
+    if not match:
+        raise ValueError(f'Unrecognised reading {value!r}')
+    return float(match.group(1)), (unit or match.group(2)).strip().lower()
+
+
+def to_protocol(kind: str, value, unit: str = None) -> str:
+    '''A gateway reading as the string a pushed report would have'''
+    number, unit = split_value(value, unit)
+    match kind:
+        case 'temperature':
+            if unit.lstrip('°') == 'c':
+                number = number * 9/5 + 32
+        case 'pressure':
+            number *= TO_INHG[unit]
+        case 'wind':
+            number *= TO_MPH[unit]
+        case 'rain':
+            number *= TO_IN[unit]
+        case 'irradiance':
+            number *= TO_WM2[unit]
+        case 'distance':
+            number *= TO_KM[unit]
+    return f'{number:.4f}'.rstrip('0').rstrip('.')
+
+
+def livedata_payload(livedata: dict) -> dict:
+    '''
+    Turn a /get_livedata_info response into the keys and units of a pushed
+    report. Readings the exporter has no metric for are left out.
+    '''
+    data = {}
+
+    def put(key, kind, value, unit=None):
+        try:
+            data[key] = to_protocol(kind, value, unit)
+        except (KeyError, ValueError):
+            pass
+
+    for item in livedata.get('common_list', []):
+        if item.get('id') in COMMON:
+            key, kind = COMMON[item['id']]
+            put(key, kind, item.get('val'), item.get('unit'))
+    for item in livedata.get('rain', []):
+        if item.get('id') in RAIN:
+            put(RAIN[item['id']], 'rain', item.get('val'))
+    for item in livedata.get('piezoRain', []):
+        if item.get('id') in PIEZO_RAIN:
+            put(PIEZO_RAIN[item['id']], 'number' if item['id'] == 'srain_piezo' else 'rain', item.get('val'))
+    for item in livedata.get('wh25', []):
+        put('tempinf', 'temperature', item.get('intemp'), item.get('unit'))
+        put('humidityin', 'number', item.get('inhumi'))
+        put('baromabsin', 'pressure', item.get('abs'))
+        put('baromrelin', 'pressure', item.get('rel'))
+    for item in livedata.get('ch_aisle', []):
+        channel = item.get('channel')
+        put(f'temp{channel}f', 'temperature', item.get('temp'), item.get('unit'))
+        put(f'humidity{channel}', 'number', item.get('humidity'))
+    for item in livedata.get('ch_soil', []):
+        put(f'soilmoisture{item.get("channel")}', 'number', item.get('humidity'))
+    for item in livedata.get('ch_pm25', []):
+        channel = item.get('channel')
+        put(f'pm25_ch{channel}', 'number', item.get('PM25'))
+        put(f'pm25_avg_24h_ch{channel}', 'number', item.get('PM25_24H'))
+    for item in livedata.get('co2', []):
+        for field, (key, kind) in CO2.items():
+            if field in item:
+                put(key, kind, item[field], item.get('unit') if kind == 'temperature' else None)
+    for item in livedata.get('lightning', []):
+        put('lightning', 'distance', item.get('distance'))
+        put('lightning_num', 'number', item.get('count'))
+    return data
+
+
+class Gateway:
+    '''One polled gateway, its kept-alive connection and how often it has failed in a row'''
+    __slots__ = ('name', 'host', 'port', 'connection', 'failures')
+
+    def __init__(self, name: str, host: str, port: int = 80, timeout: float = 5):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.connection = KeepAlive(host, port, timeout)
+        self.failures = 0
+
+
+class Poller:
+    '''
+    Polls `gateways`, (station, host, port) tuples, every `interval`
+    seconds with `concurrency` threads, waiting at most `timeout` seconds
+    for each. Each result is passed to `ingest` with the Station from
+    `stations` and the time it was received.
+    '''
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-instance-attributes
+    def __init__(self, gateways: list, ingest, stations, interval: float = 10, timeout: float = 5,
+                 concurrency: int = 4, max_backoff: float = 300, logger: logging.Logger = None):
+        self.gateways = [Gateway(name, host, port, timeout) for name, host, port in gateways]
+        self.ingest = ingest
+        self.stations = stations
+        self.interval = interval
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self.due = []
+        self.condition = threading.Condition()
+        self.running = False
+        self.polls = 0
+        self.errors = 0
+        # Held while a result is ingested. A process that forks while
+        # polling, like gunicorn's master starting workers, takes it first so
+        # no lock used by ingest can be copied into a child while held.
+        self.gate = threading.Lock()
+
+    def start(self):
+        '''Start polling in the background'''
+        self.running = True
+        os.register_at_fork(before=self.gate.acquire, after_in_parent=self.gate.release,
+                            after_in_child=self.gate.release)
+        now = time.monotonic()
+        with self.condition:
+            # Spread the first polls over the interval rather than all at once
+            for index, gateway in enumerate(self.gateways):
+                self.due.append((now + self.interval * index / len(self.gateways), index, gateway))
+            heapq.heapify(self.due)
+        threading.Thread(target=self.run, name='poller', daemon=True).start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix='poll') as pool:
+            while True:
+                with self.condition:
+                    while self.running and (not self.due or self.due[0][0] > time.monotonic()):
+                        self.condition.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                    if not self.running:
+                        break
+                    started, index, gateway = heapq.heappop(self.due)
+                pool.submit(self.poll, gateway, started, index)
+
+    def poll(self, gateway: Gateway, started: float, index: int):
+        '''Poll one gateway, then schedule its next poll'''
+        try:
+            data = livedata_payload(self.fetch(gateway))
+            with self.gate:
+                self.ingest(self.stations.get(gateway.name), data, time.time())
+            gateway.failures = 0
+            delay = self.interval
+        except Exception as error: # pylint: disable=broad-exception-caught
+            self.errors += 1
+            gateway.failures += 1
+            delay = min(self.interval * 2 ** gateway.failures, self.max_backoff)
+            self.logger.warning("Polling gateway %s failed, retrying in %.0fs: %s", gateway.name, delay, error)
+        self.polls += 1
+        with self.condition:
+            # Keep to the schedule, unless the poll took longer than the interval
+            heapq.heappush(self.due, (max(started + delay, time.monotonic()), index, gateway))
+            self.condition.notify()
+
+    @staticmethod
+    def fetch(gateway: Gateway) -> dict:
+        '''GET /get_livedata_info over the gateway's kept-alive connection'''
+        status, body = gateway.connection.request('GET', '/get_livedata_info')
+        if status != 200:
+            raise http.client.HTTPException(f'HTTP {status}')
+        return json.loads(body)
@@ -0,0 +1,62 @@
+'''
+The last few payloads from each station, for /debug/recent and /debug/keys.
+
+Recording a payload is one write into a preallocated slot, so it stays on
+all the time, unlike DEBUG logging. Everything else, including working out
+the last value of every key, happens when a debug endpoint is requested.
+'''
+
+# Payload keys that are never shown
+MASKED_KEYS = ('PASSKEY',)
+
+
+class Ring:
+    '''Fixed-size ring buffer of (received time, processing seconds, payload)'''
+    __slots__ = ('slots', 'size', 'index')
+
+    def __init__(self, size: int):
+        self.slots = [None] * size
+        self.size = size
+        self.index = 0
+
+    def add(self, received: float, duration: float, data: dict):
+        '''Record a payload, overwriting the oldest one if the ring is full'''
+        index = self.index
+        self.slots[index % self.size] = (received, duration, data)
+        self.index = index + 1
+
+    def entries(self) -> list:
+        '''Every recorded payload, newest first'''
+        index = self.index
+        count = min(index, self.size)
+        return [self.slots[(index - 1 - i) % self.size] for i in range(count)]
+
+
+def masked(data: dict) -> dict:
+    return {key: ('***' if key in MASKED_KEYS else value) for key, value in data.items()}
+
+
+def recent_payloads(ring: Ring) -> list:
+    '''A station's recent payloads, newest first, as JSON-ready dicts'''
+    return [
+        {'received': received, 'duration_seconds': duration, 'payload': masked(data)}
+        for received, duration, data in ring.entries()
+    ]
+
+
+def seen_keys(plan, ring: Ring) -> dict:
+    '''
+    Every key a station's IngestPlan has seen, with when it was first seen,
+    the metric it sets, and its last value if it is still in the ring.
+    '''
+    last = {}
+    for _received, _duration, data in reversed(ring.entries()):
+        last.update(data)
+    return {
+        key: {
+            'first_seen': handler.first_seen,
+            'category': handler.category,
+            'last_value': '***' if key in MASKED_KEYS else last.get(key),
+        }
+        for key, handler in sorted(plan.handlers.items())
+    }
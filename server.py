@@ -0,0 +1,45 @@
+'''
+Production serving mode, using gunicorn instead of Flask's development
+server. gunicorn is only imported if this mode is used.
+'''
+from gunicorn.app.base import BaseApplication
+
+
+class ExporterServer(BaseApplication):
+    '''Run a WSGI app under gunicorn with settings given as a dict'''
+
+    def __init__(self, application, options: dict):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+    def init(self, parser, opts, args):
+        pass
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def serve(application, port: int, workers: int, threads: int, keepalive: int, max_request_size: int):
+    '''
+    Serve `application` with `workers` processes of `threads` threads each.
+    Connections are kept alive for `keepalive` seconds between requests.
+    Request lines and headers are capped to match `max_request_size`.
+    '''
+    options = {
+        'bind': f'0.0.0.0:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'keepalive': keepalive,
+        'limit_request_line': min(max_request_size, 8190),
+        'limit_request_field_size': min(max_request_size, 8190),
+        'accesslog': None,
+        'errorlog': '-',
+    }
+    ExporterServer(application, options).run()
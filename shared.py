@@ -0,0 +1,271 @@
+'''
+Share the metrics snapshot between worker processes.
+
+With more than one worker, a report lands in one process and the scrape
+that should see it may land in another. Each worker dumps its own Snapshot
+to a file of its own in a shared directory, replacing the file atomically,
+and /metrics in any worker merges all of the files, keeping the most
+recently updated value of every series.
+
+Dumping the whole snapshot costs far more than a report, so a worker saves
+its file at most every SAVE_INTERVAL seconds while it is changing, and
+before it serves a scrape. A worker that exits merges its series into the
+retired file, which is merged like a worker's, so they are still served
+and saved to STATE_FILE once it is gone. The file of a worker that was
+killed is removed, and series past their TTL are left out of the merge,
+as only the worker that wrote them could evict them.
+'''
+import fcntl
+import glob
+import marshal
+import math
+import os
+import threading
+import time
+from snapshot import Snapshot, Sample, Family
+
+FORMAT_VERSION = 2
+
+# Most seconds a worker's changes wait before other workers can see them
+SAVE_INTERVAL = 1.0
+
+# Series of workers that have exited
+RETIRED = 'retired.snapshot'
+
+
+def clear_directory(directory: str):
+    '''Remove snapshot files left behind by a previous run'''
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.snapshot')):
+        os.remove(path)
+
+
+def dumps(snapshot: Snapshot, extra=None) -> bytes:
+    '''
+    Serialise every sample of a snapshot, with its last update time. `extra`
+    is stored alongside and returned by loads().
+    '''
+    families = {}
+    for metric, family in list(snapshot.families.items()):
+        families[metric] = [
+            (key, sample.labels, sample.value, sample.updated)
+            for key, sample in list(family.samples.items())
+        ]
+    return marshal.dumps((FORMAT_VERSION, families, extra))
+
+
+def loads(data: bytes):
+    '''Return the (families, extra) stored by dumps(), or None if unreadable'''
+    try:
+        version, families, extra = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if version != FORMAT_VERSION:
+        return None
+    return families, extra
+
+
+def merge(target: Snapshot, data: bytes, newer: bool = True):
+    '''
+    Copy the samples serialised in `data` into families `target` has.
+
+    If `newer`, this is one worker's data being combined with the others': a
+    sample only replaces one that was updated less recently, and counters,
+    which each worker keeps separately, are added up. Otherwise `data` is
+    restored as it was, except counters, which start again from zero.
+    '''
+    loaded = loads(data)
+    if loaded is None:
+        return
+    for metric, samples in loaded[0].items():
+        family = target.families.get(metric)
+        if family is None:
+            continue
+        counter = family.kind == 'counter'
+        if counter and not newer:
+            continue
+        for key, labels, value, updated in samples:
+            current = family.samples.get(key)
+            if current is not None and counter:
+                current.value += value
+                current.updated = max(current.updated, updated)
+            elif current is None or not newer or updated >= current.updated:
+                family.samples[key] = Sample(labels, value, updated)
+    target.invalidate()
+    target.changed()
+
+
+def alive(pid: int) -> bool:
+    '''Whether a process is running'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def write_atomic(path: str, data: bytes):
+    '''Replace the file at `path` with `data` so readers never see part of it'''
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+class SharedSnapshot: # pylint: disable=too-many-instance-attributes
+    '''
+    A worker's view of the snapshot in multiprocess mode. `local` is the
+    Snapshot this worker writes to; exposition() serves all workers' data.
+    `deadline`, if given, is called with a metric and Sample and returns
+    when the series expires, or None if it never does, e.g.
+    Evictor.deadline, and expired series are left out of the merge.
+    '''
+
+    def __init__(self, local: Snapshot, directory: str, interval: float = SAVE_INTERVAL, deadline=None):
+        self.local = local
+        self.directory = directory
+        self.interval = interval
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.merged = None
+        self.stamps = None
+        # When the first series in the last merge expires
+        self.expires = math.inf
+        self.dirty = False
+        # The process the saving thread runs in, as it does not survive a fork
+        self.saver = None
+        # The process sharing was set up in, which removes the files at exit
+        self.owner = os.getpid()
+        # Taken before forking, so the child never starts with it held
+        os.register_at_fork(before=self.lock.acquire, after_in_parent=self.lock.release,
+                            after_in_child=self.lock.release)
+
+    def path(self) -> str:
+        # Looked up on every save, since the app may be loaded before the
+        # server forks its workers
+        return os.path.join(self.directory, f'{os.getpid()}.snapshot')
+
+    def save(self):
+        '''Write this worker's snapshot to its file now'''
+        with self.lock:
+            self.dirty = False
+            write_atomic(self.path(), dumps(self.local))
+
+    def changed(self):
+        '''Note that this worker's snapshot has changed, to be saved within `interval` seconds'''
+        self.dirty = True
+        if self.saver != os.getpid():
+            self.saver = os.getpid()
+            threading.Thread(target=self.run, name='shared-snapshot', daemon=True).start()
+
+    def run(self):
+        pid = os.getpid()
+        while self.saver == pid:
+            time.sleep(self.interval)
+            if self.dirty:
+                self.save()
+
+    def remove(self):
+        '''Remove this worker's file'''
+        try:
+            os.remove(self.path())
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        '''
+        At exit, merge this worker's series into the retired file and remove
+        its own, or remove every file in the process that set up sharing,
+        which exits after its workers
+        '''
+        if os.getpid() == self.owner:
+            clear_directory(self.directory)
+            return
+        retired = os.path.join(self.directory, RETIRED)
+        with self.lock:
+            self.dirty = False
+            descriptor = os.open(self.directory, os.O_RDONLY)
+            try:
+                # Workers exiting together take turns
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                combined = self.empty()
+                try:
+                    with open(retired, 'rb') as f:
+                        merge(combined, f.read())
+                except FileNotFoundError:
+                    pass
+                merge(combined, dumps(self.local))
+                if self.deadline:
+                    self.expire(combined, time.time())
+                write_atomic(retired, dumps(combined))
+            finally:
+                os.close(descriptor)
+        self.remove()
+
+    def empty(self) -> Snapshot:
+        '''A Snapshot with the same families as this worker's, to merge files into'''
+        snapshot = Snapshot(common_labels=())
+        for metric, family in self.local.families.items():
+            snapshot.families[metric] = Family(family.name, family.documentation, family.kind, family.labelnames)
+        return snapshot
+
+    def load(self) -> Snapshot:
+        '''
+        Merge every live worker's file, and the retired file, into one
+        Snapshot, or return the last merge if none of the files have changed
+        and no series has expired since.
+        '''
+        if self.dirty:
+            self.save()
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.snapshot')))
+        stamps = []
+        for path in paths:
+            pid = os.path.basename(path).split('.')[0]
+            if pid.isdigit() and not alive(int(pid)):
+                # Left behind by a worker that was killed
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            stamps.append((path, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        stamps = tuple(stamps)
+        now = time.time()
+        if self.merged is not None and stamps == self.stamps and now < self.expires:
+            return self.merged
+
+        merged = self.empty()
+        for path, _inode, _mtime, _size in stamps:
+            try:
+                with open(path, 'rb') as f:
+                    merge(merged, f.read())
+            except FileNotFoundError:
+                continue
+        self.expires = self.expire(merged, now) if self.deadline else math.inf
+        self.merged = merged
+        self.stamps = stamps
+        return merged
+
+    def expire(self, merged: Snapshot, now: float) -> float:
+        '''Remove the series of a merge that have expired, returning when the next one does'''
+        expires = math.inf
+        for metric, family in merged.families.items():
+            samples = family.samples
+            for key, sample in list(samples.items()):
+                deadline = self.deadline(metric, sample)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    del samples[key]
+                else:
+                    expires = min(expires, deadline)
+        return expires
+
+    def exposition(self, openmetrics: bool = False, compress: bool = False) -> bytes:
+        return self.load().exposition(openmetrics, compress)
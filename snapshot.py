@@ -0,0 +1,277 @@
+'''
+In-memory snapshot of the latest Ecowitt readings, exposed to Prometheus.
+
+Every reading is held as a slotted Sample in its metric Family. The text
+exposition of the whole snapshot is rendered at most once per change and
+kept as bytes, in plain, OpenMetrics and gzipped variants, so a scrape that
+arrives when no report has come in since the last one costs a dict lookup.
+'''
+import gzip
+import threading
+from itertools import islice
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, InfoMetricFamily
+from prometheus_client.exposition import generate_latest, gzip_accepted, CONTENT_TYPE_PLAIN_0_0_4
+from prometheus_client.openmetrics.exposition import generate_latest as generate_openmetrics, CONTENT_TYPE_LATEST as CONTENT_TYPE_OPENMETRICS
+from ingest import INFO
+
+OPENMETRICS_EOF = b'# EOF\n'
+
+
+def escape(value: str) -> str:
+    '''A label value or HELP text escaped for the text exposition formats'''
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class Sample:
+    '''The latest value of one series and when it was set'''
+    __slots__ = ('labels', 'value', 'updated')
+
+    def __init__(self, labels: tuple, value: float, updated: float):
+        self.labels = labels
+        self.value = value
+        self.updated = updated
+
+
+class Family:
+    '''A metric family and its samples, keyed by the label tuple they were set with'''
+    __slots__ = ('name', 'documentation', 'kind', 'labelnames', 'samples')
+
+    def __init__(self, name: str, documentation: str, kind: str, labelnames: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = labelnames
+        self.samples = {}
+
+
+class Snapshot: # pylint: disable=too-many-instance-attributes
+    '''
+    Latest readings for every metric, addressed by the same short metric
+    names and label tuples that IngestPlan produces. Also a Prometheus
+    collector, so it can be registered with a CollectorRegistry.
+
+    `common_labels` are label names that every family has ahead of its own,
+    e.g. the station. Writes for different stations never touch the same
+    samples, so callers serialise batches per station with their own locks
+    and the snapshot only locks to mark itself changed.
+    '''
+
+    def __init__(self, common_labels: tuple = ()):
+        self.families = {}
+        self.common_labels = tuple(common_labels)
+        self.lock = threading.Lock()
+        self.generation = 0
+        # Bumped whenever samples are removed or replaced, which makes any
+        # handles to them held by callers stale, see apply()
+        self.epoch = 0
+        self.rendered = {}
+        # Called with (metric, key, sample) whenever a new series is set
+        self.on_create = None
+        self.registry = CollectorRegistry(auto_describe=False)
+        self.registry.register(self)
+
+    def add_gauge(self, metric: str, name: str, documentation: str, labelnames: list = ()):
+        '''Declare a gauge. Like prometheus_client, an unlabelled gauge starts at 0.'''
+        labelnames = self.common_labels + tuple(labelnames)
+        family = self.families[metric] = Family(name, documentation, 'gauge', labelnames)
+        if not labelnames:
+            family.samples[()] = Sample((), 0.0, 0.0)
+        self.generation += 1
+        self.epoch += 1
+
+    def add_info(self, metric: str, name: str, documentation: str):
+        '''
+        Declare an Info metric. It holds one value per set of common labels,
+        which is labelled with the metric name.
+        '''
+        self.families[metric] = Family(name, documentation, 'info', self.common_labels + (metric,))
+        self.generation += 1
+        self.epoch += 1
+
+    def add_counter(self, metric: str, name: str, documentation: str, labelnames: list = ()):
+        '''Declare a counter, which only goes up with inc()'''
+        labelnames = self.common_labels + tuple(labelnames)
+        self.families[metric] = Family(name, documentation, 'counter', labelnames)
+        self.generation += 1
+        self.epoch += 1
+
+    def declare(self, table: tuple):
+        '''Declare each (kind, metric, name, documentation, labelnames) row of a table'''
+        for kind, metric, name, documentation, labelnames in table:
+            if kind == 'info':
+                self.add_info(metric, name, documentation)
+            elif kind == 'counter':
+                self.add_counter(metric, name, documentation, labelnames)
+            else:
+                self.add_gauge(metric, name, documentation, labelnames)
+
+    def inc(self, metric: str, labels: tuple, amount: float = 1.0, now: float = 0.0):
+        '''Add to a counter without marking the snapshot changed'''
+        sample = self.families[metric].samples.get(labels)
+        self.write(metric, labels, (sample.value if sample else 0.0) + amount, now)
+
+    def remove(self, metric: str, key: tuple):
+        '''Delete a series without marking the snapshot changed'''
+        if self.families[metric].samples.pop(key, None) is not None:
+            self.invalidate()
+
+    def has(self, metric: str, labels: tuple) -> bool:
+        '''Whether a series has been set'''
+        return labels in self.families[metric].samples
+
+    def handle(self, metric: str, labels: tuple) -> Sample:
+        '''
+        The Sample of a series that has been set, to write straight to with
+        apply() until the epoch moves on, or None
+        '''
+        return self.families[metric].samples.get(labels)
+
+    def set(self, metric: str, labels: tuple, value, now: float = 0.0):
+        '''Set one series'''
+        self.write(metric, labels, value, now)
+        self.changed()
+
+    def apply(self, writes, now: float, handles: list = None):
+        '''
+        Set a batch of (metric, labels, value) writes from IngestPlan.evaluate().
+        The snapshot is only marked changed if one of them changed a value.
+
+        `handles` are from IngestPlan.evaluate() too: the epoch they were
+        resolved in, then the Sample of each write at the start of the batch,
+        or a false value if it has to be looked up. Samples are written
+        straight to, unless the epoch has moved on since, as one of them may
+        have been removed. Callers hold the lock that series of these labels
+        are removed under, as for write().
+        '''
+        write = self.write
+        changed = False
+        batch = iter(writes)
+        if handles and handles[0] == self.epoch:
+            for sample, (metric, labels, value) in zip(islice(handles, 1, None), batch):
+                if sample:
+                    sample.updated = now
+                    if sample.value != value:
+                        sample.value = float(value)
+                        changed = True
+                elif write(metric, labels, value, now):
+                    changed = True
+        for metric, labels, value in batch:
+            if write(metric, labels, value, now):
+                changed = True
+        if changed:
+            self.changed()
+
+    def changed(self):
+        '''Mark the snapshot as changed so the next scrape renders it again'''
+        with self.lock:
+            self.generation += 1
+
+    def invalidate(self):
+        '''Make every handle stale, after samples have been removed or replaced'''
+        with self.lock:
+            self.epoch += 1
+
+    def write(self, metric: str, labels: tuple, value, now: float) -> bool:
+        '''
+        Set one series without marking the snapshot changed. Returns whether
+        its value changed; if not, only the time it was set is updated.
+        '''
+        family = self.families[metric]
+        if value is INFO:
+            # An Info metric only has its latest value for each set of
+            # common labels. The value is the last label.
+            key = labels[:-1]
+            sample = family.samples.get(key)
+            if sample is not None and sample.labels[-1] == labels[-1]:
+                sample.updated = now
+                return False
+            created = sample is None
+            sample = family.samples[key] = Sample(tuple(str(label) for label in labels), 1.0, now)
+            if created and self.on_create:
+                self.on_create(metric, key, sample) # pylint: disable=not-callable
+            return True
+        sample = family.samples.get(labels)
+        if sample is None:
+            sample = family.samples[labels] = Sample(tuple(str(label) for label in labels), float(value), now)
+            if self.on_create:
+                self.on_create(metric, labels, sample) # pylint: disable=not-callable
+            return True
+        sample.updated = now
+        if sample.value == value:
+            return False
+        sample.value = float(value)
+        return True
+
+    def collect(self):
+        for family in list(self.families.values()):
+            samples = list(family.samples.values())
+            if family.kind == 'info':
+                labelnames = family.labelnames[:-1]
+                if not samples and not labelnames:
+                    yield InfoMetricFamily(family.name, family.documentation, value={})
+                    continue
+                metric = InfoMetricFamily(family.name, family.documentation, labels=labelnames)
+                for sample in samples:
+                    metric.add_metric(sample.labels[:-1], {family.labelnames[-1]: sample.labels[-1]})
+                yield metric
+            elif family.kind == 'counter':
+                metric = CounterMetricFamily(family.name, family.documentation, labels=family.labelnames)
+                for sample in samples:
+                    metric.add_metric(sample.labels, sample.value)
+                yield metric
+            else:
+                metric = GaugeMetricFamily(family.name, family.documentation, labels=family.labelnames)
+                for sample in samples:
+                    metric.add_metric(sample.labels, sample.value)
+                yield metric
+
+    def exposition(self, openmetrics: bool = False, compress: bool = False) -> bytes:
+        '''
+        Rendered exposition of the snapshot, regenerated only if something
+        has been set since it was last rendered. The OpenMetrics variant has
+        no trailing EOF so other output can follow it.
+        '''
+        generation = self.generation
+        variant = (openmetrics, compress)
+        cached = self.rendered.get(variant)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        if compress:
+            output = gzip.compress(self.exposition(openmetrics), 6)
+        elif openmetrics:
+            output = generate_openmetrics(self.registry)
+            if output.endswith(OPENMETRICS_EOF):
+                output = output[:-len(OPENMETRICS_EOF)]
+        else:
+            output = generate_latest(self.registry)
+        self.rendered[variant] = (generation, output)
+        return output
+
+
+def make_snapshot_app(snapshot: Snapshot, registry: CollectorRegistry = REGISTRY, before=None):
+    '''
+    WSGI app serving the snapshot's cached exposition, followed by a fresh
+    rendering of `registry` for the process and client metrics. Gzipped
+    responses are the two parts as separate gzip members, which HTTP
+    clients (including Prometheus) decode as one stream. `before`, if
+    given, is called with no arguments ahead of every scrape.
+    '''
+    def app(environ, start_response):
+        if before:
+            before()
+        openmetrics = 'application/openmetrics-text' in environ.get('HTTP_ACCEPT', '')
+        compress = gzip_accepted(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        body = snapshot.exposition(openmetrics, compress)
+        rest = generate_openmetrics(registry) if openmetrics else generate_latest(registry)
+        headers = [('Content-Type', CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_PLAIN_0_0_4)]
+        if compress:
+            rest = gzip.compress(rest, 1)
+            headers.append(('Content-Encoding', 'gzip'))
+        headers.append(('Content-Length', str(len(body) + len(rest))))
+        start_response('200 OK', headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return [b'']
+        return [body, rest]
+    return app
@@ -0,0 +1,91 @@
+'''
+Keep the metrics across restarts.
+
+The whole snapshot, with the time each series was last really updated, is
+written to STATE_FILE at most every STATE_INTERVAL seconds after a report
+and again at exit, and read back at startup. A restarted exporter then
+serves the same values and staleness timestamps it had before, instead of
+empty gauges.
+'''
+import atexit
+import logging
+import os
+import threading
+import time
+from snapshot import Snapshot
+from shared import dumps, loads, merge, write_atomic
+
+
+class StateFile:
+    '''
+    Snapshot persisted to `path`. `config` is anything marshal can store
+    that identifies how values were converted, e.g. the units; a state file
+    saved under a different config is not restored.
+    '''
+
+    def __init__(self, path: str, interval: float = 60, config=None, logger: logging.Logger = None):
+        self.path = path
+        self.interval = interval
+        self.config = config
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.saved = time.monotonic()
+
+    def restore(self, snapshot: Snapshot) -> bool:
+        '''Load the saved state into `snapshot`, returning whether there was any'''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        loaded = loads(data)
+        if loaded is None:
+            self.logger.warning("Ignoring unreadable state file %s", self.path)
+            return False
+        if loaded[1] != self.config:
+            self.logger.warning("Ignoring state file %s saved with different units", self.path)
+            return False
+        merge(snapshot, data, newer=False)
+        return True
+
+    def save(self, snapshot: Snapshot):
+        '''Write `snapshot` to the state file now'''
+        with self.lock:
+            self.write(snapshot)
+
+    def write(self, snapshot: Snapshot):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_atomic(self.path, dumps(snapshot, self.config))
+        self.saved = time.monotonic()
+
+    def changed(self, snapshot):
+        '''
+        Note that `snapshot` has changed, saving it if the last save was
+        more than `interval` seconds ago. Never waits for another save.
+        `snapshot` is a Snapshot, or a function returning one, which is
+        only called if it is saved.
+        '''
+        if time.monotonic() - self.saved < self.interval:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            # Checked again now no other thread can be saving
+            if time.monotonic() - self.saved >= self.interval:
+                self.write(snapshot() if callable(snapshot) else snapshot)
+        finally:
+            self.lock.release()
+
+    def save_at_exit(self, snapshot):
+        '''
+        Save at exit. `snapshot` is a Snapshot, or a function returning one
+        so the saved data can be looked up as late as possible.
+        '''
+        def save():
+            try:
+                self.save(snapshot() if callable(snapshot) else snapshot)
+            except OSError:
+                self.logger.exception("Failed to save state to %s", self.path)
+        atexit.register(save)
@@ -0,0 +1,97 @@
+'''
+Multiple Ecowitt gateways reporting to one exporter.
+
+Every gateway is a Station with its own IngestPlan, so it can have its own
+sensor locations, and its own lock, so pushes from different gateways never
+wait on each other. Every series is labelled with the station name.
+
+Gateways name themselves, with no authentication, so beyond `max_stations`
+new names from reports are refused rather than each growing the exporter
+by another plan and set of series.
+'''
+import re
+import threading
+from ingest import IngestPlan, LOCATION_KEYS
+from recent import Ring
+
+
+class Station:
+    '''
+    One gateway: its name, compiled ingest plan, write lock and, unless
+    `recent` is 0, a ring of that many of its latest payloads.
+    '''
+    __slots__ = ('name', 'plan', 'lock', 'recent')
+
+    def __init__(self, name: str, plan: IngestPlan, recent: int = 0):
+        self.name = name
+        self.plan = plan
+        self.lock = threading.Lock()
+        self.recent = Ring(recent) if recent > 0 else None
+
+
+def env_prefix(name: str) -> str:
+    '''Prefix for a station's own environment variables, e.g. ROOF_ for "roof"'''
+    return re.sub(r'\W', '_', name).upper() + '_'
+
+
+def station_locations(name: str, environ, defaults: dict) -> dict:
+    '''
+    Sensor locations for one station. Each one can be set with the station's
+    own variable, e.g. ROOF_TEMP1_LOCATION, and otherwise falls back to the
+    exporter-wide TEMP1_LOCATION.
+    '''
+    prefix = env_prefix(name)
+    return {
+        key: environ.get(f'{prefix}{key.upper()}_LOCATION', defaults.get(key))
+        for key in LOCATION_KEYS
+    }
+
+
+class Stations:
+    '''
+    Registry of stations, created on first sight. `make_plan` is called
+    with a station name and returns the IngestPlan for it. Each station
+    keeps its last `recent` payloads. Once there are `max_stations`
+    stations, 0 for no limit, reports can only name ones already seen or
+    configured.
+    '''
+
+    def __init__(self, default: str, passkeys: dict, make_plan, recent: int = 0, max_stations: int = 0):
+        self.default = default
+        self.passkeys = passkeys
+        self.make_plan = make_plan
+        self.recent = recent
+        self.max_stations = max_stations
+        self.stations = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> Station:
+        '''Return the named station, creating it if this is the first time it is seen'''
+        station = self.stations.get(name)
+        if station is None:
+            with self.lock:
+                station = self.stations.get(name)
+                if station is None:
+                    station = self.stations[name] = Station(name, self.make_plan(name), self.recent)
+        return station
+
+    def identify(self, data: dict, name: str = None) -> Station:
+        '''
+        Work out which station a payload came from: a name given in the URL
+        wins, then a known PASSKEY, then the default STATION_ID. Returns
+        None for a new name once there are max_stations stations.
+        '''
+        if not name:
+            name = self.passkeys.get(data.get('PASSKEY'), self.default)
+        elif (self.max_stations and name not in self.stations and len(self.stations) >= self.max_stations
+              and name != self.default and name not in self.passkeys.values()):
+            return None
+        return self.get(name)
+
+    def names(self) -> list:
+        '''
+        Names of every station that is configured or has reported. The
+        default station only counts as configured if no passkeys are.
+        '''
+        names = list(self.passkeys.values()) or [self.default]
+        return list(dict.fromkeys(names + list(self.stations)))
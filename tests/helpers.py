@@ -0,0 +1,31 @@
+'''
+Shared by the tests: an exporter set up from a given environment, and
+waiting on the background threads of the stand-in servers in benchmarks/.
+'''
+import time
+
+from config import Config
+from ecowitt_exporter import Exporter
+
+
+def make_exporter(environ: dict = None) -> Exporter:
+    '''An exporter configured from `environ` alone, not the process environment'''
+    exporter = Exporter(Config(environ or {}))
+    exporter.setup_metrics()
+    return exporter
+
+
+def wait(condition, timeout: float = 10) -> bool:
+    '''Wait until `condition()` is true, returning False if it never was'''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def value(exporter: Exporter, metric: str, labels: tuple):
+    '''The value of a series, or None if it is not set'''
+    sample = exporter.metrics.families[metric].samples.get(labels)
+    return sample and sample.value
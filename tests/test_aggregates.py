@@ -0,0 +1,66 @@
+'''Rolling-window aggregates, and dropping their windows with their series'''
+# pylint: disable=wrong-import-order
+import pytest
+
+from aggregates import Extreme, Mean, VectorMean
+from payloads import sample_payload
+
+from helpers import make_exporter, value
+
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+
+
+def test_mean_drops_samples_older_than_the_window():
+    window = Mean(10)
+    assert window.add(0, 1) == 1
+    assert window.add(5, 3) == 2
+    assert window.add(10, 5) == 4
+
+
+@pytest.mark.parametrize('largest, values, expected', [
+    (True, [5, 1, 3, 2], [5, 5, 3, 3]),
+    (False, [1, 5, 3, 4], [1, 1, 3, 3]),
+])
+def test_extreme_of_the_window(largest, values, expected):
+    window = Extreme(10, largest=largest)
+    assert [window.add(now, value) for now, value in zip((0, 5, 10, 15), values)] == expected
+
+
+def test_vector_mean_wraps_around_north():
+    window = VectorMean(60)
+    window.add(0, 350)
+    assert window.add(1, 10) == 0
+    assert VectorMean(60).add(0, 0) == 0
+    window = VectorMean(60)
+    window.add(0, 0)
+    assert window.add(1, 90) == 45
+
+
+def report(exporter, now: float, tempf: str):
+    data = sample_payload()
+    data['tempf'] = tempf
+    exporter.ingest(exporter.stations.get('garden'), data, now)
+
+
+def test_reports_feed_each_window():
+    exporter = make_exporter({'AGGREGATE_WINDOWS': '10m,1h'})
+    report(exporter, 1000, '50')
+    report(exporter, 1300, '68')
+    report(exporter, 2000, '59')
+    assert value(exporter, 'temp_max', OUTDOOR + ('10m',)) == 15
+    assert value(exporter, 'temp_min', OUTDOOR + ('10m',)) == 15
+    assert value(exporter, 'temp_max', OUTDOOR + ('1h',)) == 20
+    assert value(exporter, 'temp_min', OUTDOOR + ('1h',)) == 10
+
+
+def test_evicted_series_lose_their_windows():
+    exporter = make_exporter({'AGGREGATE_WINDOWS': '10m,1h', 'SERIES_TTL': '60'})
+    report(exporter, 1000, '68')
+    assert (('temp_max', OUTDOOR, '1h')) in exporter.aggregator.state
+    exporter.evictor.sweep(2000)
+    assert not exporter.aggregator.state
+    assert not exporter.metrics.has('temp_max', OUTDOOR + ('1h',))
+
+    # Reported again, the series starts from new windows, without the old maximum
+    report(exporter, 2000, '50')
+    assert value(exporter, 'temp_max', OUTDOOR + ('1h',)) == 10
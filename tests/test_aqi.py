@@ -0,0 +1,77 @@
+'''Air quality indexes from PM2.5 concentrations, and the Beaufort scale'''
+# pylint: disable=wrong-import-order
+import math
+import time
+
+import pytest
+
+from conversions import PiecewiseIndex, EPA_PM25, aqi_epa, aqi_function, aqi_mep, aqi_nepm, aqi_uk, mph2beaufort
+from ingest import parse_body
+from payloads import raw_payload
+
+from helpers import make_exporter, value
+
+
+@pytest.mark.parametrize('concentration, index', [
+    (0, 1), (11.9, 1), (12, 2), (35.9, 3), (36, 4), (70.9, 9), (71, 10), (300, 10),
+])
+def test_uk(concentration, index):
+    assert aqi_uk(concentration) == index
+
+
+@pytest.mark.parametrize('concentration, index', [
+    # Truncated to one decimal place, so 12.05 is still in the first band
+    (0, 0), (9.0, 38), (12.0, 50), (12.05, 50), (12.1, 51), (35.4, 100), (35.5, 101),
+    (100, 174), (500.4, 500), (600, 500),
+])
+def test_epa(concentration, index):
+    assert aqi_epa(concentration) == index
+
+
+@pytest.mark.parametrize('concentration, index', [
+    (0, 0), (35, 50), (35.9, 50), (36, 51), (75, 100), (100, 131), (500, 500), (800, 500),
+])
+def test_mep(concentration, index):
+    assert aqi_mep(concentration) == index
+
+
+@pytest.mark.parametrize('concentration, index', [(0, 0), (12.5, 50), (25, 100), (50, 200)])
+def test_nepm(concentration, index):
+    assert aqi_nepm(concentration) == index
+
+
+def test_strings_are_accepted():
+    assert aqi_uk('12') == 2 and aqi_epa('35.4') == 100 and aqi_nepm('25') == 100
+
+
+def test_memo_gives_the_same_answers():
+    memoised = PiecewiseIndex(EPA_PM25, 1)
+    direct = PiecewiseIndex(EPA_PM25, 1, memo=0)
+    for tenths in range(0, 6000, 7):
+        assert memoised(tenths / 10) == direct(tenths / 10)
+
+
+@pytest.mark.parametrize('standard', ['uk', 'epa', 'mep', 'nepm'])
+def test_nan_gives_nan(standard):
+    assert math.isnan(aqi_function(standard)(float('nan')))
+    assert math.isnan(aqi_function(standard)('nan'))
+
+
+@pytest.mark.parametrize('speed, number', [
+    (0, 0), (1, 0), (1.1, 1), (3, 1), (12, 3), (46.5, 9), (73, 11), (73.1, 12), (120, 12),
+])
+def test_beaufort(speed, number):
+    assert mph2beaufort(speed) == number
+
+
+def test_beaufort_nan_gives_nan():
+    assert math.isnan(mph2beaufort('nan'))
+
+
+def test_nan_report_sets_nan():
+    exporter = make_exporter({'AQI_STANDARD': 'uk'})
+    data = parse_body(raw_payload())
+    data['pm25_avg_24h_ch2'] = 'nan'
+    exporter.ingest(exporter.stations.get('garden'), data, time.time())
+    assert math.isnan(value(exporter, 'aqi', ('garden', 'uk', 'ch2')))
+    exporter.metrics.exposition()
@@ -0,0 +1,77 @@
+'''Converting archived reports to OpenMetrics with backfill.py'''
+# pylint: disable=wrong-import-order
+import io
+from urllib.parse import urlencode
+
+import pytest
+
+import backfill
+from payloads import drifted_payloads, raw_payload
+
+
+@pytest.fixture(autouse=True)
+def exporter():
+    return backfill.load({'STATION_PASSKEYS': 'E05DDF79DADE150B6477AE0772D37CF8=garden'})
+
+
+def convert(paths: list, processes: int = 1) -> tuple:
+    output = io.BytesIO()
+    counts = backfill.backfill([str(path) for path in paths], output, processes)
+    return output.getvalue().decode(), counts
+
+
+def archive(tmp_path, lines: list, name: str = 'archive.txt'):
+    path = tmp_path / name
+    path.write_bytes(b'\n'.join(lines) + b'\n')
+    return path
+
+
+def test_parse_dateutc():
+    assert backfill.parse_dateutc('2025-05-30 19:31:57') == 1748633517
+
+
+def test_samples_are_timestamped_with_dateutc(tmp_path):
+    text, counts = convert([archive(tmp_path, [raw_payload()])])
+    assert counts == (1, counts[1], 0) and counts[1] > 60
+    lines = text.splitlines()
+    assert lines[0] == '# HELP ecowitt_stationtype Ecowitt station type'
+    assert lines[-1] == '# EOF'
+    assert 'ecowitt_temp{station="garden",sensor="outdoor",unit="c",location="outdoor"} 17.7 1748633517' in lines
+    assert 'ecowitt_last_report_timestamp_seconds{station="garden"} 1748633517 1748633517' in lines
+    assert 'ecowitt_model_info{station="garden",model="GW1100A"} 1 1748633517' in lines
+
+
+def test_series_samples_are_together_and_in_order(tmp_path):
+    payloads = drifted_payloads(5)
+    for index, payload in enumerate(payloads):
+        payload['dateutc'] = f'2025-05-30 19:3{index}:00'
+    text, counts = convert([archive(tmp_path, [urlencode(payload).encode() for payload in payloads])])
+    assert counts[0] == 5
+    samples = [line for line in text.splitlines() if line.startswith('ecowitt_temp{station="garden",sensor="outdoor"')]
+    assert len(samples) == 5
+    assert [int(line.rsplit(' ', 1)[1]) for line in samples] == sorted(int(line.rsplit(' ', 1)[1]) for line in samples)
+
+
+def test_corrupt_and_undated_lines_are_skipped(tmp_path, capsys):
+    path = archive(tmp_path, [
+        raw_payload(),
+        b'tempf=63.86',
+        raw_payload().replace(b'tempf=63.86', b'tempf=6%'),
+        raw_payload().replace(b'2025-05-30+19:31:57', b'2025-05-30+19:32:13'),
+    ])
+    text, counts = convert([path])
+    assert counts[0] == 2 and counts[2] == 1
+    assert f'Skipping {path} line 3: ' in capsys.readouterr().err
+    assert text.count('ecowitt_temp{station="garden",sensor="outdoor"') == 2
+
+
+def test_processes_give_the_same_output(tmp_path, monkeypatch):
+    payloads = drifted_payloads(200)
+    for index, payload in enumerate(payloads):
+        payload['dateutc'] = f'2025-05-30 {index // 60:02d}:{index % 60:02d}:00'
+    lines = [urlencode(payload).encode() for payload in payloads]
+    paths = [archive(tmp_path, lines[:100], 'one.txt'), archive(tmp_path, lines[100:], 'two.txt')]
+    single, counts = convert(paths)
+    monkeypatch.setattr(backfill, 'CHUNK_SIZE', 4096)
+    assert len(backfill.chunks([str(path) for path in paths], str(tmp_path))) > 4
+    assert convert(paths, processes=3) == (single, counts)
@@ -0,0 +1,80 @@
+'''Dew point, heat index, wind chill, feels-like and absolute humidity, with DERIVED_METRICS'''
+# pylint: disable=wrong-import-order
+import pytest
+
+from derived import absolute_humidity, dew_point_f, feels_like_f, heat_index_f, wind_chill_f
+from payloads import sample_payload
+
+from helpers import make_exporter, value
+
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+
+
+def test_dew_point():
+    assert dew_point_f(68, 50) == pytest.approx(48.7, abs=0.1)
+    assert dew_point_f(68, 100) == pytest.approx(68)
+
+
+@pytest.mark.parametrize('temp, humidity, index', [
+    # From the US National Weather Service's heat index chart
+    (90, 70, 106), (100, 40, 109), (80, 40, 80), (70, 50, 69),
+])
+def test_heat_index(temp, humidity, index):
+    assert heat_index_f(temp, humidity) == pytest.approx(index, abs=0.7)
+
+
+@pytest.mark.parametrize('temp, wind, chill', [
+    # From the US National Weather Service's wind chill chart
+    (0, 15, -19), (30, 10, 21), (40, 30, 28),
+    # Not defined when it is warm or calm
+    (60, 20, 60), (20, 3, 20),
+])
+def test_wind_chill(temp, wind, chill):
+    assert wind_chill_f(temp, wind) == pytest.approx(chill, abs=0.5)
+
+
+def test_feels_like():
+    assert feels_like_f(0, 50, 15) == wind_chill_f(0, 15)
+    assert feels_like_f(90, 70, 15) == heat_index_f(90, 70)
+    assert feels_like_f(65, 50, 15) == 65
+
+
+def test_absolute_humidity():
+    assert absolute_humidity(68, 50) == pytest.approx(8.6, abs=0.1)
+
+
+def report(exporter, now: float, **changes):
+    exporter.ingest(exporter.stations.get('garden'), {**sample_payload(), **changes}, now)
+
+
+def test_reports_set_derived_metrics_in_the_temperature_unit():
+    exporter = make_exporter({'DERIVED_METRICS': 'yes'})
+    report(exporter, 1000, tempf='68', humidity='50', windspeedmph='10')
+    assert value(exporter, 'dewpoint', OUTDOOR) == pytest.approx(9.26, abs=0.01)
+    assert value(exporter, 'windchill', OUTDOOR) == 20
+    assert value(exporter, 'feelslike', OUTDOOR) == 20
+    assert value(exporter, 'absolute_humidity', ('garden', 'outdoor', 'gm3', 'outdoor')) == pytest.approx(8.64)
+    # Only the outdoor sensor has wind, and sensors without humidity have nothing derived
+    assert not exporter.metrics.has('windchill', ('garden', 'indoor', 'c', 'indoor'))
+    assert exporter.metrics.has('dewpoint', ('garden', 'indoor', 'c', 'indoor'))
+    assert not exporter.metrics.has('dewpoint', ('garden', 'ch7', 'c', None))
+
+    exporter = make_exporter({'DERIVED_METRICS': 'yes', 'TEMPERATURE_UNIT': 'f'})
+    report(exporter, 1000, tempf='68', humidity='50')
+    assert value(exporter, 'dewpoint', ('garden', 'outdoor', 'f', 'outdoor')) == pytest.approx(48.66)
+
+
+def test_changed_readings_are_derived_again():
+    exporter = make_exporter({'DERIVED_METRICS': 'yes'})
+    report(exporter, 1000, tempf='68', humidity='50')
+    report(exporter, 1010, tempf='68', humidity='100')
+    assert value(exporter, 'dewpoint', OUTDOOR) == 20
+    assert exporter.metrics.handle('dewpoint', OUTDOOR).updated == 1010
+
+
+@pytest.mark.parametrize('humidity', ['0', '101', 'nan'])
+def test_implausible_humidity_derives_nothing(humidity):
+    exporter = make_exporter({'DERIVED_METRICS': 'yes'})
+    report(exporter, 1000, humidity=humidity)
+    assert not exporter.metrics.has('dewpoint', OUTDOOR)
+    assert exporter.metrics.has('dewpoint', ('garden', 'indoor', 'c', 'indoor'))
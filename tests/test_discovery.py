@@ -0,0 +1,50 @@
+'''Exposing unrecognised report keys as ecowitt_raw, with DISCOVER_KEYS, and capping their series'''
+# pylint: disable=wrong-import-order
+from config import parse_patterns
+from payloads import sample_payload
+
+from helpers import make_exporter, value
+
+def report(exporter, now: float, **extra):
+    exporter.ingest(exporter.stations.get('garden'), {**sample_payload(), **extra}, now)
+
+
+def keys(exporter) -> set:
+    return {key for _, key in exporter.metrics.families['raw'].samples}
+
+
+def test_patterns():
+    matches = parse_patterns('new*, !newer*,x?')
+    assert matches('newkey') and matches('xy')
+    assert not matches('newerkey') and not matches('xyz') and not matches('other')
+    assert parse_patterns('!heap') is None and parse_patterns('') is None
+
+
+def test_numeric_unrecognised_keys_are_exposed():
+    exporter = make_exporter({'DISCOVER_KEYS': 'new*'})
+    report(exporter, 1000, newkey='1.5', newtext='abc', other='2')
+    assert keys(exporter) == {'newkey'}
+    assert value(exporter, 'raw', ('garden', 'newkey')) == 1.5
+
+
+def test_series_are_capped_per_station_dropping_the_least_recently_updated():
+    exporter = make_exporter({'DISCOVER_KEYS': 'new*', 'DISCOVER_MAX_SERIES': '2'})
+    for index in range(5):
+        report(exporter, 1000 + index, new0='1', **{f'new{index + 1}': '1'})
+    assert keys(exporter) == {'new0', 'new5'}
+    assert value(exporter, 'raw_evicted', ('garden',)) == 4
+
+    # Another station has a cap of its own
+    exporter.ingest(exporter.stations.get('attic'), {**sample_payload(), 'new9': '1'}, 1010)
+    assert exporter.metrics.has('raw', ('attic', 'new9'))
+    assert keys(exporter) == {'new0', 'new5', 'new9'}
+
+
+def test_dropped_keys_come_back_when_reported_again():
+    exporter = make_exporter({'DISCOVER_KEYS': 'new*', 'DISCOVER_MAX_SERIES': '1'})
+    report(exporter, 1000, new1='1')
+    report(exporter, 1001, new2='2')
+    assert keys(exporter) == {'new2'}
+    report(exporter, 1002, new1='1')
+    assert keys(exporter) == {'new1'}
+    assert value(exporter, 'raw', ('garden', 'new1')) == 1
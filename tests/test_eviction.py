@@ -0,0 +1,54 @@
+'''Dropping series that are no longer reported, with SERIES_TTL'''
+# pylint: disable=wrong-import-order
+import time
+
+from ecowitt_exporter import create_app
+from payloads import sample_payload
+
+from helpers import make_exporter, value
+
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+CH1 = ('garden', 'ch1', 'c', None)
+
+
+def report(exporter, now: float, without: tuple = ()):
+    data = {key: value for key, value in sample_payload().items() if key not in without}
+    exporter.ingest(exporter.stations.get('garden'), data, now)
+
+
+def test_sensors_no_longer_reported_are_dropped():
+    exporter = make_exporter({'SERIES_TTL': '60'})
+    report(exporter, 1000)
+    assert exporter.metrics.has('humidity', ('garden', 'ch1', 'percent', None))
+    report(exporter, 1050, without=('temp1f', 'humidity1'))
+    report(exporter, 1100, without=('temp1f', 'humidity1'))
+    assert not exporter.metrics.has('temp', CH1)
+    assert not exporter.metrics.has('humidity', ('garden', 'ch1', 'percent', None))
+    assert value(exporter, 'temp', OUTDOOR) == 17.7
+    assert value(exporter, 'evicted_series', ('garden', 'ecowitt_temp')) == 1
+    assert value(exporter, 'evicted_series', ('garden', 'ecowitt_humidity')) == 1
+
+    # Nothing else is due until the TTL after the last report
+    assert exporter.evictor.sweep(1159) == 0
+    assert exporter.evictor.sweep(1160) > 50
+    # The gateway's report time is kept, for stale gateway alerts
+    assert exporter.metrics.has('last_report_timestamp', ('garden',))
+
+
+def test_ttls_per_metric_and_tracked_sensors():
+    exporter = make_exporter({'SERIES_TTLS': 'ecowitt_temp=60', 'SENSORS_TO_TRACK': 'ch2'})
+    report(exporter, 1000)
+    exporter.evictor.sweep(2000)
+    assert not exporter.metrics.has('temp', OUTDOOR)
+    assert not exporter.metrics.has('temp', CH1)
+    assert exporter.metrics.has('temp', ('garden', 'ch2', 'c', None))
+    assert exporter.metrics.has('humidity', ('garden', 'outdoor', 'percent', 'outdoor'))
+
+
+def test_expired_series_are_dropped_when_scraped():
+    exporter = make_exporter({'SERIES_TTL': '60'})
+    report(exporter, time.time() - 120)
+    assert exporter.metrics.has('temp', OUTDOOR)
+    body = create_app(exporter).test_client().get('/metrics').data
+    assert b'ecowitt_temp{' not in body
+    assert b'ecowitt_last_report_timestamp_seconds{' in body
@@ -0,0 +1,155 @@
+'''Pushing to a Pushgateway with PUSH_URL, against the stand-in in fake_pushgateway.py'''
+# pylint: disable=wrong-import-order
+import glob
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+import pytest
+
+import fake_pushgateway
+from ecowitt_exporter import create_app
+from keepalive import KeepAlive
+from payloads import drifted_payloads, raw_payload
+from snapshot import escape
+
+from helpers import make_exporter, wait
+
+GROUP = '/metrics/job/ecowitt/station/'
+
+
+def dead_process() -> int:
+    '''The pid of a process that has exited'''
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0) # pylint: disable=protected-access
+    os.waitpid(pid, 0)
+    return pid
+
+
+@pytest.fixture
+def pushgateway():
+    server = fake_pushgateway.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def exporter(pushgateway, tmp_path):
+    return make_exporter({'PUSH_URL': pushgateway.url, 'PUSH_INTERVAL': '0.05',
+                          'PUSH_QUEUE_DIR': str(tmp_path), 'PUSH_TIMEOUT': '5'})
+
+
+def pushed(pushgateway, exporter) -> tuple:
+    '''Numbers of series set in the exporter that were pushed with the same and a different value'''
+    samples = pushgateway.samples()
+    same = differ = 0
+    for family in exporter.metrics.families.values():
+        if family.kind == 'counter':
+            continue
+        for sample in family.samples.values():
+            labels = dict(zip(family.labelnames, sample.labels))
+            station = labels.pop('station')
+            name = family.name + '_info' if family.kind == 'info' else family.name
+            key = (GROUP + station, name, tuple(sorted(labels.items())))
+            if key not in samples:
+                continue
+            if samples[key] == (1.0 if family.kind == 'info' else sample.value):
+                same += 1
+            else:
+                differ += 1
+    return same, differ
+
+
+def temperature(pushgateway, station: str) -> float:
+    key = (GROUP + station, 'ecowitt_temp', (('location', 'outdoor'), ('sensor', 'outdoor'), ('unit', 'c')))
+    return pushgateway.samples().get(key)
+
+
+def test_pushes_match_metrics(pushgateway, exporter):
+    client = create_app(exporter).test_client()
+    client.post('/report/garden', data=raw_payload())
+    client.post('/report/roof', data=raw_payload())
+    assert wait(lambda: temperature(pushgateway, 'garden') and temperature(pushgateway, 'roof'))
+    same, differ = pushed(pushgateway, exporter)
+    assert same > 60 and differ == 0
+    assert temperature(pushgateway, 'garden') == 17.7
+    assert ('/metrics/job/ecowitt/station/garden', 'ecowitt_model_info',
+            (('model', 'GW1100A'),)) in pushgateway.samples()
+
+
+def test_pushes_are_queued_while_down(pushgateway, exporter, tmp_path):
+    client = create_app(exporter).test_client()
+    forwarder = exporter.forwarder
+    payloads = drifted_payloads(2)
+    client.post('/report/garden', data=urlencode(payloads[0]))
+    assert wait(lambda: temperature(pushgateway, 'garden'))
+
+    pushgateway.down = True
+    client.post('/report/garden', data=urlencode(payloads[1]))
+    assert wait(lambda: glob.glob(os.path.join(tmp_path, '*.push')))
+    assert forwarder.failed
+    assert temperature(pushgateway, 'garden') != exporter.metrics.families['temp'].samples[
+        ('garden', 'outdoor', 'c', 'outdoor')].value
+
+    pushgateway.down = False
+    assert wait(lambda: not glob.glob(os.path.join(tmp_path, '*.push*')))
+    assert wait(lambda: pushed(pushgateway, exporter)[1] == 0)
+    assert pushed(pushgateway, exporter)[0] > 60
+
+
+def test_pushes_claimed_by_a_dead_process_are_sent(pushgateway, exporter, tmp_path):
+    client = create_app(exporter).test_client()
+    pushgateway.down = True
+    client.post('/report/attic', data=raw_payload())
+    assert wait(lambda: glob.glob(os.path.join(tmp_path, '*.push')))
+    # As a process that died while sending it, and one that died writing another
+    dead_pid = str(dead_process())
+    [queued] = glob.glob(os.path.join(tmp_path, '*.push'))
+    os.rename(queued, f'{queued}.{dead_pid}')
+    writing = os.path.join(tmp_path, f'{time.time_ns():020d}-{dead_pid}.push.tmp')
+    with open(writing, 'wb') as f:
+        f.write(b'/metrics/job/ecowitt/station/attic\n')
+
+    pushgateway.down = False
+    restarted = make_exporter({'PUSH_URL': pushgateway.url, 'PUSH_INTERVAL': '0.05', 'PUSH_QUEUE_DIR': str(tmp_path)})
+    create_app(restarted).test_client().post('/report/garden', data=raw_payload())
+    assert wait(lambda: temperature(pushgateway, 'attic') and temperature(pushgateway, 'garden'))
+    assert not os.listdir(tmp_path)
+
+
+def test_connection_closed_while_idle_is_opened_again():
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self): # pylint: disable=invalid-name
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+            # Without saying so, as an idle timeout would
+            self.close_connection = True
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = KeepAlive('127.0.0.1', server.server_address[1], timeout=5)
+        for _ in range(3):
+            assert connection.request('GET', '/') == (200, b'ok')
+            time.sleep(0.05)
+    finally:
+        server.shutdown()
+        server.server_close()
+    with pytest.raises(OSError):
+        connection.request('GET', '/')
+    assert connection.connection is None
+
+
+def test_escape():
+    assert escape('a\\b\n"c"') == r'a\\b\n\"c\"'
@@ -0,0 +1,59 @@
+'''Writing readings straight to their series, and looking them up again once series are removed'''
+# pylint: disable=wrong-import-order
+from payloads import sample_payload
+
+from helpers import make_exporter, value
+
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+
+
+def report(exporter, now: float, **changes):
+    exporter.ingest(exporter.stations.get('garden'), {**sample_payload(), **changes}, now)
+
+
+def series(exporter) -> set:
+    return {(metric, key) for metric, family in exporter.metrics.families.items() for key in family.samples}
+
+
+def test_evicted_series_come_back_when_reported_again():
+    exporter = make_exporter({'SERIES_TTL': '60'})
+    report(exporter, 1000)
+    report(exporter, 1010)
+    reported = series(exporter)
+    assert exporter.evictor.sweep(2000)
+    assert not exporter.metrics.has('temp', OUTDOOR)
+
+    # The same readings again, which would reuse the handles of the removed series
+    report(exporter, 2000)
+    assert series(exporter) - reported == {
+        ('evicted_series', key) for key in exporter.metrics.families['evicted_series'].samples}
+    assert value(exporter, 'temp', OUTDOOR) == 17.7
+    report(exporter, 2010, tempf='68')
+    assert value(exporter, 'temp', OUTDOOR) == 20
+    assert exporter.metrics.handle('temp', OUTDOOR).updated == 2010
+
+
+def test_series_removed_between_evaluating_and_applying():
+    exporter = make_exporter()
+    report(exporter, 1000)
+    station = exporter.stations.get('garden')
+    handles = []
+    writes = station.plan.evaluate(sample_payload(), 1010, handles=handles)
+    assert exporter.metrics.handle('temp', OUTDOOR) in handles
+
+    exporter.metrics.remove('temp', OUTDOOR)
+    exporter.metrics.apply(writes, 1010, handles)
+    assert value(exporter, 'temp', OUTDOOR) == 17.7
+    assert exporter.metrics.handle('temp', OUTDOOR).updated == 1010
+
+
+def test_handles_write_to_the_series():
+    exporter = make_exporter()
+    report(exporter, 1000)
+    sample = exporter.metrics.handle('temp', OUTDOOR)
+    generation = exporter.metrics.generation
+    report(exporter, 1010)
+    # Unchanged readings only move the time they were set
+    assert exporter.metrics.handle('temp', OUTDOOR) is sample and sample.updated == 1010
+    report(exporter, 1020, tempf='68')
+    assert sample.value == 20 and exporter.metrics.generation > generation
@@ -0,0 +1,34 @@
+'''The exporter's own metrics with INSTRUMENT=yes'''
+# pylint: disable=wrong-import-order
+from ecowitt_exporter import create_app
+from payloads import raw_payload
+
+from helpers import make_exporter
+
+
+def scrape(client, openmetrics: bool = False) -> list:
+    headers = {'Accept': 'application/openmetrics-text'} if openmetrics else {}
+    return client.get('/metrics', headers=headers).data.decode().splitlines()
+
+
+def test_exporters_in_one_process_have_their_own_metrics():
+    first = create_app(make_exporter({'INSTRUMENT': 'yes'})).test_client()
+    second = create_app(make_exporter({'INSTRUMENT': 'yes'})).test_client()
+    first.post('/report', data=raw_payload())
+    first.post('/report', data=b'newkey=1&' + raw_payload())
+    second.post('/report', data=raw_payload())
+    assert 'ecowitt_exporter_report_seconds_count 2.0' in scrape(first)
+    assert 'ecowitt_unknown_key_total{key="newkey"} 1.0' in scrape(first)
+    lines = scrape(second)
+    assert 'ecowitt_exporter_report_seconds_count 1.0' in lines
+    assert not [line for line in lines if 'newkey' in line]
+    # The process metrics of the default registry are still served
+    assert [line for line in lines if line.startswith('process_cpu_seconds_total')]
+
+
+def test_openmetrics_scrape_ends_once():
+    client = create_app(make_exporter({'INSTRUMENT': 'yes'})).test_client()
+    client.post('/report', data=raw_payload())
+    lines = scrape(client, openmetrics=True)
+    assert lines.count('# EOF') == 1 and lines[-1] == '# EOF'
+    assert 'ecowitt_exporter_report_seconds_count 1.0' in lines
@@ -0,0 +1,213 @@
+'''Taking reports from MQTT, against the stand-in broker in fake_broker.py'''
+# pylint: disable=wrong-import-order
+import itertools
+import socket
+import threading
+import time
+
+import pytest
+
+import fake_broker
+from ecowitt_exporter import create_app
+from mqtt import (CONNACK, CONNECT, PINGRESP, PUBACK, PUBLISH, SUBACK, SUBSCRIBE, Subscriber,
+                  packet, read_publish, split_packets, string, topic_pattern)
+from payloads import raw_payload
+
+from helpers import make_exporter, value, wait
+
+PASSKEY = 'E05DDF79DADE150B6477AE0772D37CF8'
+
+client_ids = (f'test-{index}' for index in itertools.count())
+
+
+@pytest.fixture
+def broker():
+    server = fake_broker.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def subscribed(broker):
+    '''Start an exporter taking reports from `broker` with extra settings, stopping it afterwards'''
+    started = []
+
+    def start(environ: dict = None):
+        exporter = make_exporter({'MQTT_URL': broker.url, 'MQTT_QOS': '1', 'MQTT_CLIENT_ID': next(client_ids),
+                                  **(environ or {})})
+        started.append(exporter.subscriber)
+        exporter.subscriber.start()
+        assert wait(lambda: exporter.subscriber.connects)
+        return exporter
+
+    yield start
+    for subscriber in started:
+        subscriber.stop()
+
+
+@pytest.mark.parametrize('topic_filter, topic, groups', [
+    ('ecowitt/+', 'ecowitt/garden', ('garden',)),
+    ('ecowitt/+', 'ecowitt/garden/extra', None),
+    ('ecowitt/+', 'other/garden', None),
+    ('ecowitt/#', 'ecowitt', (None,)),
+    ('ecowitt/#', 'ecowitt/a/b', ('a/b',)),
+    ('#', 'any/topic', ('any/topic',)),
+    ('site/+/gw/+', 'site/north/gw/1', ('north', '1')),
+    ('a.b/c', 'a.b/c', ()),
+    ('a.b/c', 'axb/c', None),
+])
+def test_topic_pattern(topic_filter, topic, groups):
+    match = topic_pattern(topic_filter).match(topic)
+    assert (match and match.groups()) == groups
+
+
+def test_station_name():
+    subscriber = Subscriber('mqtt://localhost', ['ecowitt/+', 'site/+/gw/#', 'fixed/topic'], None, None)
+    assert subscriber.station_name('ecowitt/garden') == 'garden'
+    assert subscriber.station_name('site/north/gw/1') == 'north'
+    assert subscriber.station_name('fixed/topic') is None
+    assert subscriber.station_name('ecowitt/') is None
+    assert subscriber.station_name('unsubscribed') is None
+
+
+def test_packets_round_trip():
+    body = string('ecowitt/garden') + b'\x00\x07' + raw_payload()
+    buffer = bytearray(packet(PUBLISH, body, flags=2) + packet(PUBLISH, b'x' * 200))
+    last = buffer[-10:]
+    del buffer[-10:]
+    assert split_packets(buffer) == [(PUBLISH << 4 | 2, body)]
+    assert len(buffer) == len(packet(PUBLISH, b'x' * 200)) - 10
+    buffer += last
+    assert split_packets(buffer) == [(PUBLISH << 4, b'x' * 200)] and not buffer
+    assert read_publish(PUBLISH << 4 | 2, body) == ('ecowitt/garden', b'\x00\x07', raw_payload())
+
+
+@pytest.mark.parametrize('size', [0, 127, 128, 16383, 16384])
+def test_packets_arriving_a_byte_at_a_time(size):
+    '''Lengths of one to three bytes, split anywhere, including within the length'''
+    whole = packet(PUBLISH, b'x' * size) + packet(PINGRESP)
+    buffer = bytearray()
+    packets = []
+    for byte in whole:
+        buffer.append(byte)
+        packets += split_packets(buffer)
+    assert packets == [(PUBLISH << 4, b'x' * size), (PINGRESP << 4, b'')] and not buffer
+
+
+def test_longest_packet_length():
+    buffer = bytearray(packet(PUBLISH, b'x' * 2097152))
+    assert buffer[1:5] == b'\x80\x80\x80\x01'
+    assert split_packets(buffer) == [(PUBLISH << 4, b'x' * 2097152)]
+
+
+def test_malformed_length_closes_the_connection():
+    with pytest.raises(ConnectionError):
+        split_packets(bytearray(b'\x30\xff\xff\xff\xff\x01'))
+
+
+def dribble(connection: socket.socket, data: bytes):
+    '''Send `data` a few bytes at a time, so that it arrives in many reads'''
+    for start in range(0, len(data), 7):
+        connection.sendall(data[start:start + 7])
+        time.sleep(0.0005)
+
+
+def receive(connection: socket.socket, buffer: bytearray, kind: int) -> bytes:
+    '''Read until a packet of `kind` arrives, returning its body, or None if the connection closes'''
+    while True:
+        for first, body in split_packets(buffer):
+            if first >> 4 == kind:
+                return body
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+        buffer += chunk
+
+
+def test_packets_split_across_reads_and_reconnecting():
+    '''
+    Against a broker that sends everything a few bytes at a time and drops
+    the first connection once its message is acknowledged
+    '''
+    listener = socket.create_server(('127.0.0.1', 0))
+    acknowledged = []
+
+    def serve():
+        for station in ('garden', 'attic'):
+            connection, _ = listener.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with connection:
+                buffer = bytearray()
+                receive(connection, buffer, CONNECT)
+                dribble(connection, packet(CONNACK, b'\x00\x00'))
+                packet_id = receive(connection, buffer, SUBSCRIBE)[:2]
+                dribble(connection, packet(SUBACK, packet_id + b'\x01') + packet(
+                    PUBLISH, string(f'ecowitt/{station}') + b'\x00\x01' + raw_payload(), flags=2))
+                # Acknowledged once ingested, then the connection is dropped or closed by stop()
+                acknowledged.append(receive(connection, buffer, PUBACK))
+                if station == 'attic':
+                    receive(connection, buffer, -1)
+
+    server = threading.Thread(target=serve, daemon=True)
+    server.start()
+    exporter = make_exporter({'MQTT_URL': f'mqtt://127.0.0.1:{listener.getsockname()[1]}', 'MQTT_QOS': '1'})
+    subscriber = exporter.subscriber
+    subscriber.start()
+    try:
+        assert wait(lambda: len(acknowledged) == 2)
+        assert acknowledged == [b'\x00\x01', b'\x00\x01']
+        for station in ('garden', 'attic'):
+            assert value(exporter, 'temp', (station, 'outdoor', 'c', 'outdoor')) == 17.7
+        assert subscriber.connects == 2 and subscriber.errors == 1
+    finally:
+        subscriber.stop()
+        server.join(5)
+        listener.close()
+    assert not server.is_alive()
+
+
+def test_reports_match_posted(broker, subscribed):
+    '''A report over MQTT sets the same metrics as posted to /report, and retained ones are skipped'''
+    broker.publish('ecowitt/old', raw_payload(), qos=1, retain=True)
+    exporter = subscribed()
+    create_app(exporter).test_client().post('/report/http', data=raw_payload())
+    broker.publish('ecowitt/mqtt', raw_payload(), qos=1)
+    assert wait(lambda: exporter.subscriber.messages)
+    same = 0
+    for family in exporter.metrics.families.values():
+        if 'timestamp' in family.name or family.kind == 'counter':
+            continue
+        for key, sample in family.samples.items():
+            if key[0] == 'http':
+                other = family.samples.get(('mqtt',) + key[1:])
+                assert other is not None and other.value == sample.value, (family.name, key)
+                same += 1
+    assert same > 50
+    assert 'old' not in exporter.stations.names()
+
+
+def test_topic_without_wildcard_uses_passkey(broker, subscribed):
+    exporter = subscribed({'MQTT_TOPICS': 'weather', 'STATION_PASSKEYS': f'{PASSKEY}=attic'})
+    broker.publish('weather', raw_payload(), qos=1)
+    assert wait(lambda: exporter.subscriber.messages)
+    assert value(exporter, 'temp', ('attic', 'outdoor', 'c', 'outdoor')) == 17.7
+
+
+def test_new_stations_beyond_max_stations_are_refused(broker, subscribed):
+    exporter = subscribed({'MAX_STATIONS': '2'})
+    for name in ('one', 'two', 'three'):
+        broker.publish('ecowitt/' + name, raw_payload(), qos=1)
+    assert wait(lambda: exporter.subscriber.messages >= 3)
+    assert exporter.metrics.has('last_report_timestamp', ('one',))
+    assert exporter.metrics.has('last_report_timestamp', ('two',))
+    assert 'three' not in exporter.stations.names()
+
+
+def test_reports_are_not_lost_when_reconnecting(broker, subscribed):
+    exporter = subscribed()
+    broker.drop()
+    for index in range(5):
+        broker.publish(f'ecowitt/station{index}', raw_payload(), qos=1)
+    assert wait(lambda: all(exporter.metrics.has('last_report_timestamp', (f'station{index}',)) for index in range(5)))
+    assert exporter.subscriber.connects >= 2
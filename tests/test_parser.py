@@ -0,0 +1,68 @@
+'''Parsing Ecowitt report bodies and Weather Underground uploads'''
+# pylint: disable=wrong-import-order
+from urllib.parse import parse_qsl, urlencode
+
+from ecowitt_exporter import create_app
+from ingest import parse_body
+from payloads import raw_payload
+from wunderground import UPLOAD_PATH, parse_query
+
+from helpers import make_exporter, value
+
+
+def test_sample_report_parses_like_parse_qsl():
+    assert parse_body(raw_payload()) == dict(parse_qsl(raw_payload().decode(), keep_blank_values=True))
+
+
+def test_first_value_wins():
+    assert parse_body(b'tempf=60.1&tempf=70.2') == {'tempf': '60.1'}
+
+
+def test_values_are_unquoted():
+    data = parse_body(b'model=GW1100A%2BX&dateutc=2025-05-30+19%3A31%3A57&tempf=63.86')
+    assert data == {'model': 'GW1100A+X', 'dateutc': '2025-05-30 19:31:57', 'tempf': '63.86'}
+
+
+def test_empty_pairs_and_bare_keys():
+    assert parse_body(b'&tempf=63.86&&flag&') == {'tempf': '63.86', 'flag': ''}
+
+
+def test_keys_are_renamed_or_dropped():
+    data = parse_body(b'ID=abc&PASSWORD=secret&tempf=63.86', {'ID': 'PASSKEY', 'PASSWORD': None})
+    assert data == {'PASSKEY': 'abc', 'tempf': '63.86'}
+
+
+def test_wunderground_query():
+    data = parse_query(b'ID=KXX1&PASSWORD=secret&action=updateraw&indoortempf=70.5&baromin=30.1&tempf=63.86')
+    assert data == {'PASSKEY': 'KXX1', 'tempinf': '70.5', 'baromrelin': '30.1', 'tempf': '63.86'}
+
+
+def test_report_sets_metrics():
+    exporter = make_exporter()
+    client = create_app(exporter).test_client()
+    response = client.post('/report/garden', data=raw_payload())
+    assert response.status_code == 200 and response.data == b'OK'
+    assert value(exporter, 'temp', ('garden', 'outdoor', 'c', 'outdoor')) == 17.7
+    assert value(exporter, 'humidity', ('garden', 'outdoor', 'percent', 'outdoor')) == 75.0
+    assert value(exporter, 'winddir', ('garden',)) == 173.0
+
+
+def test_wunderground_upload_sets_metrics():
+    exporter = make_exporter()
+    client = create_app(exporter).test_client()
+    response = client.get(UPLOAD_PATH + '?' + urlencode({'ID': 'KXX1', 'PASSWORD': 'secret', 'tempf': '63.86',
+                                                          'indoortempf': '86.18', 'humidity': '75'}))
+    assert response.status_code == 200 and response.data == b'success'
+    station = exporter.config.station_id
+    assert value(exporter, 'temp', (station, 'outdoor', 'c', 'outdoor')) == 17.7
+    assert value(exporter, 'temp', (station, 'indoor', 'c', 'indoor')) == 30.1
+
+
+def test_new_stations_beyond_max_stations_are_refused():
+    exporter = make_exporter({'MAX_STATIONS': '2'})
+    client = create_app(exporter).test_client()
+    assert client.post('/report/one', data=raw_payload()).status_code == 200
+    assert client.post('/report/two', data=raw_payload()).status_code == 200
+    assert client.post('/report/three', data=raw_payload()).status_code == 403
+    assert client.post('/report/one', data=raw_payload()).status_code == 200
+    assert 'three' not in exporter.stations.names()
@@ -0,0 +1,43 @@
+'''INGEST_MODE=async: reports queued for a background thread, and refused when it falls behind'''
+# pylint: disable=wrong-import-order
+from urllib.parse import urlencode
+
+from ecowitt_exporter import create_app
+from payloads import sample_payload
+
+from helpers import make_exporter, value, wait
+
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+
+
+def body(tempf: str) -> bytes:
+    return urlencode({**sample_payload(), 'tempf': tempf}).encode()
+
+
+def test_reports_are_applied_in_the_background():
+    exporter = make_exporter({'INGEST_MODE': 'async'})
+    client = create_app(exporter).test_client()
+    assert client.post('/report/garden', data=body('68')).status_code == 200
+    assert wait(lambda: value(exporter, 'temp', OUTDOOR) == 20)
+
+
+def test_full_queue_answers_503_and_only_the_latest_report_is_applied():
+    exporter = make_exporter({'INGEST_MODE': 'async', 'INGEST_QUEUE_SIZE': '2', 'RETRY_AFTER': '7'})
+    client = create_app(exporter).test_client()
+    station = exporter.stations.get('garden')
+    applied = []
+    ingest = exporter.ingest_queue.apply
+    exporter.ingest_queue.apply = lambda *args: applied.append(args[1]['tempf']) or ingest(*args)
+
+    # Holding the station's lock keeps the consumer stuck in the first report
+    with station.lock:
+        assert client.post('/report/garden', data=body('32')).status_code == 200
+        assert wait(exporter.ingest_queue.queue.empty)
+        for tempf in ('50', '68'):
+            assert client.post('/report/garden', data=body(tempf)).status_code == 200
+        refused = client.post('/report/garden', data=body('86'))
+        assert refused.status_code == 503
+        assert refused.headers['Retry-After'] == '7'
+    assert wait(lambda: len(applied) == 2)
+    assert applied == ['32', '68']
+    assert value(exporter, 'temp', OUTDOOR) == 20
@@ -0,0 +1,95 @@
+'''Polling gateways' local API, against the stand-in gateways in fake_gateway.py'''
+# pylint: disable=wrong-import-order
+import socket
+import time
+
+import pytest
+
+from config import parse_gateways
+from fake_gateway import livedata, start_fleet
+from ingest import parse_body
+from payloads import raw_payload, sample_payload
+from poller import livedata_payload, split_value, to_protocol
+
+from helpers import make_exporter, value, wait
+
+
+@pytest.fixture
+def gateways():
+    servers = start_fleet(2)
+    yield [server.server_address[1] for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_parse_gateways():
+    assert parse_gateways('roof=10.0.0.2:8080, 10.0.0.3,,') == [('roof', '10.0.0.2', 8080), ('10.0.0.3', '10.0.0.3', 80)]
+
+
+def test_split_value():
+    assert split_value('1013.2 hPa') == (1013.2, 'hpa')
+    assert split_value('65%') == (65.0, '%')
+    assert split_value('-3.5', 'C') == (-3.5, 'c')
+    with pytest.raises(ValueError):
+        split_value('--')
+
+
+def test_to_protocol():
+    assert to_protocol('temperature', '20.0', '°C') == '68'
+    assert to_protocol('temperature', '68.5', 'F') == '68.5'
+    assert abs(float(to_protocol('pressure', '1013.25 hPa')) - 29.921) < 0.001
+    assert to_protocol('wind', '10 km/h') == '6.2137'
+
+
+def test_unknown_readings_are_left_out():
+    data = livedata_payload({'common_list': [{'id': '0x02', 'val': 'bad', 'unit': 'C'}, {'id': 'nope', 'val': '1'}]})
+    assert not data
+
+
+def test_polled_readings_match_pushed():
+    '''The sample readings polled in metric units set the same metrics as pushed'''
+    exporter = make_exporter()
+    now = time.time()
+    exporter.ingest(exporter.stations.get('push'), parse_body(raw_payload()), now)
+    exporter.ingest(exporter.stations.get('poll'), livedata_payload(livedata(sample_payload())), now)
+    same = 0
+    for family in exporter.metrics.families.values():
+        if family.kind != 'gauge' or 'timestamp' in family.name:
+            continue
+        for key, sample in family.samples.items():
+            polled = family.samples.get(('poll',) + key[1:]) if key[0] == 'push' else None
+            if polled is not None:
+                assert abs(polled.value - sample.value) <= max(0.15, abs(sample.value) * 0.005), (family.name, key)
+                same += 1
+    assert same > 30
+
+
+def test_poller_sets_metrics(gateways):
+    exporter = make_exporter({'POLL_GATEWAYS': f'roof=127.0.0.1:{gateways[0]},127.0.0.1:{gateways[1]}',
+                              'POLL_INTERVAL': '0.1'})
+    poller = exporter.poller
+    poller.start()
+    try:
+        assert wait(lambda: exporter.metrics.has('last_report_timestamp', ('roof',))
+                    and exporter.metrics.has('last_report_timestamp', ('127.0.0.1',)))
+        assert wait(lambda: poller.polls >= 6)
+    finally:
+        poller.stop()
+    assert poller.errors == 0
+    assert abs(value(exporter, 'temp', ('roof', 'outdoor', 'c', 'outdoor')) - 17.7) <= 0.35
+    assert value(exporter, 'humidity', ('127.0.0.1', 'outdoor', 'percent', 'outdoor')) == 75.0
+
+
+def test_unreachable_gateway_counts_errors():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    exporter = make_exporter({'POLL_GATEWAYS': f'gone=127.0.0.1:{port}', 'POLL_INTERVAL': '0.05', 'POLL_TIMEOUT': '1'})
+    poller = exporter.poller
+    poller.start()
+    try:
+        assert wait(lambda: poller.errors >= 2)
+    finally:
+        poller.stop()
+    assert not exporter.metrics.has('last_report_timestamp', ('gone',))
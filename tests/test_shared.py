@@ -0,0 +1,110 @@
+'''Sharing metrics between worker processes through MULTIPROC_DIR, with forked stand-in workers'''
+# pylint: disable=wrong-import-order
+import glob
+import os
+import time
+
+import pytest
+
+from ingest import parse_body
+from payloads import raw_payload
+
+from helpers import make_exporter, value
+
+OUTDOOR = ('outdoor', 'c', 'outdoor')
+
+
+def in_worker(work, running=None):
+    '''
+    Run `work` in a forked process, as gunicorn runs a worker. If `running`
+    is given, it is called while the worker is still alive, after `work`.
+    '''
+    ready, done = os.pipe(), os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            work()
+            os.write(ready[1], b'.')
+            os.read(done[0], 1)
+            code = 0
+        finally:
+            os._exit(code) # pylint: disable=protected-access
+    try:
+        assert os.read(ready[0], 1) == b'.'
+        if running:
+            running()
+    finally:
+        os.write(done[1], b'.')
+        _pid, status = os.waitpid(pid, 0)
+        for descriptor in ready + done:
+            os.close(descriptor)
+    assert os.waitstatus_to_exitcode(status) == 0
+
+
+def report(exporter, station: str, tempf: str = None):
+    data = parse_body(raw_payload())
+    if tempf:
+        data['tempf'] = tempf
+    exporter.ingest(exporter.stations.get(station), data, time.time())
+
+
+@pytest.fixture
+def shared(tmp_path):
+    '''An exporter sharing its metrics, as gunicorn's master sets it up before forking'''
+    exporter = make_exporter({'MULTIPROC_DIR': str(tmp_path / 'shared'), 'STATE_FILE': str(tmp_path / 'state.bin')})
+    exporter.share()
+    return exporter
+
+
+def files(exporter) -> list:
+    return sorted(os.path.basename(path) for path in glob.glob(os.path.join(exporter.config.multiproc_dir, '*')))
+
+
+def test_newest_value_wins_and_counters_add_up(shared):
+    def work():
+        report(shared, 'garden', '50')
+        shared.shared.save()
+
+    def running():
+        merged = shared.current_snapshot()
+        assert value(shared, 'temp', ('garden',) + OUTDOOR) is None
+        assert merged.families['temp'].samples[('garden',) + OUTDOOR].value == 10.0
+        lookups = merged.families['change_cache_lookups'].samples[('garden',)].value
+
+        report(shared, 'garden', '68')
+        merged = shared.current_snapshot()
+        assert merged.families['temp'].samples[('garden',) + OUTDOOR].value == 20.0
+        assert merged.families['change_cache_lookups'].samples[('garden',)].value == 2 * lookups
+
+    in_worker(work, running)
+
+
+def test_killed_worker_is_dropped(shared):
+    def work():
+        report(shared, 'garden')
+        shared.shared.save()
+
+    in_worker(work)
+    assert len(files(shared)) == 2
+    merged = shared.current_snapshot()
+    assert ('garden',) + OUTDOOR not in merged.families['temp'].samples
+    assert files(shared) == [f'{os.getpid()}.snapshot']
+
+
+def test_exited_workers_are_kept_and_saved(shared, tmp_path):
+    '''Workers that exit hand their series on, so the final save to STATE_FILE has them'''
+    for station in ('one', 'two'):
+        def work(station=station):
+            report(shared, station)
+            shared.shared.close()
+        in_worker(work)
+    assert files(shared) == [f'{os.getpid()}.snapshot', 'retired.snapshot']
+
+    shared.state.save(shared.current_snapshot())
+    shared.shared.close()
+    assert not files(shared)
+
+    restarted = make_exporter({'STATE_FILE': str(tmp_path / 'state.bin')})
+    assert value(restarted, 'temp', ('one',) + OUTDOOR) == 17.7
+    assert value(restarted, 'temp', ('two',) + OUTDOOR) == 17.7
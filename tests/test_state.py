@@ -0,0 +1,85 @@
+'''Keeping the metrics across restarts in STATE_FILE'''
+# pylint: disable=wrong-import-order
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from ingest import parse_body
+from payloads import raw_payload
+from state import StateFile
+
+from helpers import make_exporter, value, wait
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTDOOR = ('garden', 'outdoor', 'c', 'outdoor')
+
+
+def reported(state_file: str, **environ):
+    exporter = make_exporter({'STATE_FILE': state_file, **environ})
+    exporter.ingest(exporter.stations.get('garden'), parse_body(raw_payload()), 1000.0)
+    return exporter
+
+
+def test_restore_keeps_values_and_report_times(tmp_path):
+    path = str(tmp_path / 'state.bin')
+    exporter = reported(path)
+    exporter.state.save(exporter.metrics)
+
+    restarted = make_exporter({'STATE_FILE': path})
+    assert value(restarted, 'temp', OUTDOOR) == 17.7
+    assert value(restarted, 'last_report_timestamp', ('garden',)) == 1000.0
+    assert restarted.metrics.families['temp'].samples[OUTDOOR].updated == 1000.0
+    # Counters start again from zero
+    assert not restarted.metrics.families['change_cache_lookups'].samples
+
+
+def test_state_saved_with_other_units_is_ignored(tmp_path):
+    path = str(tmp_path / 'state.bin')
+    exporter = reported(path)
+    exporter.state.save(exporter.metrics)
+    assert value(make_exporter({'STATE_FILE': path, 'TEMPERATURE_UNIT': 'f'}), 'temp', OUTDOOR) is None
+
+
+def test_unreadable_state_is_ignored(tmp_path):
+    path = tmp_path / 'state.bin'
+    path.write_bytes(b'not a snapshot')
+    exporter = make_exporter({'STATE_FILE': str(path)})
+    assert not exporter.metrics.families['temp'].samples
+
+
+def test_saves_at_most_every_interval(tmp_path):
+    path = str(tmp_path / 'state.bin')
+    exporter = reported(path)
+    state = StateFile(path, interval=60)
+    state.changed(exporter.metrics)
+    assert not os.path.exists(path)
+    state.saved -= 60
+    state.changed(lambda: exporter.metrics)
+    assert os.path.exists(path)
+
+
+def test_saved_when_stopped(tmp_path):
+    '''SIGTERM, as docker stop sends, saves the state before the exporter exits'''
+    path = str(tmp_path / 'state.bin')
+    environ = dict(os.environ, STATE_FILE=path, STATE_INTERVAL='3600')
+    process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'ecowitt_exporter.py')], env=environ, cwd=ROOT,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        def posted():
+            try:
+                with urllib.request.urlopen('http://127.0.0.1:8088/report/garden', raw_payload(), timeout=1) as response:
+                    return response.status == 200
+            except OSError:
+                time.sleep(0.1)
+                return False
+        assert wait(posted)
+        assert not os.path.exists(path)
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+    assert value(make_exporter({'STATE_FILE': path}), 'temp', OUTDOOR) == 17.7
@@ -0,0 +1,55 @@
+'''Weather Underground uploads, read into the keys of an Ecowitt report'''
+# pylint: disable=wrong-import-order
+from urllib.parse import urlencode
+
+from ecowitt_exporter import create_app
+from wunderground import UPLOAD_PATH, parse_query
+
+from helpers import make_exporter, value
+
+UPLOAD = {
+    'ID': 'KXYZ123', 'PASSWORD': 'secret', 'action': 'updateraw', 'realtime': '1', 'rtfreq': '5',
+    'dateutc': 'now', 'softwaretype': 'EasyWeather V1.6', 'tempf': '68', 'humidity': '50',
+    'indoortempf': '70', 'indoorhumidity': '40', 'baromin': '29.92', 'absbaromin': '29.50',
+    'rainin': '0.1', 'dailyrainin': '0.5', 'windspeedmph': '5', 'winddir': '180', 'UV': '3',
+    'solarradiation': '100', 'dewptf': '49', 'windchillf': '68',
+}
+
+
+def test_fields_are_renamed_or_dropped():
+    data = parse_query(urlencode(UPLOAD).encode())
+    assert data['PASSKEY'] == 'KXYZ123'
+    assert data['stationtype'] == 'EasyWeather V1.6'
+    assert (data['tempinf'], data['humidityin'], data['uv']) == ('70', '40', '3')
+    assert (data['baromrelin'], data['baromabsin'], data['hourlyrainin']) == ('29.92', '29.50', '0.1')
+    # Unchanged where the names are the same
+    assert (data['tempf'], data['dailyrainin'], data['winddir']) == ('68', '0.5', '180')
+    for dropped in ('ID', 'PASSWORD', 'action', 'realtime', 'rtfreq', 'softwaretype', 'dewptf', 'windchillf'):
+        assert dropped not in data
+
+
+def test_upload_sets_the_same_metrics_as_a_report():
+    exporter = make_exporter({'STATION_PASSKEYS': 'KXYZ123=roof'})
+    response = create_app(exporter).test_client().get(f'{UPLOAD_PATH}?{urlencode(UPLOAD)}')
+    assert response.status_code == 200 and response.data == b'success'
+    assert value(exporter, 'temp', ('roof', 'outdoor', 'c', 'outdoor')) == 20
+    assert value(exporter, 'temp', ('roof', 'indoor', 'c', 'indoor')) == 21.11
+    assert value(exporter, 'humidity', ('roof', 'indoor', 'percent', 'indoor')) == 40
+    assert value(exporter, 'barom', ('roof', 'relative', 'hpa')) == 1013.21
+    assert value(exporter, 'rain', ('roof', 'hourly', 'mm')) == 2.5
+    assert value(exporter, 'uv', ('roof',)) == 3
+    assert exporter.metrics.handle('stationtype', ('roof',)).labels == ('roof', 'EasyWeather V1.6')
+    assert exporter.metrics.has('last_report_timestamp', ('roof',))
+
+    # Posted as an Ecowitt report instead, the same readings set the same series
+    posted = make_exporter({'STATION_PASSKEYS': 'KXYZ123=roof'})
+    ecowitt = {'PASSKEY': 'KXYZ123', 'stationtype': 'EasyWeather V1.6', 'tempinf': '70', 'humidityin': '40',
+               'baromrelin': '29.92', 'baromabsin': '29.50', 'hourlyrainin': '0.1', 'uv': '3',
+               **{key: UPLOAD[key] for key in ('tempf', 'humidity', 'dailyrainin', 'windspeedmph', 'winddir',
+                                               'solarradiation')}}
+    create_app(posted).test_client().post('/report', data=urlencode(ecowitt))
+    for metric, family in posted.metrics.families.items():
+        if 'timestamp' in family.name or family.kind == 'counter':
+            continue
+        for key, sample in family.samples.items():
+            assert value(exporter, metric, key) == sample.value, (metric, key)
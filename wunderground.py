@@ -0,0 +1,41 @@
+'''
+Accept reports in the Weather Underground protocol.
+
+Gateways and repeaters that cannot send Ecowitt's POST can usually upload
+to a custom server as if it were Weather Underground, a GET to
+/weatherstation/updateweatherstation.php with the readings in the query
+string. Most of its fields are named as in an Ecowitt report already; the
+rest are renamed while the query string is parsed, so a WU report is then
+handled exactly like a pushed one.
+'''
+from ingest import parse_body
+
+UPLOAD_PATH = '/weatherstation/updateweatherstation.php'
+
+# WU fields that differ from Ecowitt's, and their Ecowitt names. The station
+# ID stands in for the PASSKEY, so STATION_PASSKEYS can name WU stations.
+# Fields mapped to None are dropped: credentials, upload settings and
+# readings that DERIVED_METRICS works out from the others.
+KEYS = {
+    'ID': 'PASSKEY',
+    'PASSWORD': None,
+    'action': None,
+    'realtime': None,
+    'rtfreq': None,
+    'softwaretype': 'stationtype',
+    'indoortempf': 'tempinf',
+    'indoorhumidity': 'humidityin',
+    'baromin': 'baromrelin',
+    'absbaromin': 'baromabsin',
+    'rainin': 'hourlyrainin',
+    'UV': 'uv',
+    'soilmoisture': 'soilmoisture1',
+    'AqPM2.5': 'pm25_ch1',
+    'dewptf': None,
+    'windchillf': None,
+}
+
+
+def parse_query(query: bytes) -> dict:
+    '''Parse a WU query string into the keys of an Ecowitt report'''
+    return parse_body(query, KEYS)